@@ -0,0 +1,352 @@
+"""
+Online snapshots of the live database.
+
+A snapshot copies the database with SQLite's backup API a few pages per step,
+sleeping between steps, inside one read transaction: in WAL mode that keeps
+the copy consistent without blocking the writer, and the copy doesn't restart
+every time the bot commits. The copy is gzipped into BACKUP_DIR and old
+snapshots are rotated. The same scheduler checkpoints the WAL so the -wal file
+stays bounded.
+
+    python backup.py snapshot
+    python backup.py list
+    python backup.py checkpoint --mode TRUNCATE
+    python backup.py restore backups/kbju-20260101-030000.sqlite3.gz   # bot stopped
+"""
+from __future__ import annotations
+
+import argparse
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+
+import metrics
+
+log = logging.getLogger("kbju.backup")
+
+CHECKPOINT_MODES = ("PASSIVE", "FULL", "RESTART", "TRUNCATE")
+
+
+def _snapshot_name(db_path: str) -> str:
+    return f"{Path(db_path).stem}-{datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')}.sqlite3.gz"
+
+
+def list_snapshots(db_path: str, backup_dir: str) -> list[Path]:
+    """Snapshots of db_path in backup_dir, oldest first."""
+    d = Path(backup_dir)
+    if not d.is_dir():
+        return []
+    return sorted(d.glob(f"{Path(db_path).stem}-*.sqlite3.gz"))
+
+
+def wal_size(db_path: str) -> int:
+    try:
+        return os.path.getsize(db_path + "-wal")
+    except OSError:
+        return 0
+
+
+def copy_online(db_path: str, dest_path: str, pages: int = 256, pause: float = 0.005) -> dict[str, Any]:
+    """
+    Copy db_path to dest_path with the backup API, `pages` pages per step and
+    `pause` seconds between steps. The GIL and the source are released during
+    the pause, so handlers and the writer keep running.
+    """
+    src = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+    dst = sqlite3.connect(dest_path)
+    steps = 0
+    slowest = 0.0
+    last = time.perf_counter()
+
+    def progress(status: int, remaining: int, total: int) -> None:
+        nonlocal steps, slowest, last
+        now = time.perf_counter()
+        step = now - last
+        metrics.backup_step_seconds.observe(step)
+        slowest = max(slowest, step)
+        steps += 1
+        if remaining and pause:
+            time.sleep(pause)
+        last = time.perf_counter()
+
+    t0 = time.perf_counter()
+    try:
+        # pin one WAL snapshot for the whole copy; otherwise every commit of
+        # the bot restarts the backup from page 1
+        src.execute("BEGIN")
+        src.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+        src.backup(dst, pages=pages, progress=progress)
+        src.execute("COMMIT")
+        page_count = dst.execute("PRAGMA page_count").fetchone()[0]
+        page_size = dst.execute("PRAGMA page_size").fetchone()[0]
+    finally:
+        dst.close()
+        src.close()
+    return {
+        "seconds": time.perf_counter() - t0,
+        "pages": page_count,
+        "bytes": page_count * page_size,
+        "steps": steps,
+        "max_step_seconds": slowest,
+    }
+
+
+def snapshot(db_path: str, backup_dir: str, keep: int = 7, pages: int = 256, pause: float = 0.005) -> dict[str, Any]:
+    """Online copy -> integrity check -> gzip into backup_dir -> drop all but the newest `keep`."""
+    Path(backup_dir).mkdir(parents=True, exist_ok=True)
+    target = Path(backup_dir) / _snapshot_name(db_path)
+    t0 = time.perf_counter()
+    with tempfile.TemporaryDirectory(dir=backup_dir, prefix=".snapshot-") as tmp:
+        raw = os.path.join(tmp, "copy.sqlite3")
+        try:
+            info = copy_online(db_path, raw, pages=pages, pause=pause)
+            conn = sqlite3.connect(raw)
+            try:
+                check = conn.execute("PRAGMA quick_check").fetchone()[0]
+            finally:
+                conn.close()
+            if check != "ok":
+                raise RuntimeError(f"snapshot of {db_path} failed quick_check: {check}")
+            t1 = time.perf_counter()
+            part = target.with_name(target.name + ".part")
+            with open(raw, "rb") as fin, gzip.open(part, "wb", compresslevel=6) as fout:
+                shutil.copyfileobj(fin, fout, 1 << 20)
+            os.replace(part, target)
+        except Exception:
+            metrics.backup_errors.inc(op="snapshot")
+            raise
+    info.update({
+        "path": str(target),
+        "compressed_bytes": target.stat().st_size,
+        "compress_seconds": time.perf_counter() - t1,
+        "total_seconds": time.perf_counter() - t0,
+        "removed": [str(p) for p in rotate(db_path, backup_dir, keep)],
+    })
+    metrics.backup_seconds.observe(info["total_seconds"], op="snapshot")
+    return info
+
+
+def rotate(db_path: str, backup_dir: str, keep: int) -> list[Path]:
+    old = list_snapshots(db_path, backup_dir)[:-keep] if keep > 0 else []
+    for p in old:
+        p.unlink(missing_ok=True)
+    return old
+
+
+def checkpoint(db_path: str, mode: str = "PASSIVE", busy_timeout_ms: int = 2000) -> dict[str, Any]:
+    """
+    PRAGMA wal_checkpoint(mode) on its own connection. PASSIVE never waits;
+    TRUNCATE waits up to busy_timeout_ms for readers and then resets -wal to
+    zero bytes.
+    """
+    mode = mode.upper()
+    if mode not in CHECKPOINT_MODES:
+        raise ValueError(f"unknown checkpoint mode {mode}")
+    before = wal_size(db_path)
+    t0 = time.perf_counter()
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        conn.execute(f"PRAGMA busy_timeout={int(busy_timeout_ms)}")
+        busy, log_frames, done = conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+    finally:
+        conn.close()
+    seconds = time.perf_counter() - t0
+    metrics.backup_seconds.observe(seconds, op="checkpoint")
+    return {
+        "mode": mode,
+        "busy": bool(busy),
+        "wal_frames": log_frames,
+        "checkpointed": done,
+        "wal_bytes_before": before,
+        "wal_bytes_after": wal_size(db_path),
+        "seconds": seconds,
+    }
+
+
+def restore(archive: str, db_path: str) -> dict[str, Any]:
+    """
+    Replace db_path with a snapshot. Run with the bot stopped. The current
+    database is first saved next to it as <db>.before-restore.
+    """
+    t0 = time.perf_counter()
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(db_path)), prefix=".restore-") as tmp:
+        raw = os.path.join(tmp, "restore.sqlite3")
+        opener = gzip.open if archive.endswith(".gz") else open
+        with opener(archive, "rb") as fin, open(raw, "wb") as fout:
+            shutil.copyfileobj(fin, fout, 1 << 20)
+        src = sqlite3.connect(raw)
+        try:
+            check = src.execute("PRAGMA integrity_check").fetchone()[0]
+            if check != "ok":
+                raise RuntimeError(f"{archive} failed integrity_check: {check}")
+            if os.path.exists(db_path):
+                cur, keep = sqlite3.connect(db_path), sqlite3.connect(db_path + ".before-restore")
+                try:
+                    cur.backup(keep)
+                finally:
+                    keep.close()
+                    cur.close()
+            # the backup API writes through SQLite's locks and the WAL, unlike a file copy
+            dst = sqlite3.connect(db_path)
+            try:
+                src.backup(dst)
+                dst.execute("PRAGMA journal_mode=WAL")
+                dst.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            finally:
+                dst.close()
+        finally:
+            src.close()
+    seconds = time.perf_counter() - t0
+    metrics.backup_seconds.observe(seconds, op="restore")
+    return {"path": db_path, "from": archive, "seconds": seconds}
+
+
+class BackupScheduler:
+    """
+    Background thread: a snapshot every `interval` seconds and a WAL
+    checkpoint every `checkpoint_interval` seconds (0 disables either).
+    The checkpoint is PASSIVE unless -wal has grown past wal_max_bytes.
+    """
+
+    def __init__(self, db_path: str, backup_dir: str, interval: float = 86400.0, keep: int = 7,
+                 checkpoint_interval: float = 300.0, wal_max_bytes: int = 64 << 20,
+                 pages: int = 256, pause: float = 0.005):
+        self.db_path = db_path
+        self.backup_dir = backup_dir
+        self.interval = interval
+        self.keep = keep
+        self.checkpoint_interval = checkpoint_interval
+        self.wal_max_bytes = wal_max_bytes
+        self.pages = pages
+        self.pause = pause
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.running = False
+        self.last_snapshot: dict[str, Any] = {}
+        self.last_checkpoint: dict[str, Any] = {}
+
+    def start(self) -> None:
+        if (self._thread and self._thread.is_alive()) or not (self.interval or self.checkpoint_interval):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="backup", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(10)
+
+    def _due_snapshot(self) -> float:
+        # resume the schedule from the newest snapshot on disk, so restarts don't snapshot every time
+        snaps = list_snapshots(self.db_path, self.backup_dir)
+        return snaps[-1].stat().st_mtime + self.interval if snaps else time.time()
+
+    def _loop(self) -> None:
+        next_snapshot = self._due_snapshot() if self.interval else float("inf")
+        next_checkpoint = time.time() + self.checkpoint_interval if self.checkpoint_interval else float("inf")
+        while not self._stop.wait(max(0.0, min(next_snapshot, next_checkpoint) - time.time())):
+            now = time.time()
+            if now >= next_snapshot:
+                self.run_snapshot()
+                next_snapshot = time.time() + self.interval
+            if now >= next_checkpoint:
+                self.run_checkpoint()
+                next_checkpoint = time.time() + self.checkpoint_interval
+
+    def run_snapshot(self) -> dict[str, Any] | None:
+        self.running = True
+        try:
+            info = snapshot(self.db_path, self.backup_dir, keep=self.keep, pages=self.pages, pause=self.pause)
+            self.last_snapshot = {**info, "at": time.time()}
+            log.info(
+                "snapshot %s: %d pages in %.1fs (%d steps, slowest %.1f ms), %.1f MB gzipped",
+                info["path"], info["pages"], info["seconds"], info["steps"],
+                info["max_step_seconds"] * 1000, info["compressed_bytes"] / 1e6,
+            )
+            return info
+        except Exception:
+            log.exception("snapshot of %s failed", self.db_path)
+            return None
+        finally:
+            self.running = False
+
+    def run_checkpoint(self) -> dict[str, Any] | None:
+        mode = "TRUNCATE" if wal_size(self.db_path) > self.wal_max_bytes else "PASSIVE"
+        try:
+            info = checkpoint(self.db_path, mode)
+        except Exception:
+            metrics.backup_errors.inc(op="checkpoint")
+            log.exception("WAL checkpoint of %s failed", self.db_path)
+            return None
+        self.last_checkpoint = {**info, "at": time.time()}
+        if info["busy"]:
+            log.warning("WAL checkpoint (%s) was blocked by readers, -wal is %d bytes", mode, info["wal_bytes_after"])
+        return info
+
+    def stats(self) -> dict[str, float]:
+        snap, ckpt = self.last_snapshot, self.last_checkpoint
+        return {
+            "running": float(self.running),
+            "wal_bytes": float(wal_size(self.db_path)),
+            "last_snapshot_age_seconds": time.time() - snap["at"] if snap else -1.0,
+            "last_snapshot_bytes": float(snap.get("compressed_bytes", 0)),
+            "last_snapshot_seconds": float(snap.get("total_seconds", 0.0)),
+            "last_checkpoint_busy": float(ckpt.get("busy", False)),
+        }
+
+
+def main() -> None:
+    from dotenv import load_dotenv
+
+    from config import load_config
+
+    load_dotenv()
+    cfg = load_config()
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--db", default=cfg.db_path)
+    ap.add_argument("--dir", default=cfg.backup_dir)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("snapshot")
+    sub.add_parser("list")
+    ck = sub.add_parser("checkpoint")
+    ck.add_argument("--mode", default="TRUNCATE", choices=CHECKPOINT_MODES)
+    rs = sub.add_parser("restore")
+    rs.add_argument("archive")
+    rs.add_argument("--yes", action="store_true", help="don't ask for confirmation")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.cmd == "snapshot":
+        info = snapshot(args.db, args.dir, keep=cfg.backup_keep, pages=cfg.backup_step_pages, pause=cfg.backup_step_pause)
+        print(f"{info['path']}: {info['bytes'] / 1e6:.1f} MB -> {info['compressed_bytes'] / 1e6:.1f} MB, "
+              f"copy {info['seconds']:.2f}s in {info['steps']} steps (slowest {info['max_step_seconds'] * 1000:.1f} ms), "
+              f"gzip {info['compress_seconds']:.2f}s")
+        for p in info["removed"]:
+            print(f"removed {p}")
+    elif args.cmd == "list":
+        for p in list_snapshots(args.db, args.dir):
+            st = p.stat()
+            print(f"{datetime.fromtimestamp(st.st_mtime):%Y-%m-%d %H:%M:%S}  {st.st_size / 1e6:8.1f} MB  {p}")
+    elif args.cmd == "checkpoint":
+        info = checkpoint(args.db, args.mode)
+        print(f"{info['mode']}: busy={info['busy']} frames={info['wal_frames']} checkpointed={info['checkpointed']} "
+              f"-wal {info['wal_bytes_before']} -> {info['wal_bytes_after']} bytes in {info['seconds'] * 1000:.1f} ms")
+    elif args.cmd == "restore":
+        if not args.yes and input(f"Stop the bot first. Replace {args.db} with {args.archive}? [y/N] ").strip().lower() != "y":
+            return
+        info = restore(args.archive, args.db)
+        print(f"restored {info['path']} from {info['from']} in {info['seconds']:.2f}s "
+              f"(previous database saved as {args.db}.before-restore)")
+
+
+if __name__ == "__main__":
+    main()
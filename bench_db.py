@@ -0,0 +1,294 @@
+"""
+Microbenchmarks for the hot functions in database.py at realistic data sizes.
+
+    python bench_db.py --scale small --out bench.json
+    python bench_db.py --scale full --db /var/tmp/bench.sqlite3 --out new.json --compare bench.json
+
+The generated database is kept and reused when its sizes match, since filling
+10M food_log rows takes a while. With --compare the run exits with code 1 when
+any benchmark's median is slower than the baseline by more than --threshold.
+It also exits with 1 when a diary page DEEP_USER_ROWS entries deep costs more
+than DEEP_PAGE_SLACK times the first page.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable
+
+import database as db
+
+SCALES = {
+    #          users   log rows    products  user products  events
+    "tiny":   (1_000,     50_000,     10_000,       1_000,     50_000),
+    "small":  (10_000,   500_000,    100_000,      10_000,    500_000),
+    "medium": (50_000, 3_000_000,    500_000,      50_000,  2_000_000),
+    "full":   (100_000, 10_000_000, 1_000_000,    100_000,  5_000_000),
+}
+
+WORDS = [
+    "овсянка", "молоко", "банан", "яблоко", "курица", "рис", "гречка", "творог", "яйцо", "хлеб",
+    "сыр", "картофель", "говядина", "лосось", "кефир", "йогурт", "орехи", "макароны", "томат", "огурец",
+]
+WORDS_EN = [
+    "oatmeal", "milk", "banana", "apple", "chicken", "rice", "buckwheat", "cottage", "egg", "bread",
+    "cheese", "potato", "beef", "salmon", "kefir", "yogurt", "nuts", "pasta", "tomato", "cucumber",
+]
+EVENTS = ["start", "open_add_food", "search_start", "search_results", "pick_meal", "meal_chosen", "add_food_done", "open_summary", "open_recent", "back_to_main"]
+MEALS = ["breakfast", "lunch", "dinner", "snack"]
+DAYS = 90
+CHUNK = 50_000
+# diary pages of one user with this many log rows: a deep page must cost about what the first one does
+DEEP_USER_ROWS = 100_000
+DEEP_PAGE_SLACK = 3.0  # allowed deep/first page median ratio
+
+
+def _product_name(rnd: random.Random, i: int) -> tuple[str, str]:
+    k = rnd.randrange(len(WORDS))
+    j = rnd.randrange(len(WORDS))
+    return f"{WORDS[k]} {WORDS[j]} {i}", f"{WORDS_EN[k]} {WORDS_EN[j]} {i}"
+
+
+def _ts(base: datetime, seconds: int) -> str:
+    return (base + timedelta(seconds=seconds)).strftime(db.ISO)
+
+
+def generate(db_path: str, sizes: tuple[int, int, int, int, int], seed: int) -> None:
+    users, log_rows, products, user_products, events = sizes
+    rnd = random.Random(seed)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    db.init_db(db_path)
+    start = datetime.now(timezone.utc) - timedelta(days=DAYS)
+    span = DAYS * 86400
+
+    def fill(conn, sql: str, total: int, row: Callable[[int], tuple]) -> None:
+        for lo in range(0, total, CHUNK):
+            conn.executemany(sql, (row(i) for i in range(lo, min(total, lo + CHUNK))))
+            conn.commit()
+            print(f"\r  {sql.split()[2].split('(')[0]}: {min(total, lo + CHUNK):,}/{total:,}", end="", file=sys.stderr)
+        print(file=sys.stderr)
+
+    with db.connect(db_path) as conn:
+        conn.execute("PRAGMA synchronous=OFF")
+        fill(conn, "INSERT INTO users(user_id, username, lang, created_at, last_seen_at, timezone) VALUES(?, ?, ?, ?, ?, ?)", users,
+             lambda i: (i + 1, f"user{i + 1}", "ru" if i % 4 else "en", _ts(start, rnd.randrange(span)), _ts(start, span), "Europe/Moscow" if i % 3 else "UTC"))
+        fill(conn, "INSERT INTO products_global(name_ru, name_en, kcal, p, f, c, source, created_by_user_id, created_at) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)", products,
+             lambda i: (*_product_name(rnd, i), rnd.uniform(20, 600), rnd.uniform(0, 30), rnd.uniform(0, 30), rnd.uniform(0, 80), "bench", rnd.randint(1, users), _ts(start, rnd.randrange(span))))
+        fill(conn, "INSERT INTO products_user(user_id, name_ru, name_en, kcal, p, f, c, created_at) VALUES(?, ?, ?, ?, ?, ?, ?, ?)", user_products,
+             lambda i: (rnd.randint(1, users), *_product_name(rnd, i), rnd.uniform(20, 600), rnd.uniform(0, 30), rnd.uniform(0, 30), rnd.uniform(0, 80), _ts(start, rnd.randrange(span))))
+        # log rows arrive in time order, like production
+        step = span / max(log_rows, 1)
+        fill(conn, "INSERT INTO food_log(user_id, product_ref_type, product_ref_id, grams, meal, eaten_at) VALUES(?, ?, ?, ?, ?, ?)", log_rows,
+             lambda i: (rnd.randint(1, users), "global", rnd.randint(1, products), float(rnd.choice((30, 50, 100, 150, 200, 250))), rnd.choice(MEALS), _ts(start, int(i * step))))
+        step = span / max(events, 1)
+        fill(conn, "INSERT INTO events(user_id, event_name, meta_json, created_at) VALUES(?, ?, ?, ?)", events,
+             lambda i: (rnd.randint(1, users), rnd.choice(EVENTS), "{}", _ts(start, int(i * step))))
+        db.rebuild_product_stats(conn)
+        db.set_setting(conn, "bench_sizes", json.dumps([*sizes, seed]))
+        conn.commit()
+        conn.execute("ANALYZE")
+
+
+def existing_sizes(db_path: str) -> list | None:
+    if not os.path.exists(db_path):
+        return None
+    with db.connect(db_path) as conn:
+        try:
+            raw = db.get_setting(conn, "bench_sizes")
+        except Exception:
+            return None
+    return json.loads(raw) if raw else None
+
+
+def deep_user(db_path: str, users: int) -> int:
+    """A user with DEEP_USER_ROWS food_log rows (added to a reused dataset on first use)."""
+    uid = users + 1
+    with db.connect(db_path, readonly=False) as conn:
+        have = conn.execute("SELECT COUNT(*) FROM food_log WHERE user_id=?", (uid,)).fetchone()[0]
+        if have < DEEP_USER_ROWS:
+            start = datetime.now(timezone.utc) - timedelta(days=DAYS)
+            step = DAYS * 86400 / DEEP_USER_ROWS
+            conn.executemany(
+                "INSERT INTO food_log(user_id, product_ref_type, product_ref_id, grams, meal, eaten_at) VALUES(?, 'global', 1, 100, 'lunch', ?)",
+                ((uid, _ts(start, int(i * step))) for i in range(have, DEEP_USER_ROWS)),
+            )
+            conn.commit()
+    return uid
+
+
+def diary_cursor(db_path: str, user_id: int, offset: int, newest_first: bool) -> tuple[str, int]:
+    order = "DESC" if newest_first else "ASC"
+    with db.connect(db_path) as conn:
+        row = conn.execute(
+            f"SELECT eaten_at, id FROM food_log WHERE user_id=? ORDER BY eaten_at {order}, id {order} LIMIT 1 OFFSET ?",
+            (user_id, offset),
+        ).fetchone()
+    return row[0], row[1]
+
+
+def timeit(fn: Callable[[], object], iterations: int, warmup: int = 3) -> dict[str, float]:
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    samples.sort()
+    n = len(samples)
+    return {
+        "iterations": n,
+        "median_ms": samples[n // 2] * 1000,
+        "p95_ms": samples[min(n - 1, int(n * 0.95))] * 1000,
+        "mean_ms": sum(samples) / n * 1000,
+        "min_ms": samples[0] * 1000,
+        "ops_per_s": n / sum(samples) if sum(samples) else 0.0,
+    }
+
+
+def benchmarks(db_path: str, sizes, rnd: random.Random) -> dict[str, Callable[[], object]]:
+    users, _, products, _, _ = sizes
+    today = datetime.now(timezone.utc)
+
+    def user() -> int:
+        return rnd.randint(1, users)
+
+    def day() -> str:
+        return (today - timedelta(days=rnd.randrange(DAYS))).strftime("%Y-%m-%d")
+
+    def recent_cold():
+        db._recent_cache.clear()
+        return db.get_recent_products(db_path, user(), 10)
+
+    fixed_user = user()
+    db.get_recent_products(db_path, fixed_user, 10)
+
+    deep = deep_user(db_path, users)
+    start, end = (today - timedelta(days=DAYS + 1)).strftime(db.ISO), (today + timedelta(days=1)).strftime(db.ISO)
+    pages = {}
+    for newest_first in (True, False):
+        suffix = "" if newest_first else "_asc"
+        for depth, offset in (("first", 10), ("deep", DEEP_USER_ROWS - 20)):
+            cur = diary_cursor(db_path, deep, offset, newest_first)
+            pages[f"diary_page_{depth}{suffix}"] = (
+                lambda cur=cur, nf=newest_first: db.diary_page(db_path, deep, start, end, cur, 10, newest_first=nf)
+            )
+
+    def find_by_names():
+        name_ru, name_en = _product_name(rnd, rnd.randrange(products))
+        return db.find_global_product_by_names(db_path, name_ru, name_en)
+
+    return {
+        "search_products": lambda: db.search_products(db_path, user(), rnd.choice(WORDS + WORDS_EN)[:4], 10),
+        "search_products_miss": lambda: db.search_products(db_path, user(), "zzqx", 10),
+        "sum_day": lambda: db.sum_day(db_path, user(), day()),
+        "sum_range_30d": lambda: db.sum_range(db_path, user(), (today - timedelta(days=29)).strftime(db.ISO), today.strftime(db.ISO)),
+        "get_recent_products": recent_cold,
+        "get_recent_products_cached": lambda: db.get_recent_products(db_path, fixed_user, 10),
+        "find_global_product_by_names": find_by_names,
+        "analytics_snapshot": lambda: db.analytics_snapshot(db_path),
+        "upsert_user": lambda: db.upsert_user(db_path, user(), "bench", False),
+        **pages,
+    }
+
+
+def check_deep_pages(results: dict) -> list[str]:
+    """Keyset pagination: the page DEEP_USER_ROWS deep may not cost much more than the first."""
+    failed = []
+    for suffix in ("", "_asc"):
+        first, deep = results.get(f"diary_page_first{suffix}"), results.get(f"diary_page_deep{suffix}")
+        if not first or not deep:
+            continue
+        ratio = deep["median_ms"] / first["median_ms"] if first["median_ms"] else 1.0
+        if ratio > DEEP_PAGE_SLACK:
+            failed.append(f"diary_page_deep{suffix} is {ratio:.1f}x the first page ({deep['median_ms']:.3f} vs {first['median_ms']:.3f} ms)")
+    return failed
+
+
+# slow full-scan functions get fewer iterations
+ITERATIONS = {"analytics_snapshot": 5, "find_global_product_by_names": 10, "search_products_miss": 10}
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list[str]:
+    regressions = []
+    for name, res in current["results"].items():
+        base = baseline.get("results", {}).get(name)
+        if not base:
+            continue
+        ratio = res["median_ms"] / base["median_ms"] if base["median_ms"] else 1.0
+        mark = ""
+        if ratio > 1 + threshold:
+            mark = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<30}{base['median_ms']:>10.3f}{res['median_ms']:>10.3f}{ratio:>8.2f}x{mark}")
+    return regressions
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--scale", choices=SCALES, default="small")
+    ap.add_argument("--db", default="bench.sqlite3", help="benchmark database (generated if missing or a different scale)")
+    ap.add_argument("--regenerate", action="store_true")
+    ap.add_argument("--iterations", type=int, default=50)
+    ap.add_argument("--only", action="append", help="run only these benchmarks")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--out", help="write results as JSON")
+    ap.add_argument("--compare", help="baseline JSON from an earlier run")
+    ap.add_argument("--threshold", type=float, default=0.2, help="allowed median slowdown vs baseline (0.2 = 20%%)")
+    args = ap.parse_args()
+
+    sizes = SCALES[args.scale]
+    if args.regenerate or existing_sizes(args.db) != [*sizes, args.seed]:
+        print(f"generating {args.scale} dataset in {args.db} ...", file=sys.stderr)
+        t0 = time.perf_counter()
+        generate(args.db, sizes, args.seed)
+        print(f"generated in {time.perf_counter() - t0:.1f}s", file=sys.stderr)
+    db.init_db(args.db)  # apply migrations/indexes of the current code to a reused dataset
+
+    rnd = random.Random(args.seed)
+    results = {}
+    for name, fn in benchmarks(args.db, sizes, rnd).items():
+        if args.only and name not in args.only:
+            continue
+        results[name] = timeit(fn, ITERATIONS.get(name, args.iterations))
+        r = results[name]
+        print(f"{name:<30} median {r['median_ms']:9.3f} ms   p95 {r['p95_ms']:9.3f} ms   {r['ops_per_s']:10.1f} ops/s")
+
+    report = {
+        "scale": args.scale,
+        "sizes": dict(zip(("users", "food_log", "products_global", "products_user", "events"), sizes)),
+        "created_at": db.utcnow(),
+        "python": platform.python_version(),
+        "sqlite": db.sqlite3.sqlite_version,
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    deep_failures = check_deep_pages(results)
+    for msg in deep_failures:
+        print(f"FAILED: {msg}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"\n{'benchmark':<30}{'base ms':>10}{'now ms':>10}{'ratio':>9}")
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+    if deep_failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
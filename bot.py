@@ -1,27 +1,53 @@
 from __future__ import annotations
 
+import time
+
+_IMPORT_T0 = time.perf_counter()
+
+import functools
+import html
+import logging
 import os
 import re
-from datetime import datetime, timezone
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
 from typing import Any, Dict
 
-import requests
 import telebot
-from telebot import types
+from telebot import apihelper, types
 from dotenv import load_dotenv
 
-from config import load_config
-from texts import t
+from config import ALLOWED_UPDATES, Config, load_config
+from texts import DEFAULT_LANG, TEXTS, t, tf
+import backup
 import database as db
-
-load_dotenv()
-cfg = load_config()
-
-db.init_db(cfg.db_path)
-
-bot = telebot.TeleBot(cfg.bot_token, parse_mode="HTML")
+import keyboards
+import metrics
+import nutrition
+import popstats
+import ratelimit
+import slowlog
+from keyboards import back_kb, main_menu_kb, more_menu_kb, quick_grams_kb
+from broadcast import BroadcastScheduler, check_html, parse_broadcast_text
+from search_index import ProductIndex
+from sender import OutboundSender
+
+logger = logging.getLogger("kbju.bot")
+
+# Filled in by create_app(); the handlers below read them as module globals.
+cfg: Config = None  # type: ignore[assignment]
+bot: telebot.TeleBot = None  # type: ignore[assignment]
+sender: OutboundSender = None  # type: ignore[assignment]
+scheduler: BroadcastScheduler = None  # type: ignore[assignment]
+product_index: ProductIndex = None  # type: ignore[assignment]
+stats_job: popstats.PopulationStatsJob = None  # type: ignore[assignment]
+backups: backup.BackupScheduler = None  # type: ignore[assignment]
+ingress: ratelimit.IngressLimiter = None  # type: ignore[assignment]
 
 STATE: Dict[int, Dict[str, Any]] = {}
+# user_id -> food_log row as it was before the user's last diary edit/delete
+UNDO: Dict[int, Dict[str, Any]] = {}
 
 
 def now_utc():
@@ -42,28 +68,9 @@ def user_lang(user_id: int) -> str:
     return (row["lang"] if row and row["lang"] else "ru")
 
 
-def main_menu_kb(lang: str):
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.row(t("btn_add_food", lang), t("btn_diary", lang))
-    kb.row(t("btn_summary", lang), t("btn_more", lang))
-    return kb
-
-
-def more_menu_kb(lang: str, show_admin: bool):
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.row(t("btn_my_products", lang), t("btn_search", lang))
-    kb.row(t("btn_goals", lang), t("btn_settings", lang))
-    kb.row(t("btn_feedback", lang))
-    if show_admin:
-        kb.row(t("btn_admin", lang))
-    kb.row(t("btn_back", lang))
-    return kb
-
-
-def back_kb(lang: str):
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.row(t("btn_back", lang))
-    return kb
+def send(chat_id: int, text: str, **kwargs):
+    # all outgoing messages go through the rate-limited queue
+    return sender.send_message(chat_id, text, **kwargs)
 
 
 def log(user_id: int, event: str, meta: dict | None = None):
@@ -89,36 +96,32 @@ def get_state(user_id: int) -> dict:
     return STATE.get(user_id, {})
 
 
-@bot.message_handler(commands=["start"])
 def start(message):
     ensure_user(message)
     user_id = message.from_user.id
 
     row = db.get_user(cfg.db_path, user_id)
     if row and row["created_at"] and row["created_at"] == row["last_seen_at"]:
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton(t("lang_ru", "ru"), callback_data="setlang:ru"))
-        kb.add(types.InlineKeyboardButton(t("lang_en", "ru"), callback_data="setlang:en"))
-        bot.send_message(user_id, t("choose_lang", "ru"), reply_markup=kb)
+        send(user_id, t("choose_lang", "ru"), reply_markup=keyboards.lang_picker_kb("ru"))
         log(user_id, "start_first")
         return
 
     lang = user_lang(user_id)
-    bot.send_message(user_id, t("main_title", lang), reply_markup=main_menu_kb(lang))
+    send(user_id, t("main_title", lang), reply_markup=main_menu_kb(lang))
     log(user_id, "start")
 
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("setlang:"))
 def cb_setlang(call):
     user_id = call.from_user.id
     lang = call.data.split(":", 1)[1]
+    if lang not in TEXTS:
+        lang = DEFAULT_LANG
     db.set_user_lang(cfg.db_path, user_id, lang)
     bot.answer_callback_query(call.id, "OK")
-    bot.send_message(user_id, t("main_title", lang), reply_markup=main_menu_kb(lang))
+    send(user_id, t("main_title", lang), reply_markup=main_menu_kb(lang))
     log(user_id, "set_lang", {"lang": lang})
 
 
-@bot.message_handler(func=lambda m: True, content_types=["text"])
 def router(message):
     ensure_user(message)
     user_id = message.from_user.id
@@ -127,7 +130,7 @@ def router(message):
 
     if text == t("btn_back", lang):
         clear_state(user_id)
-        bot.send_message(user_id, t("main_title", lang), reply_markup=main_menu_kb(lang))
+        send(user_id, t("main_title", lang), reply_markup=main_menu_kb(lang))
         log(user_id, "back_to_main")
         return
 
@@ -141,6 +144,9 @@ def router(message):
     if st.get("step") == "search_query":
         handle_search_query(message, lang)
         return
+    if st.get("step") == "pick_meal":
+        handle_meal_choice(message, lang)
+        return
     if st.get("step") == "enter_grams":
         handle_enter_grams(message, lang)
         return
@@ -150,6 +156,30 @@ def router(message):
     if st.get("step") == "barcode":
         handle_barcode(message, lang)
         return
+    if st.get("step") == "admin_broadcast_text":
+        handle_admin_broadcast(message, lang)
+        return
+    if st.get("step") == "summary" and handle_summary_period(message, lang):
+        return
+    if st.get("step") == "profile_input":
+        handle_profile_input(message, lang)
+        return
+    if st.get("step") == "goals" and handle_goals_button(message, lang):
+        return
+    if st.get("step") == "diary_grams":
+        handle_diary_grams(message, lang)
+        return
+    if st.get("step") == "diary" and handle_diary_button(message, lang):
+        return
+    if st.get("step") == "recipe_name":
+        handle_recipe_name(message, lang)
+        return
+    if st.get("step") == "recipe_items":
+        handle_recipe_items(message, lang)
+        return
+    if st.get("step") == "recipe_yield":
+        handle_recipe_yield(message, lang)
+        return
 
     if text == t("btn_add_food", lang):
         show_add_food_menu(user_id, lang)
@@ -183,7 +213,12 @@ def router(message):
         if is_admin_user(message):
             show_admin(user_id, lang)
         else:
-            bot.send_message(user_id, "⛔", reply_markup=main_menu_kb(lang))
+            send(user_id, "⛔", reply_markup=main_menu_kb(lang))
+        return
+
+    if text in ADMIN_BUTTONS:
+        if is_admin_user(message):
+            ADMIN_BUTTONS[text](message)
         return
 
     if text == t("btn_find_product", lang):
@@ -195,87 +230,361 @@ def router(message):
     if text == t("btn_add_new_product", lang):
         start_add_new_product(user_id, lang)
         return
+    if text == t("btn_new_recipe", lang):
+        start_new_recipe(user_id, lang)
+        return
+
+    # a "name grams" list logs food from the main/add-food menu (no step); on other
+    # screens (diary, goals, summary) stray text is a list only if clearly shaped as one
+    if (not st.get("step") or is_food_list(text)) and handle_batch_log(message, lang):
+        return
 
-    bot.send_message(user_id, t("main_title", lang), reply_markup=main_menu_kb(lang))
+    send(user_id, t("main_title", lang), reply_markup=main_menu_kb(lang))
 
 
 def show_more(user_id: int, lang: str):
     row = db.get_user(cfg.db_path, user_id)
-    show_admin = bool(row and row.get("is_admin", 0) == 1)
-    bot.send_message(user_id, t("more_title", lang), reply_markup=more_menu_kb(lang, show_admin))
+    show_admin = bool(row and row["is_admin"] == 1)
+    send(user_id, t("more_title", lang), reply_markup=more_menu_kb(lang, show_admin))
     log(user_id, "open_more")
 
 
 def show_add_food_menu(user_id: int, lang: str):
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.row(t("btn_find_product", lang), t("btn_recent", lang))
-    kb.row(t("btn_my_products", lang), t("btn_add_new_product", lang))
-    kb.row(t("btn_back", lang))
-    bot.send_message(user_id, t("add_food_title", lang), reply_markup=kb)
+    send(user_id, t("add_food_title", lang), reply_markup=keyboards.add_food_kb(lang))
     log(user_id, "open_add_food")
 
 
 def show_diary(user_id: int, lang: str):
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.row(t("today", lang), t("list_view", lang))
-    kb.row(t("btn_back", lang))
-    bot.send_message(
+    set_state(user_id, step="diary")
+    send(
         user_id,
-        t("diary_title", lang) + "\n\n📄 PDF пока временно отключен (вернём позже).",
-        reply_markup=kb
+        t("diary_title", lang) + "\n\n" + t("pdf_disabled", lang),
+        reply_markup=keyboards.diary_kb(lang)
     )
     log(user_id, "open_diary")
 
 
+DIARY_PAGE = 10
+MEALS = ("breakfast", "lunch", "dinner", "snack")
+MEAL_ICONS = {"breakfast": "🍳", "lunch": "🍲", "dinner": "🍽", "snack": "🍏"}
+# day page, list page, entry card, edit grams, set meal, delete, undo
+DIARY_CALLBACKS = ("dd", "dl", "de", "dg", "dm", "dx", "du")
+
+
+def handle_diary_button(message, lang: str) -> bool:
+    user_id = message.from_user.id
+    if message.text == t("today", lang):
+        text, kb = diary_day_view(user_id, lang, now_utc().date().isoformat())
+        view = "day"
+    elif message.text == t("list_view", lang):
+        text, kb = diary_list_view(user_id, lang)
+        view = "list"
+    else:
+        return False
+    set_state(user_id, step="diary")
+    send(user_id, text, reply_markup=kb)
+    log(user_id, "diary_view", {"view": view})
+    return True
+
+
+def _cursor_data(cursor: tuple[str, int]) -> str:
+    # callback_data is limited to 64 bytes: eaten_at goes as unix time
+    return f"{int(datetime.strptime(cursor[0], db.ISO).timestamp())}:{cursor[1]}"
+
+
+def _parse_cursor(ts: str, entry_id: str) -> tuple[str, int]:
+    return datetime.fromtimestamp(int(ts), timezone.utc).strftime(db.ISO), int(entry_id)
+
+
+def entry_line(e: dict, with_day: bool = False) -> str:
+    name = html.escape(e["name_ru"] or e["name_en"] or "—")
+    kcal = (e["kcal"] or 0) * (e["grams"] or 0) / 100
+    when = e["eaten_at"][11:16]
+    if with_day:
+        when = f"{e['eaten_at'][:10]} {when}"
+    return f"{when} {MEAL_ICONS.get(e['meal'], '•')} {name} · {e['grams']:.0f} g · {kcal:.0f} kcal"
+
+
+def _entries_kb(entries: list[dict]) -> types.InlineKeyboardMarkup:
+    kb = types.InlineKeyboardMarkup()
+    for e in entries:
+        title = (e["name_ru"] or e["name_en"] or "—")[:32]
+        kb.add(types.InlineKeyboardButton(f"✏️ {e['eaten_at'][11:16]} {title}", callback_data=f"de:{e['id']}"))
+    return kb
+
+
+def diary_day_view(user_id: int, lang: str, day: str, cursor: tuple[str, int] | None = None):
+    """One page of a UTC day (like db.sum_day), oldest first, with day totals and day/page navigation."""
+    d = date.fromisoformat(day)
+    entries, nxt = db.diary_page(cfg.db_path, user_id, day, (d + timedelta(days=1)).isoformat(), cursor, limit=DIARY_PAGE)
+    lines = [tf("diary_day", lang, day=day), ""]
+    lines += [entry_line(e) for e in entries] or ["—"]
+    lines += ["", tf("diary_total", lang, **db.sum_day(cfg.db_path, user_id, day))]
+
+    kb = _entries_kb(entries)
+    nav = [types.InlineKeyboardButton("◀️", callback_data=f"dd:{d - timedelta(days=1)}")]
+    if nxt:
+        nav.append(types.InlineKeyboardButton(t("btn_more_entries", lang), callback_data=f"dd:{day}:{_cursor_data(nxt)}"))
+    nav.append(types.InlineKeyboardButton("▶️", callback_data=f"dd:{d + timedelta(days=1)}"))
+    kb.row(*nav)
+    return "\n".join(lines), kb
+
+
+def diary_list_view(user_id: int, lang: str, cursor: tuple[str, int] | None = None):
+    """The whole diary, newest first, DIARY_PAGE entries per page."""
+    entries, nxt = db.diary_page(cfg.db_path, user_id, "", "9999", cursor, limit=DIARY_PAGE, newest_first=True)
+    lines = [t("diary_list", lang), ""]
+    lines += [entry_line(e, with_day=True) for e in entries] or ["—"]
+    kb = _entries_kb(entries)
+    if nxt:
+        kb.add(types.InlineKeyboardButton(t("btn_more_entries", lang), callback_data=f"dl:{_cursor_data(nxt)}"))
+    return "\n".join(lines), kb
+
+
+def cb_diary(call):
+    user_id = call.from_user.id
+    lang = user_lang(user_id)
+    action, *args = call.data.split(":")
+
+    if action in ("dd", "dl"):
+        if action == "dd":
+            text, kb = diary_day_view(user_id, lang, args[0], _parse_cursor(*args[1:]) if len(args) == 3 else None)
+        else:
+            text, kb = diary_list_view(user_id, lang, _parse_cursor(*args))
+        bot.answer_callback_query(call.id)
+        # turn the page in place instead of sending a message per page
+        sender.submit(user_id, "edit_message_text", text, user_id, call.message.message_id, reply_markup=kb)
+        return
+
+    entry_id = int(args[0])
+    if action == "du":
+        undo_diary_change(call, lang, entry_id)
+        return
+
+    e = db.get_food_log_entry(cfg.db_path, user_id, entry_id)
+    if not e:
+        bot.answer_callback_query(call.id, t("entry_not_found", lang))
+        return
+    bot.answer_callback_query(call.id)
+
+    if action == "de":
+        kb = types.InlineKeyboardMarkup()
+        kb.row(
+            types.InlineKeyboardButton(t("btn_edit_grams", lang), callback_data=f"dg:{entry_id}"),
+            types.InlineKeyboardButton(t("btn_delete", lang), callback_data=f"dx:{entry_id}"),
+        )
+        kb.row(*[
+            types.InlineKeyboardButton(t(f"meal_{m}", lang), callback_data=f"dm:{entry_id}:{m}")
+            for m in MEALS if m != e["meal"]
+        ])
+        caption = f"\n{product_caption(e)}" if e["kcal"] is not None else ""
+        send(user_id, entry_line(e, with_day=True) + caption, reply_markup=kb)
+    elif action == "dg":
+        set_state(user_id, step="diary_grams", entry_id=entry_id)
+        send(user_id, t("enter_grams", lang))
+    elif action == "dm" and len(args) == 2 and args[1] in MEALS:
+        old = db.update_food_log(cfg.db_path, user_id, entry_id, meal=args[1])
+        diary_changed(user_id, lang, "entry_updated", old, db.get_food_log_entry(cfg.db_path, user_id, entry_id))
+    elif action == "dx":
+        old = db.delete_food_log(cfg.db_path, user_id, entry_id)
+        diary_changed(user_id, lang, "entry_deleted", old, e)
+
+
+def handle_diary_grams(message, lang: str):
+    user_id = message.from_user.id
+    try:
+        grams = float((message.text or "").strip().replace(",", "."))
+    except ValueError:
+        grams = 0.0
+    if grams <= 0:
+        if not handle_diary_button(message, lang):
+            send(user_id, t("bad_format", lang))
+        return
+    entry_id = get_state(user_id).get("entry_id")
+    set_state(user_id, step="diary", entry_id=None)
+    old = db.update_food_log(cfg.db_path, user_id, int(entry_id), grams=grams)
+    diary_changed(user_id, lang, "entry_updated", old, db.get_food_log_entry(cfg.db_path, user_id, int(entry_id)))
+
+
+def diary_changed(user_id: int, lang: str, key: str, old: dict | None, entry: dict | None):
+    if old is None or entry is None:
+        send(user_id, t("entry_not_found", lang))
+        return
+    UNDO[user_id] = old
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton(t("btn_undo", lang), callback_data=f"du:{old['id']}"))
+    send(user_id, tf(key, lang, entry=entry_line(entry, with_day=True)), reply_markup=kb)
+    log(user_id, "diary_delete" if key == "entry_deleted" else "diary_edit", {"id": old["id"]})
+
+
+def undo_diary_change(call, lang: str, entry_id: int):
+    user_id = call.from_user.id
+    old = UNDO.get(user_id)
+    if not old or old["id"] != entry_id:
+        bot.answer_callback_query(call.id, t("nothing_to_undo", lang))
+        return
+    del UNDO[user_id]
+    bot.answer_callback_query(call.id)
+    if not db.restore_food_log(cfg.db_path, old):
+        send(user_id, t("entry_not_found", lang))
+        return
+    e = db.get_food_log_entry(cfg.db_path, user_id, entry_id)
+    send(user_id, tf("entry_restored", lang, entry=entry_line(e, with_day=True)))
+    log(user_id, "diary_undo", {"id": entry_id})
+
+
 def show_summary(user_id: int, lang: str):
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.row(t("sum_today", lang), t("sum_week", lang))
-    kb.row(t("sum_month", lang), t("remaining", lang))
-    kb.row(t("btn_back", lang))
-    bot.send_message(user_id, t("summary_title", lang), reply_markup=kb)
+    set_state(user_id, step="summary")
+    send(user_id, t("summary_title", lang), reply_markup=keyboards.summary_kb(lang))
     log(user_id, "open_summary")
 
 
+SUMMARY_DAYS = {"sum_today": 1, "sum_week": 7, "sum_month": 30}
+
+
+def handle_summary_period(message, lang: str) -> bool:
+    user_id = message.from_user.id
+    if message.text == t("remaining", lang):
+        show_remaining(user_id, lang)
+        return True
+    key = next((k for k in SUMMARY_DAYS if t(k, lang) == message.text), None)
+    if key is None:
+        return False
+    # UTC days, like db.sum_day
+    now = now_utc()
+    if SUMMARY_DAYS[key] == 1:
+        total = db.day_totals(cfg.db_path, user_id, now.date().isoformat())
+    else:
+        start = (now - timedelta(days=SUMMARY_DAYS[key] - 1)).strftime("%Y-%m-%dT00:00:00+0000")
+        total = db.sum_range(cfg.db_path, user_id, start, now.strftime(db.ISO))
+    send(user_id, tf("summary_totals", lang, period=t(key, lang), **total), reply_markup=keyboards.summary_kb(lang))
+    log(user_id, "summary", {"days": SUMMARY_DAYS[key]})
+    return True
+
+
 def show_my_products(user_id: int, lang: str):
     with db.connect(cfg.db_path) as conn:
         rows = conn.execute(
-            "SELECT id, name_ru, name_en FROM products_user WHERE user_id=? ORDER BY created_at DESC LIMIT 10",
+            "SELECT id, name_ru, name_en, is_recipe FROM products_user WHERE user_id=? ORDER BY created_at DESC LIMIT 10",
             (user_id,),
         ).fetchall()
     lines = [t("my_products_title", lang)]
+    kb = types.InlineKeyboardMarkup()
     if not rows:
         lines.append("—")
     else:
         for r in rows:
-            lines.append(f"• {r['name_ru']} / {r['name_en']}")
+            lines.append(f"{'🍲' if r['is_recipe'] else '•'} {html.escape(r['name_ru'])} / {html.escape(r['name_en'])}")
+            if r["is_recipe"]:
+                kb.add(types.InlineKeyboardButton(f"🍲 {r['name_ru'] or r['name_en']}"[:48], callback_data=f"rc:{r['id']}"))
     lines.append("")
-    lines.append(t("btn_add_new_product", lang) + " — чтобы добавить")
-    bot.send_message(user_id, "\n".join(lines), reply_markup=back_kb(lang))
+    lines.append(tf("my_products_add_hint", lang, btn=t("btn_add_new_product", lang)))
+    send(user_id, "\n".join(lines), reply_markup=kb if kb.keyboard else back_kb(lang))
     log(user_id, "open_my_products")
 
 
 def show_goals(user_id: int, lang: str):
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.row(t("goal_cut", lang), t("goal_maint", lang), t("goal_bulk", lang))
-    kb.row(t("profile", lang), t("activity", lang))
-    kb.row(t("cal_norm", lang), t("macros", lang))
-    kb.row(t("btn_back", lang))
-    bot.send_message(user_id, t("goals_title", lang), reply_markup=kb)
+    set_state(user_id, step="goals")
+    prof = db.get_profile(cfg.db_path, user_id)
+    send(user_id, t("goals_title", lang) + "\n\n" + profile_text(prof, lang), reply_markup=keyboards.goals_kb(lang))
     log(user_id, "open_goals")
 
 
+GOAL_BUTTONS = {"goal_cut": "cut", "goal_maint": "maint", "goal_bulk": "bulk"}
+PROFILE_RE = re.compile(r"^\s*([mfмж])\w*[\s,;]+(\d+)[\s,;]+(\d+(?:[.,]\d+)?)[\s,;]+(\d+(?:[.,]\d+)?)\s*$", re.IGNORECASE)
+
+
+def has_targets(prof: dict | None) -> bool:
+    return bool(prof) and prof.get("kcal") is not None
+
+
+def profile_text(prof: dict | None, lang: str) -> str:
+    if not has_targets(prof):
+        return t("profile_empty", lang)
+    goal = next(k for k, g in GOAL_BUTTONS.items() if g == prof["goal"])
+    return "\n\n".join((
+        tf("profile_text", lang, sex=t(f"sex_{prof['sex']}", lang), age=prof["age"], weight=prof["weight"],
+           height=prof["height"], activity=t(f"act_{prof['activity']}", lang), goal=t(goal, lang)),
+        tf("targets_text", lang, **{k: prof[k] for k in ("kcal", "p", "f", "c")}),
+    ))
+
+
+def handle_goals_button(message, lang: str) -> bool:
+    user_id = message.from_user.id
+    text = message.text
+    goal = next((g for k, g in GOAL_BUTTONS.items() if t(k, lang) == text), None)
+    if goal:
+        prof = db.save_profile(cfg.db_path, user_id, goal=goal)
+        send(user_id, profile_text(prof, lang), reply_markup=keyboards.goals_kb(lang))
+        log(user_id, "goal_set", {"goal": goal})
+    elif text == t("profile", lang):
+        set_state(user_id, step="profile_input")
+        send(user_id, t("profile_prompt", lang), reply_markup=back_kb(lang))
+    elif text == t("activity", lang):
+        send(user_id, t("pick_activity", lang), reply_markup=keyboards.activity_picker_kb(lang))
+    elif text in (t("cal_norm", lang), t("macros", lang)):
+        prof = db.get_profile(cfg.db_path, user_id)
+        if not has_targets(prof):
+            send(user_id, t("profile_empty", lang), reply_markup=keyboards.goals_kb(lang))
+        elif text == t("cal_norm", lang):
+            bmr = nutrition.bmr(prof["sex"], prof["age"], prof["weight"], prof["height"])
+            send(user_id, tf("targets_text", lang, **prof) + "\n" + tf("bmr_text", lang, bmr=bmr), reply_markup=keyboards.goals_kb(lang))
+        else:
+            kcal = prof["kcal"] or 1
+            shares = {"p_share": prof["p"] * 4 / kcal, "f_share": prof["f"] * 9 / kcal, "c_share": prof["c"] * 4 / kcal}
+            send(user_id, tf("macros_text", lang, **prof, **shares), reply_markup=keyboards.goals_kb(lang))
+    else:
+        return False
+    return True
+
+
+def handle_profile_input(message, lang: str):
+    user_id = message.from_user.id
+    m = PROFILE_RE.match(message.text or "")
+    if m:
+        sex = "m" if m.group(1).lower() in ("m", "м") else "f"
+        age, weight, height = int(m.group(2)), float(m.group(3).replace(",", ".")), float(m.group(4).replace(",", "."))
+    if not m or not (10 <= age <= 100 and 30 <= weight <= 300 and 100 <= height <= 250):
+        send(user_id, t("bad_format", lang) + "\n\n" + t("profile_prompt", lang))
+        return
+    prof = db.save_profile(cfg.db_path, user_id, sex=sex, age=age, weight=weight, height=height)
+    set_state(user_id, step="goals")
+    send(user_id, profile_text(prof, lang), reply_markup=keyboards.goals_kb(lang))
+    log(user_id, "profile_saved")
+
+
+def cb_activity(call):
+    user_id = call.from_user.id
+    lang = user_lang(user_id)
+    activity = call.data.split(":", 1)[1]
+    if activity not in nutrition.ACTIVITY:
+        bot.answer_callback_query(call.id)
+        return
+    prof = db.save_profile(cfg.db_path, user_id, activity=activity)
+    bot.answer_callback_query(call.id, "OK")
+    send(user_id, profile_text(prof, lang), reply_markup=keyboards.goals_kb(lang))
+    log(user_id, "activity_set", {"activity": activity})
+
+
+def show_remaining(user_id: int, lang: str):
+    prof = db.get_profile(cfg.db_path, user_id)
+    if not has_targets(prof):
+        send(user_id, t("profile_empty", lang), reply_markup=keyboards.summary_kb(lang))
+        return
+    eaten = db.day_totals(cfg.db_path, user_id, now_utc().date().isoformat())
+    left = {k: prof[k] - eaten[k] for k in ("kcal", "p", "f", "c")}
+    send(user_id, tf("remaining_text", lang, **left, eaten=eaten["kcal"], target=prof["kcal"]), reply_markup=keyboards.summary_kb(lang))
+    log(user_id, "remaining")
+
+
 def show_settings(user_id: int, lang: str):
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.row(t("set_lang", lang), t("set_tz", lang))
-    kb.row(t("set_quick_grams", lang))
-    kb.row(t("btn_back", lang))
-    bot.send_message(user_id, t("settings_title", lang), reply_markup=kb)
+    send(user_id, t("settings_title", lang), reply_markup=keyboards.settings_kb(lang))
     log(user_id, "open_settings")
 
 
 def start_feedback(user_id: int, lang: str):
     set_state(user_id, step="feedback_text")
-    bot.send_message(user_id, t("feedback_prompt", lang), reply_markup=back_kb(lang))
+    send(user_id, t("feedback_prompt", lang), reply_markup=back_kb(lang))
     log(user_id, "feedback_start")
 
 
@@ -283,11 +592,11 @@ def handle_feedback(message, lang: str):
     user_id = message.from_user.id
     text = (message.text or "").strip()
     if not text:
-        bot.send_message(user_id, t("bad_format", lang))
+        send(user_id, t("bad_format", lang))
         return
     db.add_feedback(cfg.db_path, user_id, text, None)
     clear_state(user_id)
-    bot.send_message(user_id, t("thanks", lang), reply_markup=main_menu_kb(lang))
+    send(user_id, t("thanks", lang), reply_markup=main_menu_kb(lang))
     log(user_id, "feedback_sent")
 
 
@@ -295,12 +604,12 @@ def start_add_new_product(user_id: int, lang: str):
     limit = db.get_free_my_products_limit(cfg.db_path)
     has_sub = False  # подписки сейчас отключены
     if not has_sub and db.count_user_products(cfg.db_path, user_id) >= limit:
-        bot.send_message(user_id, t("limit_reached", lang).format(n=limit), reply_markup=main_menu_kb(lang))
+        send(user_id, tf("limit_reached", lang, n=limit), reply_markup=main_menu_kb(lang))
         log(user_id, "my_products_limit_hit", {"limit": limit})
         return
 
     set_state(user_id, step="add_product_kbju")
-    bot.send_message(user_id, t("send_kbju_per100", lang), reply_markup=back_kb(lang))
+    send(user_id, t("send_kbju_per100", lang), reply_markup=back_kb(lang))
     log(user_id, "add_product_start")
 
 
@@ -309,15 +618,15 @@ def handle_add_product_kbju(message, lang: str):
     raw = (message.text or "").strip().replace(",", ".")
     parts = re.split(r"\s+", raw)
     if len(parts) != 4:
-        bot.send_message(user_id, t("bad_format", lang))
+        send(user_id, t("bad_format", lang))
         return
     try:
         kcal, p, f, c_ = map(float, parts)
     except Exception:
-        bot.send_message(user_id, t("bad_format", lang))
+        send(user_id, t("bad_format", lang))
         return
     set_state(user_id, step="add_product_names", kbju=(kcal, p, f, c_))
-    bot.send_message(user_id, t("send_names", lang), reply_markup=back_kb(lang))
+    send(user_id, t("send_names", lang), reply_markup=back_kb(lang))
 
 
 def handle_add_product_names(message, lang: str):
@@ -326,7 +635,7 @@ def handle_add_product_names(message, lang: str):
     mru = re.search(r"^RU:\s*(.+)$", text, re.MULTILINE | re.IGNORECASE)
     men = re.search(r"^EN:\s*(.+)$", text, re.MULTILINE | re.IGNORECASE)
     if not mru or not men:
-        bot.send_message(user_id, t("bad_format", lang))
+        send(user_id, t("bad_format", lang))
         return
 
     name_ru = mru.group(1).strip()
@@ -335,19 +644,196 @@ def handle_add_product_names(message, lang: str):
     st = get_state(user_id)
     kcal, p, f, c_ = st.get("kbju", (0, 0, 0, 0))
 
-    user_pid = db.add_user_product(cfg.db_path, user_id, name_ru, name_en, kcal, p, f, c_)
-    existing = db.find_global_product_by_names(cfg.db_path, name_ru, name_en)
-    if existing is None:
-        db.add_global_product(cfg.db_path, user_id, name_ru, name_en, kcal, p, f, c_, source="manual")
+    db.create_product(cfg.db_path, user_id, name_ru, name_en, kcal, p, f, c_, source="manual", event_name="add_product_done")
 
     clear_state(user_id)
-    bot.send_message(user_id, f"✅ {name_ru} / {name_en}", reply_markup=main_menu_kb(lang))
-    log(user_id, "add_product_done", {"user_product_id": user_pid})
+    send(user_id, f"✅ {name_ru} / {name_en}", reply_markup=main_menu_kb(lang))
+
+
+RECIPE_CALLBACKS = ("rc", "ra", "ry", "rx")
+# "гречка 80", "chicken breast 150 g"
+ITEM_RE = re.compile(r"^\s*(.+?)\s+(\d+(?:[.,]\d+)?)\s*(g|г|гр)?\.?\s*$", re.IGNORECASE)
+# items go one per line or comma-separated; "1,5" stays a number
+ITEM_SEP_RE = re.compile(r"[\n;]|,(?!\d)")
+
+
+def parse_items(text: str) -> tuple[list[tuple[str, float]], list[str]]:
+    """"oatmeal 60, milk 200" -> ([("oatmeal", 60.0), ("milk", 200.0)], unparsed parts)."""
+    items, bad = [], []
+    for part in ITEM_SEP_RE.split(text or ""):
+        if not part.strip():
+            continue
+        m = ITEM_RE.match(part)
+        grams = float(m.group(2).replace(",", ".")) if m else 0.0
+        if grams > 0:
+            items.append((m.group(1).strip(), grams))
+        else:
+            bad.append(part.strip())
+    return items, bad
+
+
+def is_food_list(text: str) -> bool:
+    """
+    Whether a search query is meant as a food list: two or more "name grams"
+    items, or one with an explicit unit. "молоко 2,5" or "cola 0.5" are product
+    names and stay a search.
+    """
+    matches = [ITEM_RE.match(part) for part in ITEM_SEP_RE.split(text or "") if part.strip()]
+    items = [m for m in matches if m and float(m.group(2).replace(",", ".")) > 0]
+    return len(items) >= 2 or any(m.group(3) for m in items)
+
+
+def resolve_products(user_id: int, queries: list[str]) -> list[dict | None]:
+    """Best match for each name: from the in-memory index when it's warm, else all of them on one db connection."""
+    if product_index.ready:
+        product_index.refresh(cfg.db_path, user_id=user_id)
+        recent = {(r["ref_type"], r["ref_id"]) for r in db.get_recent_products(cfg.db_path, user_id, limit=db.RECENT_CACHE_DEPTH)}
+        found = [product_index.search(user_id, q, limit=1, prefer=recent) for q in queries]
+    else:
+        found = db.search_products_many(cfg.db_path, user_id, queries, limit=1)
+    return [r[0] if r else None for r in found]
+
+
+def start_new_recipe(user_id: int, lang: str):
+    # рецепт — тоже продукт пользователя, поэтому тот же лимит
+    limit = db.get_free_my_products_limit(cfg.db_path)
+    if db.count_user_products(cfg.db_path, user_id) >= limit:
+        send(user_id, tf("limit_reached", lang, n=limit), reply_markup=main_menu_kb(lang))
+        log(user_id, "my_products_limit_hit", {"limit": limit})
+        return
+    set_state(user_id, step="recipe_name")
+    send(user_id, t("recipe_name_prompt", lang), reply_markup=back_kb(lang))
+    log(user_id, "recipe_start")
+
+
+def handle_recipe_name(message, lang: str):
+    user_id = message.from_user.id
+    name = (message.text or "").strip()
+    if not name or len(name) > 100:
+        send(user_id, t("bad_format", lang))
+        return
+    set_state(user_id, step="recipe_items", recipe_name=name, recipe_id=None, items={})
+    send(user_id, tf("recipe_items_prompt", lang, btn=t("btn_done", lang)), reply_markup=keyboards.recipe_items_kb(lang))
+
+
+def handle_recipe_items(message, lang: str):
+    user_id = message.from_user.id
+    text = (message.text or "").strip()
+    st = get_state(user_id)
+    if text == t("btn_done", lang):
+        finish_recipe(user_id, lang, st)
+        return
+
+    items, bad = parse_items(text)
+    lines = [tf("recipe_item_not_found", lang, query=html.escape(b)) for b in bad]
+    for (query, grams), prod in zip(items, resolve_products(user_id, [q for q, _ in items])):
+        if prod is None:
+            lines.append(tf("recipe_item_not_found", lang, query=html.escape(query)))
+            continue
+        if st.get("recipe_id"):
+            try:
+                apply_recipe_changes(db.set_recipe_item(cfg.db_path, user_id, st["recipe_id"], prod["ref_type"], prod["id"], grams))
+            except ValueError:
+                lines.append(t("recipe_cycle", lang))
+                continue
+        else:
+            st["items"][(prod["ref_type"], prod["id"])] = grams
+        lines.append(tf("recipe_item_added", lang, name=html.escape(prod["name_ru"] or prod["name_en"] or "—"), grams=grams))
+    send(user_id, "\n".join(lines) or t("bad_format", lang))
+
+
+def finish_recipe(user_id: int, lang: str, st: dict):
+    recipe_id = st.get("recipe_id")
+    if not recipe_id:
+        if not st.get("items"):
+            send(user_id, t("recipe_empty", lang))
+            return
+        name = st["recipe_name"]
+        items = [(ref_type, ref_id, grams) for (ref_type, ref_id), grams in st["items"].items()]
+        recipe_id = db.create_recipe(cfg.db_path, user_id, name, name, items)
+        product_index.refresh(cfg.db_path, force=True)
+        log(user_id, "recipe_created", {"id": recipe_id, "items": len(items)})
+    clear_state(user_id)
+    send(user_id, "✅", reply_markup=main_menu_kb(lang))
+    show_recipe(user_id, lang, recipe_id)
+
+
+def apply_recipe_changes(changed: list[tuple]):
+    # macros of the edited recipe and of every recipe using it were recomputed in the db
+    for rid, kcal, p, f, c in changed:
+        product_index.update("user", rid, kcal, p, f, c)
+
+
+def show_recipe(user_id: int, lang: str, recipe_id: int):
+    r = db.get_recipe(cfg.db_path, user_id, recipe_id)
+    if r is None:
+        send(user_id, t("entry_not_found", lang))
+        return
+    lines = [tf("recipe_card", lang, name=html.escape(r["name_ru"] or r["name_en"] or "—"), **{k: r[k] for k in ("weight", "kcal", "p", "f", "c")})]
+    kb = types.InlineKeyboardMarkup()
+    for it in r["items"]:
+        name = it["name_ru"] or it["name_en"] or "—"
+        lines.append(f"• {html.escape(name)} — {it['grams']:g} g")
+        kb.add(types.InlineKeyboardButton(f"❌ {name}"[:48], callback_data=f"rx:{recipe_id}:{it['ref_type'][0]}:{it['ref_id']}"))
+    if not r["items"]:
+        lines.append(t("recipe_empty", lang))
+    kb.row(
+        types.InlineKeyboardButton(t("btn_add_ingredient", lang), callback_data=f"ra:{recipe_id}"),
+        types.InlineKeyboardButton(t("btn_recipe_yield", lang), callback_data=f"ry:{recipe_id}"),
+    )
+    kb.add(types.InlineKeyboardButton(t("btn_add_to_diary", lang), callback_data=f"pick:user:{recipe_id}:1"))
+    send(user_id, "\n".join(lines), reply_markup=kb)
+
+
+def cb_recipe(call):
+    user_id = call.from_user.id
+    lang = user_lang(user_id)
+    action, recipe_id, *args = call.data.split(":")
+    recipe_id = int(recipe_id)
+    bot.answer_callback_query(call.id)
+
+    if action == "rc":
+        show_recipe(user_id, lang, recipe_id)
+    elif action == "ra":
+        set_state(user_id, step="recipe_items", recipe_id=recipe_id)
+        send(user_id, tf("recipe_items_prompt", lang, btn=t("btn_done", lang)), reply_markup=keyboards.recipe_items_kb(lang))
+    elif action == "ry":
+        set_state(user_id, step="recipe_yield", recipe_id=recipe_id)
+        send(user_id, t("recipe_yield_prompt", lang), reply_markup=back_kb(lang))
+    elif action == "rx" and len(args) == 2:
+        ref_type = "global" if args[0] == "g" else "user"
+        try:
+            apply_recipe_changes(db.set_recipe_item(cfg.db_path, user_id, recipe_id, ref_type, int(args[1]), 0))
+        except ValueError:
+            send(user_id, t("entry_not_found", lang))
+            return
+        log(user_id, "recipe_item_removed", {"id": recipe_id})
+        show_recipe(user_id, lang, recipe_id)
+
+
+def handle_recipe_yield(message, lang: str):
+    user_id = message.from_user.id
+    try:
+        grams = float((message.text or "").strip().replace(",", "."))
+    except ValueError:
+        grams = -1.0
+    if grams < 0:
+        send(user_id, t("bad_format", lang))
+        return
+    recipe_id = get_state(user_id).get("recipe_id")
+    clear_state(user_id)
+    try:
+        apply_recipe_changes(db.set_recipe_yield(cfg.db_path, user_id, int(recipe_id), grams or None))
+    except ValueError:
+        send(user_id, t("entry_not_found", lang), reply_markup=main_menu_kb(lang))
+        return
+    send(user_id, "✅", reply_markup=main_menu_kb(lang))
+    show_recipe(user_id, lang, int(recipe_id))
 
 
 def start_search(user_id: int, lang: str, for_add: bool):
     set_state(user_id, step="search_query", for_add=for_add)
-    bot.send_message(user_id, t("enter_query", lang), reply_markup=back_kb(lang))
+    send(user_id, t("enter_query", lang), reply_markup=back_kb(lang))
     log(user_id, "search_start", {"for_add": for_add})
 
 
@@ -355,10 +841,12 @@ def handle_search_query(message, lang: str):
     user_id = message.from_user.id
     query = (message.text or "").strip()
     if not query:
-        bot.send_message(user_id, t("bad_format", lang))
+        send(user_id, t("bad_format", lang))
         return
 
     st = get_state(user_id)
+    if st.get("for_add") and is_food_list(query) and handle_batch_log(message, lang):
+        return
     results = db.search_products(cfg.db_path, user_id, query, limit=10)
 
     if not results and cfg.off_enabled and query.isdigit():
@@ -367,7 +855,7 @@ def handle_search_query(message, lang: str):
         return
 
     if not results:
-        bot.send_message(user_id, t("no_results", lang), reply_markup=back_kb(lang))
+        send(user_id, t("no_results", lang), reply_markup=back_kb(lang))
         return
 
     kb = types.InlineKeyboardMarkup()
@@ -377,11 +865,45 @@ def handle_search_query(message, lang: str):
             f"{title} ({r['ref_type']})",
             callback_data=f"pick:{r['ref_type']}:{r['id']}:{'1' if st.get('for_add') else '0'}"
         ))
-    bot.send_message(user_id, t("choose_product", lang), reply_markup=kb)
+    send(user_id, t("choose_product", lang), reply_markup=kb)
     log(user_id, "search_results", {"n": len(results)})
 
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("pick:"))
+def product_caption(prod: dict) -> str:
+    return f"100g: {prod['kcal']:.0f} kcal | P {prod['p']:.1f} F {prod['f']:.1f} C {prod['c']:.1f}"
+
+
+def inline_search(query):
+    user_id = query.from_user.id
+    lang = user_lang(user_id)
+    text = (query.query or "").strip()
+
+    recent = db.get_recent_products(cfg.db_path, user_id, limit=20)
+    if not text:
+        results = recent
+    elif product_index.ready:
+        product_index.refresh(cfg.db_path, user_id=user_id)
+        results = product_index.search(user_id, text, limit=20, prefer={(r["ref_type"], r["ref_id"]) for r in recent})
+    else:
+        # index still warming up
+        results = db.search_products(cfg.db_path, user_id, text, limit=20)
+
+    articles = []
+    for r in results:
+        title = r["name_ru"] or r["name_en"] or "—"
+        kb = types.InlineKeyboardMarkup()
+        kb.add(types.InlineKeyboardButton(t("btn_add_to_diary", lang), callback_data=f"pick:{r['ref_type']}:{r['id']}:1"))
+        articles.append(types.InlineQueryResultArticle(
+            id=f"{r['ref_type']}:{r['id']}",
+            title=title,
+            description=product_caption(r),
+            input_message_content=types.InputTextMessageContent(html.escape(f"{title}\n{product_caption(r)}"), parse_mode="HTML"),
+            reply_markup=kb,
+        ))
+    bot.answer_inline_query(query.id, articles, cache_time=5, is_personal=True)
+    log(user_id, "inline_search", {"n": len(articles), "indexed": product_index.ready})
+
+
 def cb_pick_product(call):
     user_id = call.from_user.id
     lang = user_lang(user_id)
@@ -395,12 +917,7 @@ def cb_pick_product(call):
 
     if not for_add:
         bot.answer_callback_query(call.id, "OK")
-        bot.send_message(
-            user_id,
-            f"{prod['name_ru']} / {prod['name_en']}\n"
-            f"100g: {prod['kcal']:.0f} kcal | P {prod['p']:.1f} F {prod['f']:.1f} C {prod['c']:.1f}",
-            reply_markup=main_menu_kb(lang),
-        )
+        send(user_id, f"{prod['name_ru']} / {prod['name_en']}\n{product_caption(prod)}", reply_markup=main_menu_kb(lang))
         log(user_id, "product_view", {"ref_type": ref_type, "ref_id": ref_id})
         return
 
@@ -410,22 +927,12 @@ def cb_pick_product(call):
 
 
 def show_meal_picker(user_id: int, lang: str):
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.row(t("meal_breakfast", lang), t("meal_lunch", lang))
-    kb.row(t("meal_dinner", lang), t("meal_snack", lang))
-    kb.row(t("btn_back", lang))
-    bot.send_message(user_id, t("pick_meal", lang), reply_markup=kb)
+    send(user_id, t("pick_meal", lang), reply_markup=keyboards.meal_picker_kb(lang))
     log(user_id, "pick_meal")
 
 
-@bot.message_handler(func=lambda m: True, content_types=["text"])
-def handle_meal_choice(message):
-    ensure_user(message)
+def handle_meal_choice(message, lang: str):
     user_id = message.from_user.id
-    lang = user_lang(user_id)
-    st = get_state(user_id)
-    if st.get("step") != "pick_meal":
-        return
 
     meal_map = {
         t("meal_breakfast", lang): "breakfast",
@@ -435,20 +942,14 @@ def handle_meal_choice(message):
     }
     meal = meal_map.get(message.text)
     if not meal:
+        send(user_id, t("pick_meal", lang), reply_markup=keyboards.meal_picker_kb(lang))
         return
 
     set_state(user_id, step="enter_grams", remind_meal=meal)
-    bot.send_message(user_id, t("grams_hint", lang) + "\n\n" + t("enter_grams", lang), reply_markup=quick_grams_kb(lang))
+    send(user_id, t("grams_hint", lang) + "\n\n" + t("enter_grams", lang), reply_markup=quick_grams_kb(lang))
     log(user_id, "meal_chosen", {"meal": meal})
 
 
-def quick_grams_kb(lang: str):
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.row("➕ +50 г", "➕ +100 г", "➕ +200 г")
-    kb.row(t("btn_back", lang))
-    return kb
-
-
 def handle_enter_grams(message, lang: str):
     user_id = message.from_user.id
     st = get_state(user_id)
@@ -466,13 +967,13 @@ def handle_enter_grams(message, lang: str):
         current = float(st.get("grams", 0))
         new = current + add
         set_state(user_id, grams=new)
-        bot.send_message(user_id, f"{t('enter_grams', lang)}\n✅ {new:.0f} g", reply_markup=quick_grams_kb(lang))
+        send(user_id, f"{t('enter_grams', lang)}\n✅ {new:.0f} g", reply_markup=quick_grams_kb(lang))
         return
 
     try:
         grams = float(text.replace(",", "."))
     except Exception:
-        bot.send_message(user_id, t("bad_format", lang))
+        send(user_id, t("bad_format", lang))
         return
 
     set_state(user_id, grams=grams)
@@ -483,32 +984,79 @@ def handle_enter_grams(message, lang: str):
 
     if not ref_type or not ref_id or not meal:
         clear_state(user_id)
-        bot.send_message(user_id, t("main_title", lang), reply_markup=main_menu_kb(lang))
+        send(user_id, t("main_title", lang), reply_markup=main_menu_kb(lang))
         return
 
     db.add_food_log(cfg.db_path, user_id, ref_type, int(ref_id), grams_val, meal)
     clear_state(user_id)
-    bot.send_message(user_id, t("added_ok", lang), reply_markup=main_menu_kb(lang))
+    send(user_id, t("added_ok", lang), reply_markup=main_menu_kb(lang))
     log(user_id, "add_food_done", {"ref_type": ref_type, "ref_id": ref_id, "grams": grams_val, "meal": meal})
 
 
+def handle_batch_log(message, lang: str) -> bool:
+    """"oatmeal 60, milk 200, banana 120": resolve every name at once and confirm them with one keyboard."""
+    user_id = message.from_user.id
+    items, bad = parse_items(message.text)
+    if not items:
+        return False
+    batch, lines, kcal = [], [t("batch_confirm", lang)], 0.0
+    for (query, grams), prod in zip(items, resolve_products(user_id, [q for q, _ in items])):
+        if prod is None:
+            bad.append(query)
+            continue
+        batch.append((prod["ref_type"], prod["id"], grams))
+        kcal += (prod["kcal"] or 0) * grams / 100
+        lines.append(f"• {html.escape(prod['name_ru'] or prod['name_en'] or '—')} — {grams:g} g · {(prod['kcal'] or 0) * grams / 100:.0f} kcal")
+    lines += [tf("recipe_item_not_found", lang, query=html.escape(b)) for b in bad]
+    clear_state(user_id)
+    if not batch:
+        send(user_id, "\n".join(lines[1:]), reply_markup=main_menu_kb(lang))
+        return True
+    lines.append(tf("batch_total", lang, kcal=kcal))
+    set_state(user_id, batch=batch)
+    kb = types.InlineKeyboardMarkup()
+    kb.row(*[types.InlineKeyboardButton(t(f"meal_{m}", lang), callback_data=f"bl:{m}") for m in MEALS[:2]])
+    kb.row(*[types.InlineKeyboardButton(t(f"meal_{m}", lang), callback_data=f"bl:{m}") for m in MEALS[2:]])
+    kb.add(types.InlineKeyboardButton(t("btn_cancel", lang), callback_data="bl:x"))
+    send(user_id, "\n".join(lines), reply_markup=kb)
+    log(user_id, "batch_parsed", {"n": len(batch), "not_found": len(bad)})
+    return True
+
+
+def cb_batch(call):
+    user_id = call.from_user.id
+    lang = user_lang(user_id)
+    meal = call.data.split(":", 1)[1]
+    batch = get_state(user_id).get("batch")
+    if not batch:
+        bot.answer_callback_query(call.id, t("batch_expired", lang))
+        return
+    bot.answer_callback_query(call.id)
+    clear_state(user_id)
+    if meal not in MEALS:
+        sender.submit(user_id, "edit_message_text", t("batch_cancelled", lang), user_id, call.message.message_id)
+        return
+    # one write op: every row, its stats and the day totals commit together
+    db.add_food_logs(cfg.db_path, user_id, batch, meal)
+    total = db.day_totals(cfg.db_path, user_id, now_utc().date().isoformat())
+    sender.submit(user_id, "edit_message_text", tf("batch_added", lang, n=len(batch), meal=t(f"meal_{meal}", lang), kcal=total["kcal"]), user_id, call.message.message_id)
+    log(user_id, "add_food_batch", {"n": len(batch), "meal": meal})
+
+
 def show_recent(user_id: int, lang: str):
     rec = db.get_recent_products(cfg.db_path, user_id, limit=10)
     if not rec:
-        bot.send_message(user_id, "—", reply_markup=main_menu_kb(lang))
+        send(user_id, "—", reply_markup=main_menu_kb(lang))
         return
 
     kb = types.InlineKeyboardMarkup()
     for r in rec:
-        prod = db.get_product(cfg.db_path, r["ref_type"], int(r["ref_id"]), user_id)
-        if not prod:
-            continue
-        title = (prod["name_ru"] or prod["name_en"] or "—")[:48]
+        title = (r["name_ru"] or r["name_en"] or "—")[:40]
         kb.add(types.InlineKeyboardButton(
-            f"{title} ({r['ref_type']})",
+            f"{title} · {r['grams']:.0f} g",
             callback_data=f"pick:{r['ref_type']}:{r['ref_id']}:1"
         ))
-    bot.send_message(user_id, t("choose_product", lang), reply_markup=kb)
+    send(user_id, t("choose_product", lang), reply_markup=kb)
     log(user_id, "open_recent")
 
 
@@ -518,23 +1066,32 @@ def handle_barcode(message, lang: str):
     barcode = st.get("barcode") or (message.text or "").strip()
 
     if not (barcode and barcode.isdigit()):
-        bot.send_message(user_id, t("bad_format", lang))
+        send(user_id, t("bad_format", lang))
         return
 
     if not cfg.off_enabled:
-        bot.send_message(user_id, t("no_results", lang))
+        send(user_id, t("no_results", lang))
+        return
+    if not ingress.barcode_allowed(user_id):
+        clear_state(user_id)
+        send(user_id, t("barcode_cooldown", lang), reply_markup=main_menu_kb(lang))
+        log(user_id, "barcode_cooldown")
         return
 
     try:
-        url = f"https://world.openfoodfacts.org/api/v2/product/{barcode}.json"
-        resp = requests.get(url, timeout=cfg.off_timeout)
-        data = resp.json()
+        url = f"{cfg.off_base_url}/api/v2/product/{barcode}.json"
+        with metrics.timed("off", "product"):
+            import requests  # only the OFF lookup needs it
+
+            resp = requests.get(url, timeout=cfg.off_timeout)
+            data = resp.json()
     except Exception:
-        bot.send_message(user_id, t("no_results", lang))
+        send(user_id, t("no_results", lang))
         return
 
     if data.get("status") != 1:
-        bot.send_message(user_id, t("no_results", lang))
+        ingress.barcode_result(user_id, found=False)
+        send(user_id, t("no_results", lang))
         return
 
     prod = data.get("product", {})
@@ -546,34 +1103,31 @@ def handle_barcode(message, lang: str):
     c_ = nutr.get("carbohydrates_100g")
 
     if any(v is None for v in [kcal, p, f, c_]):
-        bot.send_message(user_id, t("no_results", lang))
+        ingress.barcode_result(user_id, found=False)
+        send(user_id, t("no_results", lang))
         return
+    ingress.barcode_result(user_id, found=True)
 
     name_ru = name
     name_en = name
-    user_pid = db.add_user_product(cfg.db_path, user_id, name_ru, name_en, float(kcal), float(p), float(f), float(c_))
-    existing = db.find_global_product_by_names(cfg.db_path, name_ru, name_en)
-    if existing is None:
-        db.add_global_product(cfg.db_path, user_id, name_ru, name_en, float(kcal), float(p), float(f), float(c_), source="off")
+    db.create_product(
+        cfg.db_path, user_id, name_ru, name_en, float(kcal), float(p), float(f), float(c_),
+        source="off", event_name="barcode_added", meta={"barcode": barcode},
+    )
 
     clear_state(user_id)
-    bot.send_message(
+    send(
         user_id,
         f"✅ {name_ru}\n100g: {float(kcal):.0f} kcal | P {float(p):.1f} F {float(f):.1f} C {float(c_):.1f}",
         reply_markup=main_menu_kb(lang)
     )
-    log(user_id, "barcode_added", {"barcode": barcode, "user_product_id": user_pid})
 
 
 def show_admin(user_id: int, lang: str):
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.row("📈 Аналитика")
-    kb.row("⬅️ Назад")
-    bot.send_message(user_id, t("admin_title", lang), reply_markup=kb)
+    send(user_id, t("admin_title", lang), reply_markup=keyboards.admin_kb(lang))
     log(user_id, "open_admin")
 
 
-@bot.message_handler(func=lambda m: m.text == "📈 Аналитика")
 def admin_analytics(message):
     ensure_user(message)
     if not is_admin_user(message):
@@ -582,7 +1136,7 @@ def admin_analytics(message):
     lang = user_lang(user_id)
     snap = db.analytics_snapshot(cfg.db_path)
     lines = [
-        "📈 Аналитика",
+        keyboards.ADMIN_BTN_ANALYTICS,
         f"👥 Пользователей всего: {snap['total_users']}",
         f"⚡ Активных за 7 дней: {snap['active_7d']}",
         "",
@@ -590,8 +1144,223 @@ def admin_analytics(message):
     ]
     for name, n in snap["top_events"]:
         lines.append(f"• {name}: {n}")
-    bot.send_message(user_id, "\n".join(lines), reply_markup=back_kb(lang))
+    stats = popstats.cached(cfg.db_path)
+    if stats is None:
+        stats_job.kick()
+    lines += ["", popstats.report(stats)]
+    send(user_id, "\n".join(lines), reply_markup=back_kb(lang))
+
+
+def admin_broadcasts(message):
+    user_id = message.from_user.id
+    lang = user_lang(user_id)
+    lines = ["📣 Рассылки"]
+    for b in db.list_broadcasts(cfg.db_path, limit=5):
+        when = f"⏰ {b['local_time']}" if b["kind"] == "reminder" else "📣"
+        lines.append(f"#{b['id']} {when} [{b['status']}] ✅ {b['sent']} ❌ {b['failed']}: {html.escape(b['text'][:40])}")
+    lines.append("")
+    lines.append("Напиши текст рассылки.\nЕжедневное напоминание: начни с времени, например\n09:00 Не забудь записать завтрак")
+    set_state(user_id, step="admin_broadcast_text")
+    send(user_id, "\n".join(lines), reply_markup=back_kb(lang))
+
+
+def handle_admin_broadcast(message, lang: str):
+    user_id = message.from_user.id
+    if not is_admin_user(message):
+        clear_state(user_id)
+        return
+    text, local_time = parse_broadcast_text(message.text or "")
+    if not text:
+        send(user_id, t("bad_format", lang))
+        return
+    error = check_html(text)
+    if error:
+        # state kept: the admin just sends the corrected text
+        send(user_id, f"❌ Telegram не примет этот текст: {html.escape(error)}. Исправь и пришли ещё раз.")
+        return
+    kind = "reminder" if local_time else "announcement"
+    bid = db.create_broadcast(cfg.db_path, user_id, kind, text, local_time)
+    clear_state(user_id)
+    send(user_id, f"✅ #{bid}", reply_markup=main_menu_kb(lang))
+    log(user_id, "admin_broadcast_created", {"id": bid, "kind": kind})
+
+
+def admin_slow_queries(message):
+    user_id = message.from_user.id
+    lang = user_lang(user_id)
+    # SQL contains < and >, the bot sends HTML
+    send(user_id, html.escape(slowlog.report(10)), reply_markup=back_kb(lang))
+
+
+def admin_limits(message):
+    user_id = message.from_user.id
+    lang = user_lang(user_id)
+    st = ingress.snapshot()
+    lines = [
+        keyboards.ADMIN_BTN_LIMITS,
+        f"✅ Пропущено: {st['allowed']}",
+        f"🚫 Отброшено по пользователю: {st['dropped_user']}",
+        f"🚫 Отброшено по общему лимиту: {st['dropped_global']}",
+        f"🔢 Промахов по штрихкоду: {st['barcode_misses']}, заблокировано запросов: {st['barcode_blocked']}, на паузе сейчас: {st['barcode_cooldowns']}",
+        "",
+        f"Лимит: {cfg.ingress_rate_user:g}/с на пользователя (пачка {cfg.ingress_burst_user:g}), {cfg.ingress_rate_global:g}/с на процесс",
+    ]
+    top = ingress.top(5)
+    if top:
+        lines.append("")
+        lines.append("🔥 Чаще всего отбрасывали:")
+        lines += [f"• {uid}: {n}" for uid, n in top]
+    send(user_id, "\n".join(lines), reply_markup=keyboards.admin_kb(lang))
+
+
+ADMIN_BUTTONS = {
+    keyboards.ADMIN_BTN_ANALYTICS: admin_analytics,
+    keyboards.ADMIN_BTN_BROADCAST: admin_broadcasts,
+    keyboards.ADMIN_BTN_SLOW_QUERIES: admin_slow_queries,
+    keyboards.ADMIN_BTN_LIMITS: admin_limits,
+}
+
+
+def start_metrics() -> None:
+    metrics.enable()
+    metrics.instrument_bot(bot)
+    metrics.register_collector(lambda: {f"kbju_sender_{k}": v for k, v in sender.stats().items()})
+    metrics.register_collector(lambda: {"kbju_state_users": len(STATE)})
+    metrics.register_collector(lambda: {f"kbju_ingress_{k}": v for k, v in ingress.snapshot().items()})
+    metrics.register_collector(lambda: {f"kbju_db_writer_{k}": v for k, v in db.writer_stats(cfg.db_path).items()})
+    metrics.register_collector(lambda: {f"kbju_search_index_{k}": v for k, v in {**product_index.size(), **product_index.stats}.items()})
+    metrics.register_collector(lambda: {f"kbju_backup_{k}": v for k, v in backups.stats().items()})
+    metrics.serve(cfg.metrics_host, cfg.metrics_port)
+
+
+def limited(handler):
+    """Drop updates over the ingress limits before the handler does any DB work (ensure_user, user_lang)."""
+    @functools.wraps(handler)
+    def wrapper(update):
+        user = update.from_user
+        if user is not None and (user.username or "") != cfg.admin_username:
+            ok, first = ingress.allow(user.id)
+            if not ok:
+                if first:
+                    # once per flood; the language from Telegram, the db isn't asked
+                    lang = "en" if (user.language_code or "").startswith("en") else "ru"
+                    if isinstance(update, types.Message):
+                        send(user.id, t("slow_down", lang))
+                    elif isinstance(update, types.CallbackQuery):
+                        bot.answer_callback_query(update.id, t("slow_down", lang))
+                return
+        return handler(update)
+    return wrapper
+
+
+def register_handlers(b: telebot.TeleBot) -> None:
+    # order matters: the first matching handler wins
+    b.register_message_handler(limited(start), commands=["start"])
+    b.register_message_handler(limited(router), func=lambda m: True, content_types=["text"])
+    b.register_callback_query_handler(limited(cb_setlang), func=lambda c: c.data.startswith("setlang:"))
+    b.register_callback_query_handler(limited(cb_pick_product), func=lambda c: c.data.startswith("pick:"))
+    b.register_callback_query_handler(limited(cb_activity), func=lambda c: c.data.startswith("act:"))
+    b.register_callback_query_handler(limited(cb_diary), func=lambda c: c.data.split(":", 1)[0] in DIARY_CALLBACKS)
+    b.register_callback_query_handler(limited(cb_batch), func=lambda c: c.data.startswith("bl:"))
+    b.register_callback_query_handler(limited(cb_recipe), func=lambda c: c.data.split(":", 1)[0] in RECIPE_CALLBACKS)
+    b.register_inline_handler(limited(inline_search), func=lambda q: True)
+
+
+# (phase, seconds) of create_app()
+STARTUP: list[tuple[str, float]] = []
+
+
+@contextmanager
+def _phase(name: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP.append((name, time.perf_counter() - t0))
+
+
+def create_app(threaded: bool = True) -> telebot.TeleBot:
+    """
+    Build the bot: config, DB bootstrap, Telegram client and outbound queue,
+    background services (not started), handlers, prebuilt keyboards.
+    Importing this module does none of it.
+    """
+    global cfg, bot, sender, scheduler, product_index, stats_job, backups, ingress
+    if bot is not None:
+        return bot
+
+    with _phase("config"):
+        load_dotenv()
+        cfg = load_config()
+    with _phase("database"):
+        if cfg.db_init:
+            db.init_db(cfg.db_path)
+        # observers go in before the writer opens its connection, so writes are timed from the start
+        if cfg.slow_query_ms > 0:
+            slowlog.enable(cfg.slow_query_ms)
+        if cfg.metrics_port:
+            metrics.enable()
+        if cfg.db_writer:
+            db.start_writer(cfg.db_path)
+    with _phase("telegram"):
+        if cfg.bot_api_url:
+            apihelper.API_URL = cfg.bot_api_url
+        b = telebot.TeleBot(cfg.bot_token, parse_mode="HTML", threaded=threaded)
+        sender = OutboundSender(
+            b,
+            global_rate=cfg.send_rate_global,
+            chat_rate=cfg.send_rate_chat,
+            on_blocked=lambda chat_id: db.mark_user_blocked(cfg.db_path, chat_id),
+        )
+    with _phase("services"):
+        scheduler = BroadcastScheduler(cfg.db_path, sender)
+        product_index = ProductIndex(max_products=cfg.search_index_max)
+        stats_job = popstats.PopulationStatsJob(cfg.db_path, interval=cfg.popstats_interval or 3600)
+        backups = backup.BackupScheduler(
+            cfg.db_path, cfg.backup_dir, interval=cfg.backup_interval, keep=cfg.backup_keep,
+            checkpoint_interval=cfg.checkpoint_interval, wal_max_bytes=cfg.wal_max_bytes,
+            pages=cfg.backup_step_pages, pause=cfg.backup_step_pause,
+        )
+        ingress = ratelimit.IngressLimiter(
+            user_rate=cfg.ingress_rate_user, user_burst=cfg.ingress_burst_user, global_rate=cfg.ingress_rate_global,
+            barcode_misses=cfg.barcode_miss_limit, barcode_cooldown=cfg.barcode_cooldown,
+        )
+    with _phase("handlers"):
+        register_handlers(b)
+    with _phase("keyboards"):
+        keyboards.warm()
+
+    bot = b
+    logger.info(startup_report())
+    return bot
+
+
+def startup_report() -> str:
+    total = sum(sec for _, sec in STARTUP)
+    # a forked worker inherits the modules already imported by its parent
+    imports = f"imports {IMPORT_SECONDS * 1000:.1f} ms" if os.getpid() == _IMPORT_PID else "imports preloaded"
+    return f"startup {total * 1000:.1f} ms ({imports}): " + ", ".join(f"{name} {sec * 1000:.1f}" for name, sec in STARTUP)
+
+
+def start_services(primary: bool = True) -> None:
+    """Background threads of a bot process. Only the primary runs the DB-wide jobs (broadcasts, stats, backups)."""
+    if cfg.metrics_port:
+        start_metrics()
+    sender.start()
+    if primary:
+        scheduler.start()
+        if cfg.popstats_interval:
+            stats_job.start()
+        backups.start()
+    threading.Thread(target=product_index.warm, args=(cfg.db_path,), name="search-index-warm", daemon=True).start()
+
+
+IMPORT_SECONDS = time.perf_counter() - _IMPORT_T0
+_IMPORT_PID = os.getpid()
 
 
 if __name__ == "__main__":
-    bot.infinity_polling(skip_pending=True)
+    logging.basicConfig(level=logging.INFO)
+    create_app()
+    start_services()
+    bot.infinity_polling(skip_pending=True, allowed_updates=ALLOWED_UPDATES)
@@ -0,0 +1,179 @@
+from __future__ import annotations
+
+import logging
+import re
+import threading
+import time
+from concurrent.futures import wait
+from datetime import datetime, timedelta, timezone
+
+import pytz
+from telebot.apihelper import ApiTelegramException
+
+import database as db
+from sender import PRIORITY_BULK, OutboundSender, is_blocked_error
+
+log = logging.getLogger("kbju.broadcast")
+
+# A daily reminder is still delivered if the bot was down at local_time,
+# but not later than this (no "good morning" at midnight).
+REMINDER_WINDOW = timedelta(hours=3)
+
+# A chunk not delivered in this time (sender stopped or stuck) counts as failed.
+CHUNK_TIMEOUT = 600.0
+
+# Tags Telegram accepts in parse_mode=HTML
+HTML_TAGS = {"b", "strong", "i", "em", "u", "ins", "s", "strike", "del", "a", "code", "pre", "tg-spoiler", "span", "blockquote"}
+_HTML_TOKEN = re.compile(r"<(/?)([a-z][a-z-]*)(?:\s[^<>]*)?>|&(?:[a-z]+|#\d+|#x[0-9a-f]+);|[<>&]", re.IGNORECASE)
+
+
+def _tz(name: str | None):
+    try:
+        return pytz.timezone(name or "UTC")
+    except pytz.UnknownTimeZoneError:
+        return pytz.utc
+
+
+def parse_broadcast_text(text: str) -> tuple[str, str | None]:
+    """'09:00 Пора завтракать' -> daily reminder at 09:00 local time; anything else -> announcement."""
+    head, _, rest = text.strip().partition(" ")
+    try:
+        datetime.strptime(head, "%H:%M")
+    except ValueError:
+        return text.strip(), None
+    if not rest.strip():
+        return text.strip(), None
+    return rest.strip(), head
+
+
+def check_html(text: str) -> str | None:
+    """
+    Why Telegram would reject `text` under parse_mode=HTML (bare <, > or &, an
+    unsupported or unclosed tag), None if it is fine. Every recipient's send
+    would fail with the same 400, so broadcasts are checked when created.
+    """
+    stack: list[str] = []
+    for m in _HTML_TOKEN.finditer(text):
+        token = m.group(0)
+        if token in "<>&":
+            return f"«{token}» вне тега: замени на {'&lt;' if token == '<' else '&gt;' if token == '>' else '&amp;'}"
+        if token.startswith("&"):
+            continue
+        closing, name = m.group(1), m.group(2).lower()
+        if name not in HTML_TAGS:
+            return f"тег <{name}> не поддерживается"
+        if not closing:
+            stack.append(name)
+        elif not stack or stack.pop() != name:
+            return f"лишний или не тот закрывающий </{name}>"
+    if stack:
+        return f"не закрыт <{stack[-1]}>"
+    return None
+
+
+def _bad_text(exc: BaseException | None) -> bool:
+    return isinstance(exc, ApiTelegramException) and exc.error_code == 400 and "parse entities" in str(exc.description)
+
+
+class BroadcastScheduler:
+    """
+    Fans announcements and daily reminders out to all users through the outbound
+    queue. Recipients are streamed from the DB in keyset-paginated chunks; after
+    each chunk is delivered the cursor is checkpointed in broadcast_progress,
+    so a restart resumes from the last finished chunk. A broadcast whose first
+    chunk is rejected by Telegram for every recipient (400) is marked failed.
+    """
+
+    def __init__(self, db_path: str, sender: OutboundSender, chunk_size: int = 500, interval: float = 30.0):
+        self.db_path = db_path
+        self.sender = sender
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="broadcast-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(5)
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.tick()
+            except Exception:
+                pass
+            self._stop.wait(self.interval)
+
+    def tick(self, now: datetime | None = None) -> None:
+        now = now or datetime.now(timezone.utc)
+        for b in db.list_broadcasts(self.db_path, status="active", limit=100):
+            if self._stop.is_set():
+                return
+            if b["kind"] == "reminder" and b["local_time"]:
+                self._run_reminder(b, now)
+            else:
+                if self._fan_out(b, "*", "once"):
+                    db.set_broadcast_status(self.db_path, int(b["id"]), "done")
+
+    def _run_reminder(self, b, now: datetime) -> None:
+        hh, mm = map(int, b["local_time"].split(":"))
+        for tz_name in db.list_user_timezones(self.db_path):
+            local = now.astimezone(_tz(tz_name))
+            due = local.replace(hour=hh, minute=mm, second=0, microsecond=0)
+            if not (due <= local < due + REMINDER_WINDOW):
+                continue
+            if not self._fan_out(b, tz_name, local.strftime("%Y-%m-%d")):
+                return  # stopping, or the text was rejected
+
+    def _fan_out(self, b, tz_name: str | None, run_date: str) -> bool:
+        """Send broadcast `b` to one timezone group (or '*'). Returns True when finished."""
+        broadcast_id = int(b["id"])
+        key = tz_name or ""
+        cursor, done = db.get_broadcast_progress(self.db_path, broadcast_id, key, run_date)
+        while not done and not self._stop.is_set():
+            rows = db.broadcast_recipients(self.db_path, tz_name, cursor, self.chunk_size)
+            if not rows:
+                done = True
+                db.save_broadcast_progress(self.db_path, broadcast_id, key, run_date, cursor, True, 0, 0)
+                break
+
+            futures = [
+                self.sender.send_message(int(r["user_id"]), b["text"], priority=PRIORITY_BULK)
+                for r in rows
+            ]
+            deadline = time.monotonic() + CHUNK_TIMEOUT
+            pending = set(futures)
+            while pending and not self._stop.is_set() and time.monotonic() < deadline:
+                pending = wait(pending, timeout=1.0).not_done
+            if pending and self._stop.is_set():
+                return False  # not checkpointed: resumed from this chunk after a restart
+            if pending:
+                log.warning("broadcast #%d: %d sends not done in %.0fs, counted as failed", broadcast_id, len(pending), CHUNK_TIMEOUT)
+            sent = failed = 0
+            for r, fut in zip(rows, futures):
+                exc = fut.exception(0) if fut.done() else TimeoutError()
+                if exc is None:
+                    sent += 1
+                    continue
+                failed += 1
+                if is_blocked_error(exc) and self.sender.on_blocked is None:
+                    db.mark_user_blocked(self.db_path, int(r["user_id"]))
+            if not sent and all(_bad_text(fut.exception(0)) for fut in futures if fut.done()) and not pending:
+                # the text itself is rejected: stop instead of failing for every user
+                log.error("broadcast #%d rejected by Telegram: %s", broadcast_id, futures[0].exception(0))
+                db.save_broadcast_progress(self.db_path, broadcast_id, key, run_date, cursor, True, 0, failed)
+                db.set_broadcast_status(self.db_path, broadcast_id, "failed")
+                return False
+
+            cursor = int(rows[-1]["user_id"])
+            done = len(rows) < self.chunk_size
+            db.save_broadcast_progress(self.db_path, broadcast_id, key, run_date, cursor, done, sent, failed)
+        return done
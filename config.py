@@ -1,6 +1,9 @@
 import os
 from dataclasses import dataclass
 
+# Update types the bot handles (getUpdates allowed_updates)
+ALLOWED_UPDATES = ["message", "callback_query", "inline_query"]
+
 def _get(name: str, default: str | None = None) -> str:
     val = os.getenv(name, default)
     if val is None:
@@ -11,9 +14,23 @@ def _get(name: str, default: str | None = None) -> str:
 class Config:
     bot_token: str
     admin_username: str
+    bot_api_url: str | None
+
+    # Outbound rate limits (messages per second)
+    send_rate_global: float
+    send_rate_chat: float
+
+    # Inbound limits (updates per second, 0 = off), checked before any DB work
+    ingress_rate_user: float
+    ingress_burst_user: float
+    ingress_rate_global: float
+    barcode_miss_limit: int  # OFF misses in a row before the user's barcode lookups pause
+    barcode_cooldown: float  # seconds
 
     db_path: str
     pdf_dir: str
+    db_writer: bool  # route the process's writes through one writer thread with group commit
+    db_init: bool  # create/migrate the schema on startup (the supervisor does it once for all workers)
 
     # Webhook server
     webhook_host: str
@@ -26,17 +43,52 @@ class Config:
     yookassa_secret_key: str
     yookassa_return_url: str
 
+    # Local Prometheus-style metrics endpoint (port 0 = disabled)
+    metrics_host: str
+    metrics_port: int
+
+    # Log statements slower than this with EXPLAIN QUERY PLAN (0 = disabled)
+    slow_query_ms: float
+
+    # Inline search: max products held in the in-memory prefix index
+    search_index_max: int
+
+    # Population nutrition stats job for the admin panel, seconds between runs (0 = disabled)
+    popstats_interval: float
+
+    # Online snapshots (seconds between snapshots, 0 = disabled) and WAL checkpoints
+    backup_dir: str
+    backup_interval: float
+    backup_keep: int
+    backup_step_pages: int  # pages copied per backup API step
+    backup_step_pause: float  # seconds between steps
+    checkpoint_interval: float
+    wal_max_bytes: int  # above this the scheduled checkpoint is TRUNCATE instead of PASSIVE
+
     # Open Food Facts
     off_enabled: bool
     off_timeout: int
+    off_base_url: str
 
 def load_config() -> Config:
     return Config(
         bot_token=_get("BOT_TOKEN"),
         admin_username=os.getenv("ADMIN_USERNAME", "AnatoliiOsin"),
+        bot_api_url=os.getenv("TELEGRAM_API_URL") or None,
+
+        send_rate_global=float(os.getenv("SEND_RATE_GLOBAL", "30")),
+        send_rate_chat=float(os.getenv("SEND_RATE_CHAT", "1")),
+
+        ingress_rate_user=float(os.getenv("INGRESS_RATE_USER", "2")),
+        ingress_burst_user=float(os.getenv("INGRESS_BURST_USER", "10")),
+        ingress_rate_global=float(os.getenv("INGRESS_RATE_GLOBAL", "300")),
+        barcode_miss_limit=int(os.getenv("BARCODE_MISS_LIMIT", "3")),
+        barcode_cooldown=float(os.getenv("BARCODE_COOLDOWN", "900")),
 
         db_path=os.getenv("DB_PATH", "kbju.sqlite3"),
         pdf_dir=os.getenv("PDF_DIR", "pdf_exports"),
+        db_writer=os.getenv("DB_WRITER", "1").strip() not in ("0", "false", "False"),
+        db_init=os.getenv("DB_INIT", "1").strip() not in ("0", "false", "False"),
 
         webhook_host=os.getenv("WEBHOOK_HOST", "0.0.0.0"),
         webhook_port=int(os.getenv("WEBHOOK_PORT", "8080")),
@@ -47,6 +99,24 @@ def load_config() -> Config:
         yookassa_secret_key=os.getenv("YOOKASSA_SECRET_KEY", ""),
         yookassa_return_url=os.getenv("YOOKASSA_RETURN_URL", "https://example.com/return"),
 
+        metrics_host=os.getenv("METRICS_HOST", "127.0.0.1"),
+        metrics_port=int(os.getenv("METRICS_PORT", "0")),
+
+        slow_query_ms=float(os.getenv("SLOW_QUERY_MS", "0")),
+
+        search_index_max=int(os.getenv("SEARCH_INDEX_MAX", "200000")),
+
+        popstats_interval=float(os.getenv("POPSTATS_INTERVAL", "3600")),
+
+        backup_dir=os.getenv("BACKUP_DIR", "backups"),
+        backup_interval=float(os.getenv("BACKUP_INTERVAL", "86400")),
+        backup_keep=int(os.getenv("BACKUP_KEEP", "7")),
+        backup_step_pages=int(os.getenv("BACKUP_STEP_PAGES", "256")),
+        backup_step_pause=float(os.getenv("BACKUP_STEP_PAUSE_MS", "5")) / 1000.0,
+        checkpoint_interval=float(os.getenv("CHECKPOINT_INTERVAL", "300")),
+        wal_max_bytes=int(float(os.getenv("WAL_MAX_MB", "64")) * (1 << 20)),
+
         off_enabled=os.getenv("OFF_ENABLED", "1").strip() not in ("0", "false", "False"),
         off_timeout=int(os.getenv("OFF_TIMEOUT", "8")),
+        off_base_url=os.getenv("OFF_BASE_URL", "https://world.openfoodfacts.org").rstrip("/"),
     )
@@ -1,28 +1,331 @@
 from __future__ import annotations
 
 import json
+import queue
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
 from contextlib import contextmanager
 from dataclasses import dataclass
-from datetime import datetime, timezone
-from typing import Any, Iterable, Optional
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Callable, Iterable, Optional
+
+import nutrition
+from nutrition import MacroTable
 
 ISO = "%Y-%m-%dT%H:%M:%S%z"
 
+# Bumped whenever the hook or the observers change; long-lived connections
+# (the DBWriter's) compare it and reopen to pick the change up.
+_instrumentation_gen = 0
+
+# Optional callback receiving every SQL statement executed (sqlite3 trace callback).
+_statement_hook: Callable[[str], None] | None = None
+
+def set_statement_hook(hook: Callable[[str], None] | None) -> None:
+    global _statement_hook, _instrumentation_gen
+    _statement_hook = hook
+    _instrumentation_gen += 1
+
+# Instrumentation observers. With no query observers connections are plain
+# sqlite3.Connection objects and there is no per-statement overhead.
+_query_observers: list[Callable[[str, Any, float, sqlite3.Connection], None]] = []
+_connect_observers: list[Callable[[str], None]] = []
+
+def add_query_observer(fn: Callable[[str, Any, float, sqlite3.Connection], None]) -> None:
+    global _instrumentation_gen
+    _query_observers.append(fn)
+    _instrumentation_gen += 1
+
+def add_connect_observer(fn: Callable[[str], None]) -> None:
+    _connect_observers.append(fn)
+
+class _ObservedConnection(sqlite3.Connection):
+    # Times execute()/executemany() until the first row is ready; fetch time is not included.
+    def execute(self, sql, parameters=(), /):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _notify_query(sql, parameters, time.perf_counter() - t0, self)
+
+    def executemany(self, sql, parameters, /):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            _notify_query(sql, None, time.perf_counter() - t0, self)
+
+def _notify_query(sql: str, params: Any, seconds: float, conn: sqlite3.Connection) -> None:
+    for fn in _query_observers:
+        try:
+            fn(sql, params, seconds, conn)
+        except Exception:
+            pass
+
+def _tuples(conn: sqlite3.Connection, sql: str, params: Any = ()) -> list[tuple]:
+    # Plain tuple rows for hot aggregate queries. Goes through conn.execute so the
+    # query is observed; a conn.cursor() would bypass _ObservedConnection.
+    cur = conn.execute(sql, params)
+    cur.row_factory = None
+    return cur.fetchall()
+
 def utcnow() -> str:
     return datetime.now(timezone.utc).strftime(ISO)
 
-@contextmanager
-def connect(db_path: str):
-    conn = sqlite3.connect(db_path, check_same_thread=False)
+def _open(db_path: str, readonly: bool = False) -> sqlite3.Connection:
+    factory = _ObservedConnection if _query_observers else sqlite3.Connection
+    if readonly:
+        uri = Path(db_path).absolute().as_uri() + "?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, factory=factory)
+    else:
+        conn = sqlite3.connect(db_path, check_same_thread=False, factory=factory)
     conn.row_factory = sqlite3.Row
+    for fn in _connect_observers:
+        fn(db_path)
+    if _statement_hook is not None:
+        conn.set_trace_callback(_statement_hook)
+    return conn
+
+@contextmanager
+def connect(db_path: str, readonly: bool | None = None):
+    # While a DBWriter owns db_path, ad-hoc connections are read-only by default.
+    if readonly is None:
+        readonly = db_path in _writers
+    conn = _open(db_path, readonly)
     try:
         yield conn
     finally:
         conn.close()
 
+class DBWriter:
+    """
+    Single writer thread owning the process's write connection to a database.
+    Under supervisor.py there is one per worker process; they serialize on
+    SQLite's write lock, BEGIN IMMEDIATE waiting and retrying while it is held.
+
+    Write operations are functions fn(conn, *args) taken from a queue. Every
+    batch of queued operations runs in one transaction, with a SAVEPOINT per
+    operation so one failing op doesn't roll back the others. Results are
+    handed back through futures after COMMIT, once the op's after_commit hooks
+    have run.
+    """
+
+    def __init__(self, db_path: str, max_batch: int = 64, busy_timeout: float = 30.0):
+        self.db_path = db_path
+        self.max_batch = max_batch
+        self.busy_timeout = busy_timeout
+        self._gen = 0
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: threading.Thread | None = None
+        self.stats = {"ops": 0, "batches": 0, "failed_ops": 0, "failed_commits": 0, "max_batch": 0, "busy_retries": 0}
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float | None = 10.0) -> None:
+        if self._thread and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def submit(self, fn: Callable[..., Any], *args) -> Future:
+        fut: Future = Future()
+        self._queue.put((fn, args, fut))
+        return fut
+
+    def _run(self) -> None:
+        conn = self._connect()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                if self._gen != _instrumentation_gen:
+                    conn.close()
+                    conn = self._connect()
+                batch = [item]
+                stop = False
+                while len(batch) < self.max_batch:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stop = True
+                        break
+                    batch.append(item)
+                try:
+                    self._run_batch(conn, batch)
+                except Exception as e:
+                    # BEGIN gave up on a lock or a ROLLBACK TO failed: the whole
+                    # batch fails, the thread keeps serving the queue
+                    self.stats["failed_commits"] += 1
+                    self._finish([(fut, None, e) for _, _, fut in batch])
+                    try:
+                        if conn.in_transaction:
+                            conn.execute("ROLLBACK")
+                    except sqlite3.Error:
+                        conn.close()
+                        conn = self._connect()
+                if stop:
+                    return
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        self._gen = _instrumentation_gen
+        conn = _open(self.db_path)
+        conn.isolation_level = None  # transactions are managed explicitly below
+        conn.execute("PRAGMA synchronous=NORMAL")  # safe with WAL, one fsync per checkpoint instead of per commit
+        return conn
+
+    def _begin(self, conn: sqlite3.Connection) -> None:
+        # sqlite3's own busy timeout covers short waits; another process
+        # holding the write lock longer than that gets a backoff and retry
+        deadline = time.monotonic() + self.busy_timeout
+        delay = 0.05
+        while True:
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                return
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) and "busy" not in str(e):
+                    raise
+                if time.monotonic() + delay > deadline:
+                    raise
+                self.stats["busy_retries"] += 1
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+
+    def _run_batch(self, conn: sqlite3.Connection, batch: list) -> None:
+        results = []
+        committed: list[Callable[[], None]] = []
+        rolled_back: list[Callable[[], None]] = []
+        self._begin(conn)
+        try:
+            for fn, args, fut in batch:
+                _tx.hooks = hooks = ([], [])
+                conn.execute("SAVEPOINT op")
+                try:
+                    res = fn(conn, *args)
+                    conn.execute("RELEASE op")
+                    results.append((fut, res, None))
+                    committed += hooks[0]
+                    rolled_back += hooks[1]
+                except Exception as e:
+                    _tx.hooks = None
+                    _run_hooks(hooks[1])
+                    conn.execute("ROLLBACK TO op")
+                    conn.execute("RELEASE op")
+                    results.append((fut, None, e))
+            _tx.hooks = None
+            conn.execute("COMMIT")
+        except Exception as e:
+            _tx.hooks = None
+            _run_hooks(rolled_back)
+            if not isinstance(e, sqlite3.Error) or len(results) < len(batch):
+                raise  # _run fails the whole batch
+            self.stats["failed_commits"] += 1
+            try:
+                conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+            results = [(fut, None, e) for fut, _, _ in results]
+        else:
+            _run_hooks(committed)
+        self._finish(results)
+
+    def _finish(self, results: list) -> None:
+        self.stats["ops"] += len(results)
+        self.stats["batches"] += 1
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(results))
+        for fut, res, exc in results:
+            if exc is not None:
+                self.stats["failed_ops"] += 1
+                fut.set_exception(exc)
+            else:
+                fut.set_result(res)
+
+_writers: dict[str, DBWriter] = {}
+
+# Upper bound for write() waiting on the writer; raises concurrent.futures.TimeoutError.
+WRITE_TIMEOUT = 60.0
+
+def start_writer(db_path: str, max_batch: int = 64) -> DBWriter:
+    w = _writers.get(db_path)
+    if w is None:
+        w = _writers[db_path] = DBWriter(db_path, max_batch)
+        w.start()
+    return w
+
+def stop_writer(db_path: str) -> None:
+    w = _writers.pop(db_path, None)
+    if w is not None:
+        w.stop()
+
+def writer_stats(db_path: str) -> dict[str, int]:
+    w = _writers.get(db_path)
+    return dict(w.stats) if w else {}
+
+# (after_commit, on_rollback) hooks of the write op running on this thread
+_tx = threading.local()
+
+def after_commit(fn: Callable[[], None]) -> None:
+    """
+    Run fn once the current write op is committed, e.g. to update an in-process
+    cache; it is dropped if the op rolls back. Outside write() fn runs now.
+    """
+    hooks = getattr(_tx, "hooks", None)
+    if hooks is None:
+        fn()
+    else:
+        hooks[0].append(fn)
+
+def on_rollback(fn: Callable[[], None]) -> None:
+    """Run fn if the current write op rolls back (undo a cache change the op itself needed)."""
+    hooks = getattr(_tx, "hooks", None)
+    if hooks is not None:
+        hooks[1].append(fn)
+
+def _run_hooks(fns: list[Callable[[], None]]) -> None:
+    for fn in fns:
+        try:
+            fn()
+        except Exception:
+            pass
+
+def write(db_path: str, fn: Callable[..., Any], *args, wait: bool = True) -> Any:
+    """
+    Run fn(conn, *args) as a write. Goes through the DBWriter when one is
+    running for db_path, otherwise uses its own connection and commit.
+    With wait=False the writer's Future is returned (fire-and-forget).
+    """
+    w = _writers.get(db_path)
+    if w is None:
+        prev, _tx.hooks = getattr(_tx, "hooks", None), ([], [])
+        hooks = _tx.hooks
+        try:
+            with connect(db_path, readonly=False) as conn:
+                res = fn(conn, *args)
+                conn.commit()
+        except BaseException:
+            _tx.hooks = prev
+            _run_hooks(hooks[1])
+            raise
+        _tx.hooks = prev
+        _run_hooks(hooks[0])
+        return res
+    fut = w.submit(fn, *args)
+    return fut.result(WRITE_TIMEOUT) if wait else fut
+
 def init_db(db_path: str) -> None:
-    with connect(db_path) as conn:
+    with connect(db_path, readonly=False) as conn:
         cur = conn.cursor()
         cur.executescript(
             '''
@@ -109,8 +412,99 @@ def init_db(db_path: str) -> None:
                 updated_at TEXT,
                 meta_json TEXT
             );
+
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT, -- 'announcement' (once) or 'reminder' (daily at local_time)
+                text TEXT,
+                local_time TEXT, -- 'HH:MM' in the user's timezone, reminders only
+                status TEXT, -- active/done/failed/canceled
+                sent INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                created_by_user_id INTEGER,
+                created_at TEXT
+            );
+
+            -- per-user product affinity, maintained by add_food_log
+            CREATE TABLE IF NOT EXISTS user_product_stats (
+                user_id INTEGER,
+                ref_type TEXT,
+                ref_id INTEGER,
+                uses INTEGER DEFAULT 0,
+                score REAL DEFAULT 0, -- sum of 2^((t_use - SCORE_EPOCH) / half-life): ordering == decayed frequency
+                last_used REAL, -- unix time
+                last_grams REAL,
+                last_meal TEXT,
+                PRIMARY KEY (user_id, ref_type, ref_id)
+            ) WITHOUT ROWID;
+
+            -- ingredients of recipes; a recipe is a products_user row with is_recipe=1
+            -- whose kcal..c per 100 g are recomputed from its items on every change
+            CREATE TABLE IF NOT EXISTS recipe_items (
+                recipe_id INTEGER,
+                ref_type TEXT, -- 'global' or 'user' (may itself be a recipe)
+                ref_id INTEGER,
+                grams REAL,
+                PRIMARY KEY (recipe_id, ref_type, ref_id)
+            ) WITHOUT ROWID;
+
+            -- body data for the calorie norm; kcal..c are the daily targets, recomputed on every change
+            CREATE TABLE IF NOT EXISTS user_profiles (
+                user_id INTEGER PRIMARY KEY,
+                sex TEXT, -- 'm' / 'f'
+                age INTEGER,
+                weight REAL, -- kg
+                height REAL, -- cm
+                activity TEXT DEFAULT 'moderate', -- key of nutrition.ACTIVITY
+                goal TEXT DEFAULT 'maint', -- key of nutrition.GOALS
+                kcal REAL,
+                p REAL,
+                f REAL,
+                c REAL,
+                updated_at TEXT
+            );
+
+            -- per user and UTC day food_log rollup, filled incrementally by rollup_daily_totals()
+            CREATE TABLE IF NOT EXISTS daily_totals (
+                user_id INTEGER,
+                day TEXT, -- YYYY-MM-DD
+                kcal REAL DEFAULT 0,
+                p REAL DEFAULT 0,
+                f REAL DEFAULT 0,
+                c REAL DEFAULT 0,
+                entries INTEGER DEFAULT 0,
+                meals INTEGER DEFAULT 0, -- bitmask of MEAL_BITS logged that day
+                PRIMARY KEY (user_id, day)
+            ) WITHOUT ROWID;
+
+            -- resume point of a broadcast run per timezone and local date
+            CREATE TABLE IF NOT EXISTS broadcast_progress (
+                broadcast_id INTEGER,
+                tz TEXT,
+                run_date TEXT,
+                last_user_id INTEGER DEFAULT 0,
+                done INTEGER DEFAULT 0,
+                updated_at TEXT,
+                PRIMARY KEY (broadcast_id, tz, run_date)
+            );
             '''
         )
+        _ensure_column(conn, "users", "blocked_at", "TEXT DEFAULT NULL")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_users_tz ON users(timezone, user_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_food_log_user_ref ON food_log(user_id, product_ref_type, product_ref_id, eaten_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_food_log_user_time ON food_log(user_id, eaten_at)")
+        _ensure_column(conn, "products_global", "popularity", "INTEGER DEFAULT 0")
+        _ensure_column(conn, "products_user", "is_recipe", "INTEGER DEFAULT 0")
+        _ensure_column(conn, "products_user", "total_grams", "REAL DEFAULT NULL")  # cooked weight of a recipe, NULL = sum of items
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_recipe_items_ref ON recipe_items(ref_type, ref_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_products_global_pop ON products_global(popularity DESC, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_ups_user_score ON user_product_stats(user_id, score DESC)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_ups_user_recent ON user_product_stats(user_id, last_used DESC)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_provider_id ON payments(provider_payment_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_products_user_owner ON products_user(user_id)")
+        if conn.execute("SELECT 1 FROM user_product_stats LIMIT 1").fetchone() is None:
+            # databases created before user_product_stats existed
+            rebuild_product_stats(conn)
         conn.commit()
 
         # Defaults
@@ -122,6 +516,62 @@ def init_db(db_path: str) -> None:
         set_setting(conn, "sub_included_text_ru", "Подписка на 30 дней открывает:\n• статистику за месяц\n• экспорт PDF\n• историю без ограничений\n• снимает лимит «Мои продукты» (10 → ∞)")
         set_setting(conn, "sub_included_text_en", "30-day subscription unlocks:\n• monthly analytics\n• PDF export\n• unlimited history\n• removes 'My products' limit (10 → ∞)")
 
+def _ensure_column(conn: sqlite3.Connection, table: str, column: str, decl: str) -> None:
+    # CREATE TABLE IF NOT EXISTS does not add columns to existing databases
+    cols = {r["name"] for r in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in cols:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+# Affinity score: each use adds 2^((t - SCORE_EPOCH) / SCORE_HALF_LIFE). Comparing these
+# sums orders products exactly like exponentially decayed use counts, without
+# rewriting every row as time passes. Doubles last ~39 years past the epoch.
+SCORE_EPOCH = 1704067200.0  # 2024-01-01 UTC
+SCORE_HALF_LIFE = 14 * 86400.0
+
+def use_weight(ts: float) -> float:
+    return 2.0 ** ((ts - SCORE_EPOCH) / SCORE_HALF_LIFE)
+
+def _iso_ts(value: str) -> float:
+    return datetime.strptime(value, ISO).timestamp()
+
+class _DecayedScore:
+    def __init__(self):
+        self.total = 0.0
+
+    def step(self, eaten_at):
+        if eaten_at:
+            self.total += use_weight(_iso_ts(eaten_at))
+
+    def finalize(self):
+        return self.total
+
+def rebuild_product_stats(conn: sqlite3.Connection) -> None:
+    """Recompute user_product_stats and products_global.popularity from food_log."""
+    conn.execute("DELETE FROM user_product_stats")
+    conn.execute("UPDATE products_global SET popularity=0 WHERE popularity<>0")
+    if conn.execute("SELECT 1 FROM food_log LIMIT 1").fetchone() is None:
+        return
+    conn.create_aggregate("decayed_score", 1, _DecayedScore)
+    conn.create_function("iso_ts", 1, _iso_ts, deterministic=True)
+    conn.execute(
+        '''
+        INSERT INTO user_product_stats(user_id, ref_type, ref_id, uses, score, last_used, last_grams, last_meal)
+        SELECT l.user_id, l.product_ref_type, l.product_ref_id, COUNT(*), decayed_score(f.eaten_at), iso_ts(l.eaten_at), l.grams, l.meal
+        FROM (
+            -- grams/meal/eaten_at come from the row holding MAX(id)
+            SELECT user_id, product_ref_type, product_ref_id, grams, meal, eaten_at, MAX(id)
+            FROM food_log
+            GROUP BY user_id, product_ref_type, product_ref_id
+        ) l
+        JOIN food_log f ON f.user_id=l.user_id AND f.product_ref_type=l.product_ref_type AND f.product_ref_id=l.product_ref_id
+        GROUP BY l.user_id, l.product_ref_type, l.product_ref_id
+        '''
+    )
+    popularity = conn.execute(
+        "SELECT SUM(uses) AS n, ref_id FROM user_product_stats WHERE ref_type='global' GROUP BY ref_id"
+    ).fetchall()
+    conn.executemany("UPDATE products_global SET popularity=? WHERE id=?", [tuple(r) for r in popularity])
+
 def get_setting(conn: sqlite3.Connection, key: str, default: str | None = None) -> str | None:
     cur = conn.execute("SELECT value FROM settings WHERE key = ?", (key,))
     row = cur.fetchone()
@@ -136,25 +586,28 @@ def set_setting(conn: sqlite3.Connection, key: str, value: str) -> None:
     )
 
 def upsert_user(db_path: str, user_id: int, username: str | None, is_admin: bool) -> None:
-    with connect(db_path) as conn:
-        now = utcnow()
-        conn.execute(
-            '''
-            INSERT INTO users(user_id, username, created_at, last_seen_at, is_admin)
-            VALUES(?, ?, ?, ?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET
-                username=excluded.username,
-                last_seen_at=excluded.last_seen_at,
-                is_admin=excluded.is_admin
-            ''',
-            (user_id, username, now, now, 1 if is_admin else 0),
-        )
-        conn.commit()
+    write(db_path, _upsert_user, user_id, username, is_admin)
+
+def _upsert_user(conn: sqlite3.Connection, user_id: int, username: str | None, is_admin: bool) -> None:
+    now = utcnow()
+    conn.execute(
+        '''
+        INSERT INTO users(user_id, username, created_at, last_seen_at, is_admin)
+        VALUES(?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            username=excluded.username,
+            last_seen_at=excluded.last_seen_at,
+            is_admin=excluded.is_admin,
+            blocked_at=NULL
+        ''',
+        (user_id, username, now, now, 1 if is_admin else 0),
+    )
 
 def set_user_lang(db_path: str, user_id: int, lang: str) -> None:
-    with connect(db_path) as conn:
-        conn.execute("UPDATE users SET lang=? WHERE user_id=?", (lang, user_id))
-        conn.commit()
+    write(db_path, _set_user_lang, user_id, lang)
+
+def _set_user_lang(conn: sqlite3.Connection, user_id: int, lang: str) -> None:
+    conn.execute("UPDATE users SET lang=? WHERE user_id=?", (lang, user_id))
 
 def get_user(db_path: str, user_id: int) -> sqlite3.Row | None:
     with connect(db_path) as conn:
@@ -162,12 +615,13 @@ def get_user(db_path: str, user_id: int) -> sqlite3.Row | None:
         return cur.fetchone()
 
 def log_event(db_path: str, user_id: int, event_name: str, meta: dict[str, Any] | None = None) -> None:
-    with connect(db_path) as conn:
-        conn.execute(
-            "INSERT INTO events(user_id, event_name, meta_json, created_at) VALUES(?, ?, ?, ?)",
-            (user_id, event_name, json.dumps(meta or {}, ensure_ascii=False), utcnow()),
-        )
-        conn.commit()
+    write(db_path, _log_event, user_id, event_name, meta, wait=False)
+
+def _log_event(conn: sqlite3.Connection, user_id: int, event_name: str, meta: dict[str, Any] | None = None) -> None:
+    conn.execute(
+        "INSERT INTO events(user_id, event_name, meta_json, created_at) VALUES(?, ?, ?, ?)",
+        (user_id, event_name, json.dumps(meta or {}, ensure_ascii=False), utcnow()),
+    )
 
 def is_subscription_enabled(db_path: str) -> bool:
     with connect(db_path) as conn:
@@ -193,20 +647,21 @@ def user_has_active_sub(db_path: str, user_id: int) -> bool:
     return dt > datetime.now(timezone.utc)
 
 def activate_subscription(db_path: str, user_id: int, days: int = 30) -> None:
-    with connect(db_path) as conn:
-        row = conn.execute("SELECT sub_until FROM users WHERE user_id=?", (user_id,)).fetchone()
-        now = datetime.now(timezone.utc)
-        base = now
-        if row and row["sub_until"]:
-            try:
-                prev = datetime.strptime(row["sub_until"], ISO)
-                if prev > now:
-                    base = prev
-            except Exception:
-                pass
-        new_until = (base + __import__("datetime").timedelta(days=days)).strftime(ISO)
-        conn.execute("UPDATE users SET sub_until=? WHERE user_id=?", (new_until, user_id))
-        conn.commit()
+    write(db_path, _activate_subscription, user_id, days)
+
+def _activate_subscription(conn: sqlite3.Connection, user_id: int, days: int = 30) -> None:
+    row = conn.execute("SELECT sub_until FROM users WHERE user_id=?", (user_id,)).fetchone()
+    now = datetime.now(timezone.utc)
+    base = now
+    if row and row["sub_until"]:
+        try:
+            prev = datetime.strptime(row["sub_until"], ISO)
+            if prev > now:
+                base = prev
+        except Exception:
+            pass
+    new_until = (base + __import__("datetime").timedelta(days=days)).strftime(ISO)
+    conn.execute("UPDATE users SET sub_until=? WHERE user_id=?", (new_until, user_id))
 
 def count_user_products(db_path: str, user_id: int) -> int:
     with connect(db_path) as conn:
@@ -214,48 +669,143 @@ def count_user_products(db_path: str, user_id: int) -> int:
         return int(cur.fetchone()["n"])
 
 def add_user_product(db_path: str, user_id: int, name_ru: str, name_en: str, kcal: float, p: float, f: float, c: float) -> int:
-    with connect(db_path) as conn:
-        cur = conn.execute(
-            "INSERT INTO products_user(user_id, name_ru, name_en, kcal, p, f, c, created_at) VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
-            (user_id, name_ru, name_en, kcal, p, f, c, utcnow()),
-        )
-        conn.commit()
-        return int(cur.lastrowid)
+    return write(db_path, _add_user_product, user_id, name_ru, name_en, kcal, p, f, c)
+
+def _add_user_product(conn: sqlite3.Connection, user_id: int, name_ru: str, name_en: str, kcal: float, p: float, f: float, c: float) -> int:
+    cur = conn.execute(
+        "INSERT INTO products_user(user_id, name_ru, name_en, kcal, p, f, c, created_at) VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+        (user_id, name_ru, name_en, kcal, p, f, c, utcnow()),
+    )
+    pid = int(cur.lastrowid)
+    after_commit(lambda: _macros.put("user", pid, kcal, p, f, c, user_id))
+    return pid
 
 def find_global_product_by_names(db_path: str, name_ru: str, name_en: str) -> int | None:
     with connect(db_path) as conn:
-        cur = conn.execute(
-            "SELECT id FROM products_global WHERE lower(name_ru)=lower(?) OR lower(name_en)=lower(?) LIMIT 1",
-            (name_ru.strip(), name_en.strip()),
-        )
-        row = cur.fetchone()
-        return int(row["id"]) if row else None
+        return _find_global_product_by_names(conn, name_ru, name_en)
+
+def _find_global_product_by_names(conn: sqlite3.Connection, name_ru: str, name_en: str) -> int | None:
+    cur = conn.execute(
+        "SELECT id FROM products_global WHERE lower(name_ru)=lower(?) OR lower(name_en)=lower(?) LIMIT 1",
+        (name_ru.strip(), name_en.strip()),
+    )
+    row = cur.fetchone()
+    return int(row["id"]) if row else None
 
 def add_global_product(db_path: str, created_by_user_id: int, name_ru: str, name_en: str, kcal: float, p: float, f: float, c: float, source: str = "manual") -> int:
-    with connect(db_path) as conn:
-        cur = conn.execute(
-            "INSERT INTO products_global(name_ru, name_en, kcal, p, f, c, source, created_by_user_id, created_at) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (name_ru, name_en, kcal, p, f, c, source, created_by_user_id, utcnow()),
-        )
-        conn.commit()
-        return int(cur.lastrowid)
+    return write(db_path, _add_global_product, created_by_user_id, name_ru, name_en, kcal, p, f, c, source)
+
+def _add_global_product(conn: sqlite3.Connection, created_by_user_id: int, name_ru: str, name_en: str, kcal: float, p: float, f: float, c: float, source: str = "manual") -> int:
+    cur = conn.execute(
+        "INSERT INTO products_global(name_ru, name_en, kcal, p, f, c, source, created_by_user_id, created_at) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (name_ru, name_en, kcal, p, f, c, source, created_by_user_id, utcnow()),
+    )
+    pid = int(cur.lastrowid)
+    after_commit(lambda: _macros.put("global", pid, kcal, p, f, c))
+    return pid
+
+def create_product(db_path: str, user_id: int, name_ru: str, name_en: str, kcal: float, p: float, f: float, c: float, source: str = "manual", event_name: str | None = None, meta: dict[str, Any] | None = None) -> int:
+    """
+    Unit of work for "user adds a product": the user product, its global
+    counterpart (unless one with the same name exists) and the analytics event
+    are written in one transaction with a single commit. Returns the user product id.
+    """
+    return write(db_path, _create_product, user_id, name_ru, name_en, kcal, p, f, c, source, event_name, meta)
+
+def _create_product(conn: sqlite3.Connection, user_id: int, name_ru: str, name_en: str, kcal: float, p: float, f: float, c: float, source: str, event_name: str | None, meta: dict[str, Any] | None) -> int:
+    user_pid = _add_user_product(conn, user_id, name_ru, name_en, kcal, p, f, c)
+    if _find_global_product_by_names(conn, name_ru, name_en) is None:
+        _add_global_product(conn, user_id, name_ru, name_en, kcal, p, f, c, source)
+    if event_name:
+        _log_event(conn, user_id, event_name, {**(meta or {}), "user_product_id": user_pid})
+    return user_pid
+
+_PRODUCT_COLS = "id, name_ru, name_en, kcal, p, f, c"
 
 def search_products(db_path: str, user_id: int, query: str, limit: int = 10) -> list[dict[str, Any]]:
+    """
+    Name search ranked for the user: products they log often and recently
+    (decayed score) first, then their own products, then global products by
+    popularity.
+    """
+    with connect(db_path) as conn:
+        return _search_products(conn, user_id, query, limit)
+
+def search_products_many(db_path: str, user_id: int, queries: Iterable[str], limit: int = 1) -> list[list[dict[str, Any]]]:
+    """search_products() for several names on one connection, results in the order of queries."""
+    with connect(db_path) as conn:
+        return [_search_products(conn, user_id, q, limit) for q in queries]
+
+def _search_products(conn: sqlite3.Connection, user_id: int, query: str, limit: int) -> list[dict[str, Any]]:
     q = f"%{query.strip().lower()}%"
+    rows_s = conn.execute(
+        _STATS_SQL.format(where="AND (lower(COALESCE(pu.name_ru, pg.name_ru)) LIKE ? OR lower(COALESCE(pu.name_en, pg.name_en)) LIKE ?) ORDER BY s.score DESC LIMIT ?"),
+        (user_id, q, q, limit),
+    ).fetchall()
+    rows_u = conn.execute(
+        f"SELECT {_PRODUCT_COLS}, 'user' AS ref_type FROM products_user WHERE user_id=? AND (lower(name_ru) LIKE ? OR lower(name_en) LIKE ?) LIMIT ?",
+        (user_id, q, q, limit),
+    ).fetchall()
+    rows_g = conn.execute(
+        f"SELECT {_PRODUCT_COLS}, 'global' AS ref_type FROM products_global WHERE (lower(name_ru) LIKE ? OR lower(name_en) LIKE ?) ORDER BY popularity DESC, id LIMIT ?",
+        (q, q, limit),
+    ).fetchall()
+    out = []
+    seen = set()
+    for r in list(rows_s) + list(rows_u) + list(rows_g):
+        key = (r["ref_type"], r["id"])
+        if key in seen:
+            continue
+        seen.add(key)
+        out.append({k: r[k] for k in ("id", "name_ru", "name_en", "kcal", "p", "f", "c", "ref_type")})
+    return out[:limit]
+
+_INDEX_OWNERS = """
+    WITH o AS (SELECT user_id, COUNT(*) AS n, MAX(id) AS last FROM products_user GROUP BY user_id)
+    SELECT user_id, SUM(n) OVER (ORDER BY last DESC, user_id ROWS UNBOUNDED PRECEDING) AS running FROM o
+"""
+
+def products_for_index(
+    db_path: str, limit: int,
+) -> tuple[list[sqlite3.Row], list[sqlite3.Row], int, int, list[int]]:
+    """
+    Most popular global products and the products of whole owners (most recently
+    adding first) up to limit, the max ids of both tables, and the owners left out.
+    """
     with connect(db_path) as conn:
-        rows_u = conn.execute(
-            "SELECT id, name_ru, name_en, kcal, p, f, c, 'user' AS ref_type FROM products_user WHERE user_id=? AND (lower(name_ru) LIKE ? OR lower(name_en) LIKE ?) LIMIT ?",
-            (user_id, q, q, limit),
+        # an owner is indexed whole or not at all: cut by the running count per owner
+        users = conn.execute(
+            f"SELECT p.id, p.user_id, p.name_ru, p.name_en, p.kcal, p.p, p.f, p.c FROM products_user p "
+            f"JOIN ({_INDEX_OWNERS}) r ON r.user_id = p.user_id WHERE r.running <= ?",
+            (limit,),
         ).fetchall()
-        rows_g = conn.execute(
-            "SELECT id, name_ru, name_en, kcal, p, f, c, 'global' AS ref_type FROM products_global WHERE (lower(name_ru) LIKE ? OR lower(name_en) LIKE ?) LIMIT ?",
-            (q, q, limit),
+        left_out = [int(r[0]) for r in conn.execute(f"SELECT user_id FROM ({_INDEX_OWNERS}) WHERE running > ?", (limit,))]
+        glob = conn.execute(
+            "SELECT id, name_ru, name_en, kcal, p, f, c, popularity FROM products_global ORDER BY popularity DESC, id LIMIT ?",
+            (max(limit - len(users), 0),),
         ).fetchall()
-    # merge: user first
-    out = []
-    for r in list(rows_u) + list(rows_g):
-        out.append(dict(r))
-    return out[:limit]
+        max_g = conn.execute("SELECT COALESCE(MAX(id), 0) FROM products_global").fetchone()[0]
+        max_u = conn.execute("SELECT COALESCE(MAX(id), 0) FROM products_user").fetchone()[0]
+    return glob, users, int(max_g), int(max_u), left_out
+
+def user_products_for_index(db_path: str, user_id: int) -> list[sqlite3.Row]:
+    with connect(db_path) as conn:
+        return conn.execute(
+            "SELECT id, user_id, name_ru, name_en, kcal, p, f, c FROM products_user WHERE user_id=?",
+            (user_id,),
+        ).fetchall()
+
+def products_added_since(db_path: str, global_id: int, user_id: int, limit: int = 1000) -> tuple[list[sqlite3.Row], list[sqlite3.Row]]:
+    with connect(db_path) as conn:
+        glob = conn.execute(
+            "SELECT id, name_ru, name_en, kcal, p, f, c, popularity FROM products_global WHERE id>? ORDER BY id LIMIT ?",
+            (global_id, limit),
+        ).fetchall()
+        users = conn.execute(
+            "SELECT id, user_id, name_ru, name_en, kcal, p, f, c FROM products_user WHERE id>? ORDER BY id LIMIT ?",
+            (user_id, limit),
+        ).fetchall()
+    return glob, users
 
 def get_product(db_path: str, ref_type: str, ref_id: int, user_id: int) -> dict[str, Any] | None:
     with connect(db_path) as conn:
@@ -272,66 +822,732 @@ def get_product(db_path: str, ref_type: str, ref_id: int, user_id: int) -> dict[
     return dict(row) if row else None
 
 def add_food_log(db_path: str, user_id: int, ref_type: str, ref_id: int, grams: float, meal: str) -> None:
-    with connect(db_path) as conn:
-        conn.execute(
-            "INSERT INTO food_log(user_id, product_ref_type, product_ref_id, grams, meal, eaten_at) VALUES(?, ?, ?, ?, ?, ?)",
-            (user_id, ref_type, ref_id, grams, meal, utcnow()),
-        )
-        conn.commit()
+    write(db_path, _add_food_log, user_id, ref_type, ref_id, grams, meal)
+
+def add_food_logs(db_path: str, user_id: int, items: Iterable[tuple[str, int, float]], meal: str) -> int:
+    """Log several (ref_type, ref_id, grams) at once: one write op, so one transaction. Returns the number of rows."""
+    return write(db_path, _add_food_logs, user_id, list(items), meal)
+
+def _add_food_logs(conn: sqlite3.Connection, user_id: int, items: list[tuple[str, int, float]], meal: str) -> int:
+    for ref_type, ref_id, grams in items:
+        _add_food_log(conn, user_id, ref_type, int(ref_id), float(grams), meal)
+    return len(items)
+
+def _add_food_log(conn: sqlite3.Connection, user_id: int, ref_type: str, ref_id: int, grams: float, meal: str) -> None:
+    now = time.time()
+    conn.execute(
+        "INSERT INTO food_log(user_id, product_ref_type, product_ref_id, grams, meal, eaten_at) VALUES(?, ?, ?, ?, ?, ?)",
+        (user_id, ref_type, ref_id, grams, meal, datetime.fromtimestamp(int(now), timezone.utc).strftime(ISO)),
+    )
+    conn.execute(
+        '''
+        INSERT INTO user_product_stats(user_id, ref_type, ref_id, uses, score, last_used, last_grams, last_meal)
+        VALUES(?, ?, ?, 1, ?, ?, ?, ?)
+        ON CONFLICT(user_id, ref_type, ref_id) DO UPDATE SET
+            uses=uses+1, score=score+excluded.score, last_used=excluded.last_used,
+            last_grams=excluded.last_grams, last_meal=excluded.last_meal
+        ''',
+        (user_id, ref_type, ref_id, use_weight(now), now, float(grams), meal),
+    )
+    if ref_type == "global":
+        conn.execute("UPDATE products_global SET popularity=popularity+1 WHERE id=?", (ref_id,))
+    _recent_touch(conn, user_id, ref_type, ref_id)
+    _day_totals_add(conn, user_id, datetime.fromtimestamp(int(now), timezone.utc).strftime("%Y-%m-%d"), ref_type, ref_id, float(grams))
+
+# Per-user MRU of recently logged products (most recent first), kept in sync by add_food_log.
+RECENT_CACHE_USERS = 10000
+RECENT_CACHE_DEPTH = 20
+_recent_cache: OrderedDict[int, list[dict[str, Any]]] = OrderedDict()
+_recent_lock = threading.Lock()
+_recent_gen = 0  # bumped on every commit that changes a user's MRU, like _day_totals_gen
+
+# user_product_stats joined with the product it points to; {where} continues "WHERE s.user_id=?"
+_STATS_SQL = '''
+    SELECT s.ref_type, s.ref_id, s.ref_id AS id, s.last_grams AS grams, s.last_meal AS meal,
+           s.last_used, s.uses, s.score,
+           COALESCE(pu.name_ru, pg.name_ru) AS name_ru,
+           COALESCE(pu.name_en, pg.name_en) AS name_en,
+           COALESCE(pu.kcal, pg.kcal) AS kcal,
+           COALESCE(pu.p, pg.p) AS p,
+           COALESCE(pu.f, pg.f) AS f,
+           COALESCE(pu.c, pg.c) AS c
+    FROM user_product_stats s
+    LEFT JOIN products_user pu ON s.ref_type='user' AND pu.id=s.ref_id AND pu.user_id=s.user_id
+    LEFT JOIN products_global pg ON s.ref_type='global' AND pg.id=s.ref_id
+    WHERE s.user_id=? AND COALESCE(pu.id, pg.id) IS NOT NULL {where}
+'''
+
+def _recent_touch(conn: sqlite3.Connection, user_id: int, ref_type: str, ref_id: int) -> None:
+    with _recent_lock:
+        cached = user_id in _recent_cache
+    if not cached:
+        # still bumped after COMMIT: a miss reading concurrently must not store what it read
+        after_commit(_recent_bump)
+        return
+    row = conn.execute(
+        _STATS_SQL.format(where="AND s.ref_type=? AND s.ref_id=?"),
+        (user_id, ref_type, ref_id),
+    ).fetchone()
+    entry = dict(row) if row is not None else None
+
+    def apply() -> None:
+        global _recent_gen
+        with _recent_lock:
+            _recent_gen += 1
+            items = _recent_cache.get(user_id)
+            if items is None:
+                return
+            if entry is None:
+                _recent_cache.pop(user_id, None)
+                return
+            items = [it for it in items if not (it["ref_type"] == ref_type and it["ref_id"] == ref_id)]
+            _recent_cache[user_id] = [entry] + items[:RECENT_CACHE_DEPTH - 1]
+
+    after_commit(apply)
+
+def _recent_bump() -> None:
+    global _recent_gen
+    with _recent_lock:
+        _recent_gen += 1
 
 def get_recent_products(db_path: str, user_id: int, limit: int = 10) -> list[dict[str, Any]]:
+    """
+    Recently logged products with their details, last grams/meal and use count,
+    most recent first. One query on a miss, no query while the user's MRU is cached.
+    """
+    if limit <= RECENT_CACHE_DEPTH:
+        with _recent_lock:
+            items = _recent_cache.get(user_id)
+            if items is not None:
+                _recent_cache.move_to_end(user_id)
+                return [dict(it) for it in items[:limit]]
+    with _recent_lock:
+        gen = _recent_gen
+
     with connect(db_path) as conn:
         rows = conn.execute(
-            '''
-            SELECT product_ref_type AS ref_type, product_ref_id AS ref_id, MAX(eaten_at) AS last_time
-            FROM food_log
-            WHERE user_id=?
-            GROUP BY product_ref_type, product_ref_id
-            ORDER BY last_time DESC
-            LIMIT ?
-            ''',
-            (user_id, limit),
+            _STATS_SQL.format(where="ORDER BY s.last_used DESC LIMIT ?"),
+            (user_id, max(limit, RECENT_CACHE_DEPTH)),
         ).fetchall()
-    return [dict(r) for r in rows]
+    items = [dict(r) for r in rows]
 
-def sum_day(db_path: str, user_id: int, date_yyyy_mm_dd: str) -> dict[str, float]:
-    # Sum for a UTC day; for simplicity in MVP (timezone can adjust later)
-    start = f"{date_yyyy_mm_dd}T00:00:00+0000"
-    end = f"{date_yyyy_mm_dd}T23:59:59+0000"
+    with _recent_lock:
+        if gen == _recent_gen:
+            _recent_cache[user_id] = items[:RECENT_CACHE_DEPTH]
+            _recent_cache.move_to_end(user_id)
+            while len(_recent_cache) > RECENT_CACHE_USERS:
+                _recent_cache.popitem(last=False)
+    return [dict(it) for it in items[:limit]]
+
+# Macros of every product in flat arrays for summaries; see nutrition.MacroTable.
+_macros = MacroTable()
+_macros_lock = threading.Lock()
+
+def _ensure_macros(conn: sqlite3.Connection, ref_types: Iterable[str], ref_ids: Iterable[int]) -> None:
+    if not _macros.loaded:
+        with _macros_lock:
+            if not _macros.loaded:
+                _macros.load(
+                    conn.execute("SELECT id, kcal, p, f, c FROM products_global"),
+                    conn.execute("SELECT id, user_id, kcal, p, f, c FROM products_user"),
+                )
+    # products inserted by another process (or committed during the load) since
+    by_type: dict[str, list[int]] = {"global": [], "user": []}
+    for t, i in zip(ref_types, ref_ids):
+        by_type.setdefault(t, []).append(i)
+    for ref_type, table, cols in (("global", "products_global", "id, 0, kcal, p, f, c"), ("user", "products_user", "id, user_id, kcal, p, f, c")):
+        missing = _macros.missing(ref_type, by_type[ref_type])
+        for lo in range(0, len(missing), 500):
+            chunk = missing[lo:lo + 500]
+            rows = conn.execute(f"SELECT {cols} FROM {table} WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+            for pid, owner, kcal, p, f, c in rows:
+                _macros.put(ref_type, pid, kcal, p, f, c, owner)
+
+def sum_range(db_path: str, user_id: int, start: str, end: str) -> dict[str, float]:
+    """kcal/p/f/c eaten by the user with start <= eaten_at <= end (ISO strings)."""
     with connect(db_path) as conn:
-        rows = conn.execute(
+        rows = _tuples(
+            conn,
             "SELECT product_ref_type, product_ref_id, grams FROM food_log WHERE user_id=? AND eaten_at BETWEEN ? AND ?",
             (user_id, start, end),
-        ).fetchall()
-    total = {"kcal": 0.0, "p": 0.0, "f": 0.0, "c": 0.0}
-    for r in rows:
-        prod = get_product(db_path, r["product_ref_type"], int(r["product_ref_id"]), user_id)
-        if not prod:
-            continue
-        grams = float(r["grams"])
-        factor = grams / 100.0
-        total["kcal"] += float(prod["kcal"]) * factor
-        total["p"] += float(prod["p"]) * factor
-        total["f"] += float(prod["f"]) * factor
-        total["c"] += float(prod["c"]) * factor
+        )
+        if not rows:
+            return {"kcal": 0.0, "p": 0.0, "f": 0.0, "c": 0.0}
+        ref_types, ref_ids, grams = zip(*rows)
+        _ensure_macros(conn, ref_types, ref_ids)
+    return _macros.totals(user_id, ref_types, ref_ids, [float(g or 0) for g in grams])
+
+def sum_day(db_path: str, user_id: int, date_yyyy_mm_dd: str) -> dict[str, float]:
+    # Sum for a UTC day; for simplicity in MVP (timezone can adjust later)
+    return sum_range(db_path, user_id, f"{date_yyyy_mm_dd}T00:00:00+0000", f"{date_yyyy_mm_dd}T23:59:59+0000")
+
+# kcal/p/f/c per (user, UTC day) for "remaining today": filled by day_totals() on
+# a miss, advanced by add_food_log, dropped by diary edits. Like _recent_cache
+# it is per process, which holds because all updates of a user go to one process.
+# Values are [kcal, p, f, c, gen]: gen is _day_totals_gen when the miss started.
+DAY_TOTALS_CACHE = 20000
+_day_totals: OrderedDict[tuple[int, str], list[float]] = OrderedDict()
+_day_totals_lock = threading.Lock()
+_day_totals_gen = 0  # bumped by every change, so a miss computed concurrently isn't stored stale
+
+def day_totals(db_path: str, user_id: int, day: str) -> dict[str, float]:
+    """Like sum_day(), but a dict lookup after the first call of the day."""
+    key = (user_id, day)
+    with _day_totals_lock:
+        v = _day_totals.get(key)
+        if v is not None:
+            _day_totals.move_to_end(key)
+            return dict(zip(nutrition.MACROS, v))
+        gen = _day_totals_gen
+    total = sum_day(db_path, user_id, day)
+    with _day_totals_lock:
+        if gen == _day_totals_gen:
+            _day_totals[key] = [total[k] for k in nutrition.MACROS] + [gen]
+            while len(_day_totals) > DAY_TOTALS_CACHE:
+                _day_totals.popitem(last=False)
     return total
 
-def create_payment(db_path: str, user_id: int, provider: str, amount: float, currency: str, provider_payment_id: str, idempotency_key: str, status: str = "pending", meta: dict[str, Any] | None = None) -> int:
+def _day_totals_add(conn: sqlite3.Connection, user_id: int, day: str, ref_type: str, ref_id: int, grams: float) -> None:
+    global _day_totals_gen
+    key = (user_id, day)
+    with _day_totals_lock:
+        _day_totals_gen += 1
+        gen = _day_totals_gen
+        cached = key in _day_totals
+    add = None
+    if cached:
+        _ensure_macros(conn, (ref_type,), (ref_id,))
+        add = _macros.totals(user_id, (ref_type,), (ref_id,), (grams,))
+
+    def apply() -> None:
+        # applied after COMMIT: a total from a miss started before `gen` was read
+        # without this row and is advanced; a later one may or may not include it
+        with _day_totals_lock:
+            v = _day_totals.get(key)
+            if v is None:
+                return
+            if add is None or v[-1] >= gen:
+                del _day_totals[key]
+                return
+            for i, k in enumerate(nutrition.MACROS):
+                v[i] += add[k]
+
+    after_commit(apply)
+
+def _day_totals_drop(user_ids: Iterable[int] | None = None, day: str | None = None) -> None:
+    """Forget cached totals: one day of a user, all days of some users, or everything."""
+    global _day_totals_gen
+    with _day_totals_lock:
+        _day_totals_gen += 1
+        if user_ids is None:
+            _day_totals.clear()
+            return
+        users = set(user_ids)
+        if day is not None:
+            for u in users:
+                _day_totals.pop((u, day), None)
+            return
+        for key in [k for k in _day_totals if k[0] in users]:
+            del _day_totals[key]
+
+MEAL_BITS = {"breakfast": 1, "lunch": 2, "dinner": 4, "snack": 8}
+DAILY_TOTALS_WATERMARK = "daily_totals_food_log_id"
+# bumped when a food_log row past the watermark is edited, deleted or restored
+DAILY_TOTALS_EDITS = "daily_totals_edits"
+
+def _merge_daily_totals(conn: sqlite3.Connection, rows: list[tuple], after: int, watermark: int, edits: str | None = None) -> bool:
+    # another process may have folded the same chunk in the meantime,
+    # or a row of the chunk was edited after we read it
+    if int(get_setting(conn, DAILY_TOTALS_WATERMARK, "0") or 0) != after:
+        return False
+    if get_setting(conn, DAILY_TOTALS_EDITS) != edits:
+        return False
+    conn.executemany(
+        '''
+        INSERT INTO daily_totals(user_id, day, kcal, p, f, c, entries, meals) VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id, day) DO UPDATE SET
+            kcal=kcal+excluded.kcal, p=p+excluded.p, f=f+excluded.f, c=c+excluded.c,
+            entries=entries+excluded.entries, meals=meals|excluded.meals
+        ''',
+        rows,
+    )
+    set_setting(conn, DAILY_TOTALS_WATERMARK, str(watermark))
+    return True
+
+def rollup_daily_totals(db_path: str, chunk_size: int = 50_000, should_stop: Callable[[], bool] | None = None) -> int:
+    """Fold food_log rows past the watermark into daily_totals, chunk by chunk. Returns rows processed."""
+    done = 0
+    while not (should_stop and should_stop()):
+        with connect(db_path) as conn:
+            after = int(get_setting(conn, DAILY_TOTALS_WATERMARK, "0") or 0)
+            edits = get_setting(conn, DAILY_TOTALS_EDITS)
+            rows = _tuples(
+                conn,
+                "SELECT id, user_id, product_ref_type, product_ref_id, grams, meal, substr(eaten_at, 1, 10) FROM food_log WHERE id>? ORDER BY id LIMIT ?",
+                (after, chunk_size),
+            )
+            if not rows:
+                return done
+            ids, users, ref_types, ref_ids, grams, meals, days = zip(*rows)
+            _ensure_macros(conn, ref_types, ref_ids)
+        kcal, p, f, c = _macros.per_row(ref_types, ref_ids, [float(g or 0) for g in grams])
+
+        acc: dict[tuple[int, str], list] = {}
+        for k in range(len(ids)):
+            key = (users[k], days[k])
+            a = acc.get(key)
+            if a is None:
+                a = acc[key] = [0.0, 0.0, 0.0, 0.0, 0, 0]
+            a[0] += kcal[k]
+            a[1] += p[k]
+            a[2] += f[k]
+            a[3] += c[k]
+            a[4] += 1
+            a[5] |= MEAL_BITS.get(meals[k], 0)
+        if write(db_path, _merge_daily_totals, [(u, d, *a) for (u, d), a in acc.items()], after, ids[-1], edits):
+            done += len(ids)
+    return done
+
+def daily_totals_stats(db_path: str, kcal_bin: float = 50.0, cohorts: int = 8) -> dict[str, Any]:
+    """Raw population aggregates over daily_totals; popstats turns them into percentiles and rates."""
     with connect(db_path) as conn:
-        cur = conn.execute(
-            "INSERT INTO payments(user_id, provider, amount, currency, status, provider_payment_id, idempotency_key, created_at, updated_at, meta_json) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (user_id, provider, amount, currency, status, provider_payment_id, idempotency_key, utcnow(), utcnow(), json.dumps(meta or {}, ensure_ascii=False)),
-        )
-        conn.commit()
-        return int(cur.lastrowid)
+        row = conn.execute(
+            '''
+            SELECT COUNT(*) AS days, COUNT(DISTINCT user_id) AS users,
+                   SUM(kcal) AS kcal, SUM(p) AS p, SUM(f) AS f, SUM(c) AS c,
+                   SUM(meals & 1 > 0) AS breakfast, SUM(meals & 2 > 0) AS lunch,
+                   SUM(meals & 4 > 0) AS dinner, SUM(meals & 8 > 0) AS snack,
+                   SUM(meals & 7 = 7) AS three_meals
+            FROM daily_totals
+            '''
+        ).fetchone()
+        hist = conn.execute(
+            "SELECT CAST(kcal / ? AS INTEGER) AS b, COUNT(*) AS n FROM daily_totals GROUP BY b ORDER BY b",
+            (kcal_bin,),
+        ).fetchall()
+        # signup week = Monday on or before created_at
+        sizes = conn.execute(
+            '''
+            SELECT date(substr(created_at, 1, 10), '-6 days', 'weekday 1') AS cohort, COUNT(*) AS n
+            FROM users WHERE created_at IS NOT NULL
+            GROUP BY cohort ORDER BY cohort DESC LIMIT ?
+            ''',
+            (cohorts,),
+        ).fetchall()
+        retention = []
+        if sizes:
+            retention = conn.execute(
+                '''
+                SELECT cohort, CAST((julianday(d.day) - julianday(cohort)) / 7 AS INTEGER) AS week,
+                       COUNT(DISTINCT d.user_id) AS n
+                FROM (
+                    SELECT user_id, date(substr(created_at, 1, 10), '-6 days', 'weekday 1') AS cohort
+                    FROM users WHERE created_at >= ?
+                ) u
+                JOIN daily_totals d ON d.user_id = u.user_id AND d.day >= u.cohort
+                GROUP BY cohort, week
+                ''',
+                (sizes[-1]["cohort"],),
+            ).fetchall()
+        watermark = int(get_setting(conn, DAILY_TOTALS_WATERMARK, "0") or 0)
+    return {
+        "totals": dict(row),
+        "kcal_bin": kcal_bin,
+        "kcal_hist": [(int(r["b"]), int(r["n"])) for r in hist],
+        "cohort_sizes": [(r["cohort"], int(r["n"])) for r in sizes],
+        "retention": [(r["cohort"], int(r["week"]), int(r["n"])) for r in retention],
+        "watermark": watermark,
+    }
 
-def update_payment_status(db_path: str, provider_payment_id: str, status: str, meta: dict[str, Any] | None = None) -> None:
+# Diary: keyset-paged views of food_log and edits that keep the derived tables in sync
+
+# food_log joined with its product (macros per 100 g); {where} continues "WHERE l.user_id=?"
+_ENTRY_SQL = '''
+    SELECT l.id, l.product_ref_type AS ref_type, l.product_ref_id AS ref_id, l.grams, l.meal, l.eaten_at,
+           COALESCE(pu.name_ru, pg.name_ru) AS name_ru,
+           COALESCE(pu.name_en, pg.name_en) AS name_en,
+           COALESCE(pu.kcal, pg.kcal) AS kcal,
+           COALESCE(pu.p, pg.p) AS p,
+           COALESCE(pu.f, pg.f) AS f,
+           COALESCE(pu.c, pg.c) AS c
+    FROM food_log l
+    LEFT JOIN products_user pu ON l.product_ref_type='user' AND pu.id=l.product_ref_id AND pu.user_id=l.user_id
+    LEFT JOIN products_global pg ON l.product_ref_type='global' AND pg.id=l.product_ref_id
+    WHERE l.user_id=? {where}
+'''
+
+_FOOD_LOG_COLS = ("id", "user_id", "product_ref_type", "product_ref_id", "grams", "meal", "eaten_at")
+
+def diary_page(db_path: str, user_id: int, start: str, end: str, cursor: tuple[str, int] | None = None,
+               limit: int = 10, newest_first: bool = False) -> tuple[list[dict[str, Any]], tuple[str, int] | None]:
+    """
+    Entries with start <= eaten_at < end, one page after cursor = (eaten_at, id)
+    of the previous page's last entry. Each page is a seek on
+    idx_food_log_user_time, so page 100 costs the same as page 1.
+    Returns the entries and the cursor of the next page (None on the last one).
+    """
+    op, order = ("<", "DESC") if newest_first else (">", "ASC")
+    # the cursor's eaten_at becomes the index range bound (inclusive, ties are
+    # settled by id); as a filter only, SQLite would walk every earlier page
+    if not cursor:
+        where = "AND l.eaten_at >= ? AND l.eaten_at < ?"
+        params: list[Any] = [user_id, start, end]
+    elif newest_first:
+        where = "AND l.eaten_at >= ? AND l.eaten_at <= ?"
+        params = [user_id, start, cursor[0]]
+    else:
+        where = "AND l.eaten_at >= ? AND l.eaten_at < ?"
+        params = [user_id, cursor[0], end]
+    if cursor:
+        where += f" AND (l.eaten_at, l.id) {op} (?, ?)"
+        params += cursor
+    where += f" ORDER BY l.eaten_at {order}, l.id {order} LIMIT ?"
+    params.append(limit + 1)
+    with connect(db_path) as conn:
+        rows = conn.execute(_ENTRY_SQL.format(where=where), params).fetchall()
+    items = [dict(r) for r in rows[:limit]]
+    return items, ((items[-1]["eaten_at"], items[-1]["id"]) if len(rows) > limit else None)
+
+def get_food_log_entry(db_path: str, user_id: int, entry_id: int) -> dict[str, Any] | None:
     with connect(db_path) as conn:
+        row = conn.execute(_ENTRY_SQL.format(where="AND l.id=?"), (user_id, entry_id)).fetchone()
+    return dict(row) if row else None
+
+def _food_log_row(conn: sqlite3.Connection, user_id: int, entry_id: int) -> dict[str, Any] | None:
+    row = conn.execute(
+        f"SELECT {', '.join(_FOOD_LOG_COLS)} FROM food_log WHERE id=? AND user_id=?", (entry_id, user_id)
+    ).fetchone()
+    return dict(row) if row else None
+
+def update_food_log(db_path: str, user_id: int, entry_id: int, grams: float | None = None, meal: str | None = None) -> dict[str, Any] | None:
+    """Change grams and/or meal. Returns the row as it was before (for undo), None if there is no such entry."""
+    return write(db_path, _update_food_log, user_id, entry_id, grams, meal)
+
+def _update_food_log(conn: sqlite3.Connection, user_id: int, entry_id: int, grams: float | None, meal: str | None) -> dict[str, Any] | None:
+    old = _food_log_row(conn, user_id, entry_id)
+    if old is None:
+        return None
+    conn.execute("UPDATE food_log SET grams=COALESCE(?, grams), meal=COALESCE(?, meal) WHERE id=?", (grams, meal, entry_id))
+    _food_log_changed(conn, old)
+    return old
+
+def delete_food_log(db_path: str, user_id: int, entry_id: int) -> dict[str, Any] | None:
+    """Delete an entry. Returns the deleted row (for undo), None if there is no such entry."""
+    return write(db_path, _delete_food_log, user_id, entry_id)
+
+def _delete_food_log(conn: sqlite3.Connection, user_id: int, entry_id: int) -> dict[str, Any] | None:
+    old = _food_log_row(conn, user_id, entry_id)
+    if old is None:
+        return None
+    conn.execute("DELETE FROM food_log WHERE id=?", (entry_id,))
+    if old["product_ref_type"] == "global":
+        conn.execute("UPDATE products_global SET popularity=MAX(popularity-1, 0) WHERE id=?", (old["product_ref_id"],))
+    _food_log_changed(conn, old)
+    return old
+
+def restore_food_log(db_path: str, row: dict[str, Any]) -> bool:
+    """Undo: put back a row returned by delete_food_log (same id) or update_food_log (old grams/meal)."""
+    return write(db_path, _restore_food_log, row)
+
+def _restore_food_log(conn: sqlite3.Connection, row: dict[str, Any]) -> bool:
+    cur = conn.execute("SELECT user_id FROM food_log WHERE id=?", (row["id"],)).fetchone()
+    if cur is None:
         conn.execute(
-            "UPDATE payments SET status=?, updated_at=?, meta_json=? WHERE provider_payment_id=?",
-            (status, utcnow(), json.dumps(meta or {}, ensure_ascii=False), provider_payment_id),
+            f"INSERT INTO food_log({', '.join(_FOOD_LOG_COLS)}) VALUES({', '.join('?' * len(_FOOD_LOG_COLS))})",
+            [row[k] for k in _FOOD_LOG_COLS],
         )
-        conn.commit()
+        if row["product_ref_type"] == "global":
+            conn.execute("UPDATE products_global SET popularity=popularity+1 WHERE id=?", (row["product_ref_id"],))
+    elif cur[0] == row["user_id"]:
+        conn.execute("UPDATE food_log SET grams=?, meal=? WHERE id=?", (row["grams"], row["meal"], row["id"]))
+    else:
+        return False
+    _food_log_changed(conn, row)
+    return True
+
+def _food_log_changed(conn: sqlite3.Connection, row: dict[str, Any]) -> None:
+    """Bring user_product_stats, the MRU cache and daily_totals in line after `row` was edited, deleted or restored."""
+    user_id = row["user_id"]
+    _refresh_product_stats(conn, user_id, row["product_ref_type"], row["product_ref_id"])
+    after_commit(lambda: _forget_user_caches(user_id, row["eaten_at"][:10]))
+    watermark = int(get_setting(conn, DAILY_TOTALS_WATERMARK, "0") or 0)
+    if row["id"] <= watermark:
+        _recompute_daily_total(conn, user_id, row["eaten_at"][:10], watermark)
+    else:
+        # not rolled up yet, but a rollup chunk read before this edit must not be merged
+        _bump_daily_totals_edits(conn)
+
+def _forget_user_caches(user_id: int, day: str | None = None) -> None:
+    """Drop the MRU and the cached day totals (one day or all) of a user."""
+    global _recent_gen
+    with _recent_lock:
+        _recent_gen += 1
+        _recent_cache.pop(user_id, None)
+    _day_totals_drop((user_id,), day)
+
+def _bump_daily_totals_edits(conn: sqlite3.Connection) -> None:
+    set_setting(conn, DAILY_TOTALS_EDITS, str(int(get_setting(conn, DAILY_TOTALS_EDITS, "0") or 0) + 1))
+
+def _refresh_product_stats(conn: sqlite3.Connection, user_id: int, ref_type: str, ref_id: int) -> None:
+    # one user's uses of one product: a short range of idx_food_log_user_ref
+    rows = conn.execute(
+        "SELECT grams, meal, eaten_at FROM food_log WHERE user_id=? AND product_ref_type=? AND product_ref_id=? ORDER BY id",
+        (user_id, ref_type, ref_id),
+    ).fetchall()
+    if not rows:
+        conn.execute("DELETE FROM user_product_stats WHERE user_id=? AND ref_type=? AND ref_id=?", (user_id, ref_type, ref_id))
+        return
+    last = rows[-1]
+    conn.execute(
+        '''
+        INSERT INTO user_product_stats(user_id, ref_type, ref_id, uses, score, last_used, last_grams, last_meal)
+        VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id, ref_type, ref_id) DO UPDATE SET
+            uses=excluded.uses, score=excluded.score, last_used=excluded.last_used,
+            last_grams=excluded.last_grams, last_meal=excluded.last_meal
+        ''',
+        (
+            user_id, ref_type, ref_id, len(rows), sum(use_weight(_iso_ts(r["eaten_at"])) for r in rows),
+            _iso_ts(last["eaten_at"]), last["grams"], last["meal"],
+        ),
+    )
+
+def _recompute_daily_total(conn: sqlite3.Connection, user_id: int, day: str, watermark: int) -> None:
+    rows = _tuples(
+        conn,
+        "SELECT product_ref_type, product_ref_id, grams, meal FROM food_log WHERE user_id=? AND eaten_at>=? AND eaten_at<? AND id<=?",
+        (user_id, day, (date.fromisoformat(day) + timedelta(days=1)).isoformat(), watermark),
+    )
+    if not rows:
+        conn.execute("DELETE FROM daily_totals WHERE user_id=? AND day=?", (user_id, day))
+        return
+    ref_types, ref_ids, grams, meals = zip(*rows)
+    _ensure_macros(conn, ref_types, ref_ids)
+    kcal, p, f, c = _macros.per_row(ref_types, ref_ids, [float(g or 0) for g in grams])
+    bits = 0
+    for m in meals:
+        bits |= MEAL_BITS.get(m, 0)
+    conn.execute(
+        "INSERT OR REPLACE INTO daily_totals(user_id, day, kcal, p, f, c, entries, meals) VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+        (user_id, day, sum(kcal), sum(p), sum(f), sum(c), len(rows), bits),
+    )
+
+# Recipes: products_user rows with is_recipe=1. Their per-100 g macros are
+# computed from recipe_items when the recipe changes, so logging a recipe is one
+# food_log row and summaries read it like any other product.
+
+def create_recipe(db_path: str, user_id: int, name_ru: str, name_en: str, items: list[tuple[str, int, float]], total_grams: float | None = None) -> int:
+    """items: (ref_type, ref_id, grams). Raises ValueError for an unknown or foreign ingredient."""
+    return write(db_path, _create_recipe, user_id, name_ru, name_en, items, total_grams)
+
+def _create_recipe(conn: sqlite3.Connection, user_id: int, name_ru: str, name_en: str, items: list[tuple[str, int, float]], total_grams: float | None) -> int:
+    cur = conn.execute(
+        "INSERT INTO products_user(user_id, name_ru, name_en, kcal, p, f, c, created_at, is_recipe, total_grams) VALUES(?, ?, ?, 0, 0, 0, 0, ?, 1, ?)",
+        (user_id, name_ru, name_en, utcnow(), total_grams),
+    )
+    recipe_id = int(cur.lastrowid)
+    for ref_type, ref_id, grams in items:
+        _put_recipe_item(conn, user_id, recipe_id, ref_type, ref_id, grams)
+    _recalc_recipe(conn, recipe_id)
+    return recipe_id
+
+def set_recipe_item(db_path: str, user_id: int, recipe_id: int, ref_type: str, ref_id: int, grams: float) -> list[tuple]:
+    """
+    Set an ingredient's grams (0 removes it). Returns (id, kcal, p, f, c) of every
+    recipe whose macros were recomputed: this one and the recipes containing it.
+    """
+    return write(db_path, _set_recipe_item, user_id, recipe_id, ref_type, ref_id, grams)
+
+def _set_recipe_item(conn: sqlite3.Connection, user_id: int, recipe_id: int, ref_type: str, ref_id: int, grams: float) -> list[tuple]:
+    _own_recipe(conn, user_id, recipe_id)
+    if grams > 0:
+        _put_recipe_item(conn, user_id, recipe_id, ref_type, ref_id, grams)
+    else:
+        conn.execute("DELETE FROM recipe_items WHERE recipe_id=? AND ref_type=? AND ref_id=?", (recipe_id, ref_type, ref_id))
+    return _recalc_recipe(conn, recipe_id)
+
+def set_recipe_yield(db_path: str, user_id: int, recipe_id: int, total_grams: float | None) -> list[tuple]:
+    """Cooked weight of the whole recipe (None = sum of the ingredients). Returns recomputed recipes like set_recipe_item."""
+    return write(db_path, _set_recipe_yield, user_id, recipe_id, total_grams)
+
+def _set_recipe_yield(conn: sqlite3.Connection, user_id: int, recipe_id: int, total_grams: float | None) -> list[tuple]:
+    _own_recipe(conn, user_id, recipe_id)
+    conn.execute("UPDATE products_user SET total_grams=? WHERE id=?", (total_grams or None, recipe_id))
+    return _recalc_recipe(conn, recipe_id)
+
+def get_recipe(db_path: str, user_id: int, recipe_id: int) -> dict[str, Any] | None:
+    """The recipe row with its items (names, grams and macros per 100 g of each ingredient)."""
+    with connect(db_path) as conn:
+        row = conn.execute(
+            "SELECT id, name_ru, name_en, kcal, p, f, c, total_grams FROM products_user WHERE id=? AND user_id=? AND is_recipe=1",
+            (recipe_id, user_id),
+        ).fetchone()
+        if row is None:
+            return None
+        items = conn.execute(
+            '''
+            SELECT ri.ref_type, ri.ref_id, ri.grams,
+                   COALESCE(pu.name_ru, pg.name_ru) AS name_ru, COALESCE(pu.name_en, pg.name_en) AS name_en,
+                   COALESCE(pu.kcal, pg.kcal) AS kcal
+            FROM recipe_items ri
+            LEFT JOIN products_user pu ON ri.ref_type='user' AND pu.id=ri.ref_id
+            LEFT JOIN products_global pg ON ri.ref_type='global' AND pg.id=ri.ref_id
+            WHERE ri.recipe_id=?
+            ORDER BY ri.grams DESC
+            ''',
+            (recipe_id,),
+        ).fetchall()
+    out = dict(row)
+    out["items"] = [dict(r) for r in items]
+    out["weight"] = out["total_grams"] or sum(it["grams"] for it in out["items"])
+    return out
+
+def _own_recipe(conn: sqlite3.Connection, user_id: int, recipe_id: int) -> None:
+    if conn.execute("SELECT 1 FROM products_user WHERE id=? AND user_id=? AND is_recipe=1", (recipe_id, user_id)).fetchone() is None:
+        raise ValueError(f"recipe {recipe_id} of user {user_id} not found")
+
+def _put_recipe_item(conn: sqlite3.Connection, user_id: int, recipe_id: int, ref_type: str, ref_id: int, grams: float) -> None:
+    if ref_type == "user":
+        ok = conn.execute("SELECT 1 FROM products_user WHERE id=? AND user_id=?", (ref_id, user_id)).fetchone()
+        if ok and _recipe_contains(conn, ref_id, recipe_id):
+            raise ValueError("a recipe can't contain itself")
+    else:
+        ok = conn.execute("SELECT 1 FROM products_global WHERE id=?", (ref_id,)).fetchone()
+    if ok is None:
+        raise ValueError(f"unknown ingredient {ref_type}:{ref_id}")
+    conn.execute(
+        "INSERT INTO recipe_items(recipe_id, ref_type, ref_id, grams) VALUES(?, ?, ?, ?) ON CONFLICT(recipe_id, ref_type, ref_id) DO UPDATE SET grams=excluded.grams",
+        (recipe_id, ref_type, ref_id, float(grams)),
+    )
+
+def _recipe_contains(conn: sqlite3.Connection, product_id: int, target: int) -> bool:
+    """True if user product product_id is target or uses it, directly or through nested recipes."""
+    todo, seen = [product_id], set()
+    while todo:
+        pid = todo.pop()
+        if pid == target:
+            return True
+        if pid in seen:
+            continue
+        seen.add(pid)
+        todo += [r[0] for r in conn.execute("SELECT ref_id FROM recipe_items WHERE recipe_id=? AND ref_type='user'", (pid,))]
+    return False
+
+def _recipe_macros(conn: sqlite3.Connection, recipe_id: int, total_grams: float | None) -> tuple[float, float, float, float]:
+    items = conn.execute(
+        '''
+        SELECT ri.grams, COALESCE(pu.kcal, pg.kcal), COALESCE(pu.p, pg.p), COALESCE(pu.f, pg.f), COALESCE(pu.c, pg.c)
+        FROM recipe_items ri
+        LEFT JOIN products_user pu ON ri.ref_type='user' AND pu.id=ri.ref_id
+        LEFT JOIN products_global pg ON ri.ref_type='global' AND pg.id=ri.ref_id
+        WHERE ri.recipe_id=?
+        ''',
+        (recipe_id,),
+    ).fetchall()
+    weight = total_grams or sum(r[0] for r in items)
+    if not weight:
+        return 0.0, 0.0, 0.0, 0.0
+    return tuple(sum(r[0] * (r[k] or 0) for r in items) / weight for k in range(1, 5))
+
+def _recalc_recipe(conn: sqlite3.Connection, recipe_id: int) -> list[tuple]:
+    """Recompute a recipe, then every recipe containing it. Returns [(id, kcal, p, f, c)]."""
+    changed: dict[int, tuple] = {}
+    todo = [recipe_id]
+    while todo:
+        # no `seen`: with diamonds a recipe is recomputed again after each of its
+        # changed ingredients; recipes can't contain themselves, so this ends
+        rid = todo.pop(0)
+        row = conn.execute("SELECT user_id, total_grams FROM products_user WHERE id=? AND is_recipe=1", (rid,)).fetchone()
+        if row is None:
+            continue
+        kcal, p, f, c = _recipe_macros(conn, rid, row["total_grams"])
+        conn.execute("UPDATE products_user SET kcal=?, p=?, f=?, c=? WHERE id=?", (kcal, p, f, c, rid))
+        # the new macros are needed now, by _recompute_daily_total below
+        _macros.put("user", rid, kcal, p, f, c, row["user_id"])
+        on_rollback(lambda rid=rid: _macros.forget("user", rid))
+        _product_macros_changed(conn, row["user_id"], "user", rid)
+        changed[rid] = (rid, kcal, p, f, c)
+        todo += [r[0] for r in conn.execute("SELECT recipe_id FROM recipe_items WHERE ref_type='user' AND ref_id=?", (rid,))]
+    return list(changed.values())
+
+def _product_macros_changed(conn: sqlite3.Connection, user_id: int, ref_type: str, ref_id: int) -> None:
+    """Per-100 g macros of a user's product changed: refresh what was computed from the old ones."""
+    after_commit(lambda: _forget_user_caches(user_id))
+    watermark = int(get_setting(conn, DAILY_TOTALS_WATERMARK, "0") or 0)
+    days = conn.execute(
+        "SELECT DISTINCT substr(eaten_at, 1, 10) FROM food_log WHERE user_id=? AND product_ref_type=? AND product_ref_id=? AND id<=?",
+        (user_id, ref_type, ref_id, watermark),
+    ).fetchall()
+    for (day,) in days:
+        _recompute_daily_total(conn, user_id, day, watermark)
+    _bump_daily_totals_edits(conn)
+
+_PROFILE_FIELDS = ("sex", "age", "weight", "height", "activity", "goal")
+
+def get_profile(db_path: str, user_id: int) -> dict[str, Any] | None:
+    with connect(db_path) as conn:
+        row = conn.execute("SELECT * FROM user_profiles WHERE user_id=?", (user_id,)).fetchone()
+    return dict(row) if row else None
+
+def save_profile(db_path: str, user_id: int, **fields: Any) -> dict[str, Any]:
+    """Update some of sex/age/weight/height/activity/goal and recompute the targets. Returns the profile."""
+    return write(db_path, _save_profile, user_id, fields)
+
+def _save_profile(conn: sqlite3.Connection, user_id: int, fields: dict[str, Any]) -> dict[str, Any]:
+    row = conn.execute("SELECT * FROM user_profiles WHERE user_id=?", (user_id,)).fetchone()
+    prof = dict(row) if row else {"user_id": user_id, "activity": "moderate", "goal": "maint"}
+    prof.update({k: v for k, v in fields.items() if k in _PROFILE_FIELDS})
+    if all(prof.get(k) is not None for k in _PROFILE_FIELDS):
+        prof.update(nutrition.daily_targets(*(prof[k] for k in _PROFILE_FIELDS)))
+    prof["updated_at"] = utcnow()
+    cols = ("user_id", *_PROFILE_FIELDS, *nutrition.MACROS, "updated_at")
+    conn.execute(
+        f"INSERT OR REPLACE INTO user_profiles({', '.join(cols)}) VALUES({', '.join('?' * len(cols))})",
+        [prof.get(k) for k in cols],
+    )
+    return prof
+
+def create_payment(db_path: str, user_id: int, provider: str, amount: float, currency: str, provider_payment_id: str, idempotency_key: str, status: str = "pending", meta: dict[str, Any] | None = None) -> int:
+    return write(db_path, _create_payment, user_id, provider, amount, currency, provider_payment_id, idempotency_key, status, meta)
+
+def _create_payment(conn: sqlite3.Connection, user_id: int, provider: str, amount: float, currency: str, provider_payment_id: str, idempotency_key: str, status: str = "pending", meta: dict[str, Any] | None = None) -> int:
+    cur = conn.execute(
+        "INSERT INTO payments(user_id, provider, amount, currency, status, provider_payment_id, idempotency_key, created_at, updated_at, meta_json) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (user_id, provider, amount, currency, status, provider_payment_id, idempotency_key, utcnow(), utcnow(), json.dumps(meta or {}, ensure_ascii=False)),
+    )
+    return int(cur.lastrowid)
+
+def update_payment_status(db_path: str, provider_payment_id: str, status: str, meta: dict[str, Any] | None = None) -> None:
+    write(db_path, _update_payment_status, provider_payment_id, status, meta)
+
+def _update_payment_status(conn: sqlite3.Connection, provider_payment_id: str, status: str, meta: dict[str, Any] | None = None) -> None:
+    conn.execute(
+        "UPDATE payments SET status=?, updated_at=?, meta_json=? WHERE provider_payment_id=?",
+        (status, utcnow(), json.dumps(meta or {}, ensure_ascii=False), provider_payment_id),
+    )
+
+# a payment in one of these never changes again, whatever notification arrives late
+PAYMENT_FINAL = ("succeeded", "canceled")
+
+def apply_payment_status(db_path: str, provider_payment_id: str, status: str, meta: dict[str, Any] | None = None) -> str:
+    """
+    Idempotent status change for provider notifications, which may be delivered
+    twice or out of order. Returns "applied", "duplicate" (already in this
+    status), "stale" (already final) or "unknown" (no such payment).
+    """
+    return write(db_path, _apply_payment_status, provider_payment_id, status, meta)
+
+def _apply_payment_status(conn: sqlite3.Connection, provider_payment_id: str, status: str, meta: dict[str, Any] | None = None) -> str:
+    cur = conn.execute(
+        f"UPDATE payments SET status=?, updated_at=?, meta_json=? WHERE provider_payment_id=? AND status<>? AND status NOT IN ({','.join('?' * len(PAYMENT_FINAL))})",
+        (status, utcnow(), json.dumps(meta or {}, ensure_ascii=False), provider_payment_id, status, *PAYMENT_FINAL),
+    )
+    if cur.rowcount:
+        return "applied"
+    row = conn.execute("SELECT status FROM payments WHERE provider_payment_id=?", (provider_payment_id,)).fetchone()
+    if row is None:
+        return "unknown"
+    return "duplicate" if row["status"] == status else "stale"
 
 def get_payment_by_provider_id(db_path: str, provider_payment_id: str) -> sqlite3.Row | None:
     with connect(db_path) as conn:
@@ -345,12 +1561,13 @@ def list_feedback(db_path: str, status: str = "new", limit: int = 20) -> list[sq
         ).fetchall()
 
 def add_feedback(db_path: str, user_id: int, message: str, rating: int | None = None) -> None:
-    with connect(db_path) as conn:
-        conn.execute(
-            "INSERT INTO feedback(user_id, message, rating, status, created_at) VALUES(?, ?, ?, 'new', ?)",
-            (user_id, message, rating, utcnow()),
-        )
-        conn.commit()
+    write(db_path, _add_feedback, user_id, message, rating)
+
+def _add_feedback(conn: sqlite3.Connection, user_id: int, message: str, rating: int | None = None) -> None:
+    conn.execute(
+        "INSERT INTO feedback(user_id, message, rating, status, created_at) VALUES(?, ?, ?, 'new', ?)",
+        (user_id, message, rating, utcnow()),
+    )
 
 def analytics_snapshot(db_path: str) -> dict[str, Any]:
     with connect(db_path) as conn:
@@ -367,3 +1584,82 @@ def analytics_snapshot(db_path: str) -> dict[str, Any]:
         "active_7d": active_7d,
         "top_events": [(r["event_name"], int(r["n"])) for r in top_events],
     }
+
+def mark_user_blocked(db_path: str, user_id: int) -> None:
+    write(db_path, _mark_user_blocked, user_id)
+
+def _mark_user_blocked(conn: sqlite3.Connection, user_id: int) -> None:
+    conn.execute("UPDATE users SET blocked_at=? WHERE user_id=? AND blocked_at IS NULL", (utcnow(), user_id))
+
+def create_broadcast(db_path: str, created_by_user_id: int, kind: str, text: str, local_time: str | None = None) -> int:
+    return write(db_path, _create_broadcast, created_by_user_id, kind, text, local_time)
+
+def _create_broadcast(conn: sqlite3.Connection, created_by_user_id: int, kind: str, text: str, local_time: str | None = None) -> int:
+    cur = conn.execute(
+        "INSERT INTO broadcasts(kind, text, local_time, status, created_by_user_id, created_at) VALUES(?, ?, ?, 'active', ?, ?)",
+        (kind, text, local_time, created_by_user_id, utcnow()),
+    )
+    return int(cur.lastrowid)
+
+def list_broadcasts(db_path: str, status: str | None = None, limit: int = 20) -> list[sqlite3.Row]:
+    with connect(db_path) as conn:
+        if status:
+            return conn.execute(
+                "SELECT * FROM broadcasts WHERE status=? ORDER BY id DESC LIMIT ?", (status, limit)
+            ).fetchall()
+        return conn.execute("SELECT * FROM broadcasts ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+
+def set_broadcast_status(db_path: str, broadcast_id: int, status: str) -> None:
+    write(db_path, _set_broadcast_status, broadcast_id, status)
+
+def _set_broadcast_status(conn: sqlite3.Connection, broadcast_id: int, status: str) -> None:
+    conn.execute("UPDATE broadcasts SET status=? WHERE id=?", (status, broadcast_id))
+
+def list_user_timezones(db_path: str) -> list[str | None]:
+    with connect(db_path) as conn:
+        rows = conn.execute("SELECT DISTINCT timezone FROM users WHERE blocked_at IS NULL").fetchall()
+    return [r["timezone"] for r in rows]
+
+def get_broadcast_progress(db_path: str, broadcast_id: int, tz: str, run_date: str) -> tuple[int, bool]:
+    with connect(db_path) as conn:
+        row = conn.execute(
+            "SELECT last_user_id, done FROM broadcast_progress WHERE broadcast_id=? AND tz=? AND run_date=?",
+            (broadcast_id, tz, run_date),
+        ).fetchone()
+    if not row:
+        return 0, False
+    return int(row["last_user_id"]), bool(row["done"])
+
+def save_broadcast_progress(db_path: str, broadcast_id: int, tz: str, run_date: str, last_user_id: int, done: bool, sent: int, failed: int) -> None:
+    write(db_path, _save_broadcast_progress, broadcast_id, tz, run_date, last_user_id, done, sent, failed)
+
+def _save_broadcast_progress(conn: sqlite3.Connection, broadcast_id: int, tz: str, run_date: str, last_user_id: int, done: bool, sent: int, failed: int) -> None:
+    # checkpoint and counters in one transaction, so a restart resumes exactly here
+    conn.execute(
+        '''
+        INSERT INTO broadcast_progress(broadcast_id, tz, run_date, last_user_id, done, updated_at)
+        VALUES(?, ?, ?, ?, ?, ?)
+        ON CONFLICT(broadcast_id, tz, run_date) DO UPDATE SET
+            last_user_id=excluded.last_user_id,
+            done=excluded.done,
+            updated_at=excluded.updated_at
+        ''',
+        (broadcast_id, tz, run_date, last_user_id, 1 if done else 0, utcnow()),
+    )
+    conn.execute(
+        "UPDATE broadcasts SET sent=sent+?, failed=failed+? WHERE id=?",
+        (sent, failed, broadcast_id),
+    )
+
+def broadcast_recipients(db_path: str, tz: str | None, after_user_id: int, limit: int) -> list[sqlite3.Row]:
+    # keyset pagination over users; tz="*" means everyone
+    with connect(db_path) as conn:
+        if tz == "*":
+            return conn.execute(
+                "SELECT user_id, lang FROM users WHERE user_id>? AND blocked_at IS NULL ORDER BY user_id LIMIT ?",
+                (after_user_id, limit),
+            ).fetchall()
+        return conn.execute(
+            "SELECT user_id, lang FROM users WHERE timezone IS ? AND user_id>? AND blocked_at IS NULL ORDER BY user_id LIMIT ?",
+            (tz, after_user_id, limit),
+        ).fetchall()
@@ -0,0 +1,295 @@
+from __future__ import annotations
+
+import itertools
+import json
+import queue
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class _FakeServer:
+    """Base for local HTTP fakes: runs a ThreadingHTTPServer on 127.0.0.1 in a thread."""
+
+    def __init__(self, port: int = 0):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status: int, payload: dict) -> None:
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client gave up on an injected timeout
+
+            def _params(self) -> dict:
+                url = urlparse(self.path)
+                params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    raw = self.rfile.read(length).decode("utf-8")
+                    if "json" in (self.headers.get("Content-Type") or ""):
+                        params.update(json.loads(raw or "{}"))
+                    else:
+                        params.update({k: v[-1] for k, v in parse_qs(raw).items()})
+                return params
+
+            def do_GET(self):
+                status, payload = fake.handle("GET", urlparse(self.path).path, self._params())
+                self._reply(status, payload)
+
+            def do_POST(self):
+                status, payload = fake.handle("POST", urlparse(self.path).path, self._params())
+                self._reply(status, payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.port = self.httpd.server_address[1]
+        self._thread: threading.Thread | None = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def handle(self, method: str, path: str, params: dict) -> tuple[int, dict]:
+        raise NotImplementedError
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FakeBotAPI(_FakeServer):
+    """
+    Minimal Telegram Bot API: accepts any method, records calls and returns
+    a plausible Message for send* methods. Point telebot at it with
+    TELEGRAM_API_URL=<api_url>.
+
+    flood_every=N answers every N-th send with 429 retry_after=`retry_after`.
+    timeout_every=N holds every N-th send for `hang` seconds, longer than
+    the client's read timeout. Every request takes `latency` seconds.
+    keep_calls=False keeps only per-(method, status) counts, for long runs.
+    """
+
+    def __init__(
+        self, port: int = 0, flood_every: int = 0, retry_after: int = 1, blocked_chats: set[int] | None = None,
+        latency: float = 0.0, timeout_every: int = 0, hang: float = 3.0, keep_calls: bool = True,
+    ):
+        super().__init__(port)
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.blocked_chats = set(blocked_chats or ())
+        self.latency = latency
+        self.timeout_every = timeout_every
+        self.hang = hang
+        self.keep_calls = keep_calls
+        self.calls: list[tuple[float, str, dict, int]] = []
+        self.counts: Counter[tuple[str, int]] = Counter()
+        self.timeouts = 0
+        self._lock = threading.Lock()
+        self._requests = 0
+
+    @property
+    def api_url(self) -> str:
+        return self.base_url + "/bot{0}/{1}"
+
+    def sent(self, method: str = "sendMessage") -> list[dict]:
+        """Successfully answered calls of `method`."""
+        with self._lock:
+            return [p for _, m, p, status in self.calls if m == method and status == 200]
+
+    def handle(self, method: str, path: str, params: dict) -> tuple[int, dict]:
+        api_method = path.rsplit("/", 1)[-1]
+        status, payload = self._answer(api_method, params)
+        with self._lock:
+            self.counts[api_method, status] += 1
+            if self.keep_calls:
+                self.calls.append((time.monotonic(), api_method, params, status))
+        return status, payload
+
+    def _answer(self, api_method: str, params: dict) -> tuple[int, dict]:
+        with self._lock:
+            self._requests += 1
+            n = self._requests
+            message_id = n
+
+        if self.latency:
+            time.sleep(self.latency)
+        if not api_method.startswith("send"):
+            return 200, {"ok": True, "result": True}
+        if self.timeout_every and n % self.timeout_every == 0:
+            with self._lock:
+                self.timeouts += 1
+            time.sleep(self.hang)
+            return 504, {"ok": False, "error_code": 504, "description": "Gateway Timeout"}
+
+        chat_id = int(params.get("chat_id", 0))
+        if chat_id in self.blocked_chats:
+            return 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+        if self.flood_every and n % self.flood_every == 0:
+            return 429, {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }
+        return 200, {
+            "ok": True,
+            "result": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            },
+        }
+
+
+class FakeOFF(_FakeServer):
+    """
+    Open Food Facts product API (/api/v2/product/<barcode>.json). Barcodes
+    with an even last digit exist, the rest are "not found". Use with
+    OFF_BASE_URL=<base_url>. timeout_every=N holds every N-th request for
+    `hang` seconds (set it above OFF_TIMEOUT).
+    """
+
+    def __init__(self, port: int = 0, latency: float = 0.0, timeout_every: int = 0, hang: float = 3.0):
+        super().__init__(port)
+        self.latency = latency
+        self.timeout_every = timeout_every
+        self.hang = hang
+        self.requests = 0
+        self.timeouts = 0
+
+    def handle(self, method: str, path: str, params: dict) -> tuple[int, dict]:
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.timeout_every and self.requests % self.timeout_every == 0:
+            self.timeouts += 1
+            time.sleep(self.hang)
+            return 504, {"status": 0, "status_verbose": "timeout"}
+        barcode = path.rsplit("/", 1)[-1].removesuffix(".json")
+        if not barcode.isdigit() or int(barcode[-1]) % 2:
+            return 200, {"status": 0, "status_verbose": "product not found", "code": barcode}
+        return 200, {
+            "status": 1,
+            "code": barcode,
+            "product": {
+                "product_name": f"Product {barcode}",
+                "nutriments": {
+                    "energy-kcal_100g": 100 + int(barcode[-3:]) % 400,
+                    "proteins_100g": 5.0,
+                    "fat_100g": 3.0,
+                    "carbohydrates_100g": 20.0,
+                },
+            },
+        }
+
+
+class FakeYooKassa(_FakeServer):
+    """
+    YooKassa payments API (POST /v3/payments, GET /v3/payments/<id>) that also
+    sends payment notifications to `webhook_url`, like the real one does after
+    the user pays. Deterministic faults: every dup_every-th notification is
+    delivered twice and every stale_every-th final one is followed by a stale
+    waiting_for_capture. Non-200 answers are retried up to `retries` times.
+    """
+
+    def __init__(self, port: int = 0, webhook_url: str = "", latency: float = 0.0, dup_every: int = 0, stale_every: int = 0, retries: int = 3):
+        super().__init__(port)
+        self.webhook_url = webhook_url
+        self.latency = latency
+        self.dup_every = dup_every
+        self.stale_every = stale_every
+        self.retries = retries
+        self.payments: dict[str, dict] = {}
+        self.delivery: Counter[str] = Counter()
+        self._ids = itertools.count(1)
+        self._sent = itertools.count(1)
+        self._lock = threading.Lock()
+        self._outbox: queue.Queue[dict | None] = queue.Queue()
+        self._deliverer: threading.Thread | None = None
+
+    def handle(self, method: str, path: str, params: dict) -> tuple[int, dict]:
+        if self.latency:
+            time.sleep(self.latency)
+        parts = path.strip("/").split("/")
+        if parts[:2] != ["v3", "payments"]:
+            return 404, {"type": "error", "code": "not_found"}
+        if method == "POST" and len(parts) == 2:
+            pid = f"fake-{next(self._ids):08d}"
+            payment = {
+                "id": pid, "status": "pending", "paid": False,
+                "amount": params.get("amount") or {"value": "0.00", "currency": "RUB"},
+                "description": params.get("description", ""),
+                "metadata": params.get("metadata") or {},
+                "confirmation": {"type": "redirect", "confirmation_url": f"{self.base_url}/pay/{pid}"},
+            }
+            with self._lock:
+                self.payments[pid] = payment
+            return 200, payment
+        with self._lock:
+            payment = self.payments.get(parts[2]) if len(parts) == 3 else None
+        if payment is None:
+            return 404, {"type": "error", "code": "not_found"}
+        return 200, payment
+
+    def pay(self, payment_id: str, succeed: bool = True) -> None:
+        """The user finished (or abandoned) the payment: settle it and queue its notifications."""
+        with self._lock:
+            payment = self.payments[payment_id]
+            payment["status"] = "succeeded" if succeed else "canceled"
+            payment["paid"] = succeed
+            event = dict(payment)
+        n = next(self._sent)
+        notes = [{"type": "notification", "event": f"payment.{event['status']}", "object": event}]
+        if self.dup_every and n % self.dup_every == 0:
+            notes.append(notes[0])
+        if self.stale_every and n % self.stale_every == 0:
+            notes.append({"type": "notification", "event": "payment.waiting_for_capture", "object": {**event, "status": "waiting_for_capture"}})
+        for note in notes:
+            self._outbox.put(note)
+
+    def start(self):
+        super().start()
+        self._deliverer = threading.Thread(target=self._deliver_loop, name="fake-yookassa-webhooks", daemon=True)
+        self._deliverer.start()
+        return self
+
+    def stop(self) -> None:
+        self._outbox.put(None)
+        super().stop()
+
+    def pending(self) -> int:
+        return self._outbox.qsize()
+
+    def _deliver_loop(self) -> None:
+        import requests
+
+        session = requests.Session()
+        while True:
+            note = self._outbox.get()
+            if note is None:
+                return
+            for _ in range(self.retries + 1):
+                try:
+                    status = session.post(self.webhook_url, json=note, timeout=5).status_code
+                except requests.RequestException:
+                    status = 0
+                self.delivery[f"http_{status}"] += 1
+                if status == 200:
+                    break
+                time.sleep(0.1)
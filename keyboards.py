@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+from functools import lru_cache
+from typing import Callable, Iterable
+
+from telebot import types
+
+from nutrition import ACTIVITY
+from texts import DEFAULT_LANG, TEXTS, t
+
+ADMIN_BTN_ANALYTICS = "📈 Аналитика"
+ADMIN_BTN_BROADCAST = "📣 Рассылка"
+ADMIN_BTN_SLOW_QUERIES = "🐢 Медленные запросы"
+ADMIN_BTN_LIMITS = "🛡 Лимиты"
+
+
+class CachedMarkup(types.JsonSerializable):
+    """
+    A keyboard serialized once. telebot only calls to_json() on reply_markup,
+    so the same instance can be reused by every send from every thread.
+    """
+
+    def __init__(self, markup):
+        self.markup = markup
+        self.json = markup.to_json()
+
+    def to_json(self) -> str:
+        return self.json
+
+
+# builder -> parameter variants to prebuild at startup (besides lang)
+_REGISTRY: list[tuple[Callable, tuple[tuple, ...]]] = []
+
+
+def _keyboard(*variants: tuple):
+    def deco(build):
+        cached = lru_cache(maxsize=None)(lambda lang, *args: CachedMarkup(build(lang, *args)))
+
+        # lang can come from callback data; an unknown one must not add cache entries
+        def get(lang: str, *args):
+            return cached(lang if lang in TEXTS else DEFAULT_LANG, *args)
+
+        get.__name__ = build.__name__
+        get.__doc__ = build.__doc__
+        _REGISTRY.append((get, variants or ((),)))
+        return get
+    return deco
+
+
+def _reply(*rows: Iterable[str]) -> types.ReplyKeyboardMarkup:
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    for row in rows:
+        kb.row(*row)
+    return kb
+
+
+def warm(langs: Iterable[str] | None = None) -> int:
+    """Build every static keyboard for every language. Returns the number built."""
+    n = 0
+    for lang in (langs or TEXTS.keys()):
+        for build, variants in _REGISTRY:
+            for args in variants:
+                build(lang, *args)
+                n += 1
+    return n
+
+
+@_keyboard()
+def main_menu_kb(lang: str):
+    return _reply(
+        (t("btn_add_food", lang), t("btn_diary", lang)),
+        (t("btn_summary", lang), t("btn_more", lang)),
+    )
+
+
+@_keyboard((False,), (True,))
+def more_menu_kb(lang: str, show_admin: bool):
+    rows = [
+        (t("btn_my_products", lang), t("btn_search", lang)),
+        (t("btn_goals", lang), t("btn_settings", lang)),
+        (t("btn_feedback", lang),),
+    ]
+    if show_admin:
+        rows.append((t("btn_admin", lang),))
+    rows.append((t("btn_back", lang),))
+    return _reply(*rows)
+
+
+@_keyboard()
+def back_kb(lang: str):
+    return _reply((t("btn_back", lang),))
+
+
+@_keyboard()
+def quick_grams_kb(lang: str):
+    return _reply(
+        ("➕ +50 г", "➕ +100 г", "➕ +200 г"),
+        (t("btn_back", lang),),
+    )
+
+
+@_keyboard()
+def meal_picker_kb(lang: str):
+    return _reply(
+        (t("meal_breakfast", lang), t("meal_lunch", lang)),
+        (t("meal_dinner", lang), t("meal_snack", lang)),
+        (t("btn_back", lang),),
+    )
+
+
+@_keyboard()
+def add_food_kb(lang: str):
+    return _reply(
+        (t("btn_find_product", lang), t("btn_recent", lang)),
+        (t("btn_my_products", lang), t("btn_add_new_product", lang)),
+        (t("btn_new_recipe", lang), t("btn_back", lang)),
+    )
+
+
+@_keyboard()
+def recipe_items_kb(lang: str):
+    return _reply(
+        (t("btn_done", lang), t("btn_back", lang)),
+    )
+
+
+@_keyboard()
+def diary_kb(lang: str):
+    return _reply(
+        (t("today", lang), t("list_view", lang)),
+        (t("btn_back", lang),),
+    )
+
+
+@_keyboard()
+def summary_kb(lang: str):
+    return _reply(
+        (t("sum_today", lang), t("sum_week", lang)),
+        (t("sum_month", lang), t("remaining", lang)),
+        (t("btn_back", lang),),
+    )
+
+
+@_keyboard()
+def goals_kb(lang: str):
+    return _reply(
+        (t("goal_cut", lang), t("goal_maint", lang), t("goal_bulk", lang)),
+        (t("profile", lang), t("activity", lang)),
+        (t("cal_norm", lang), t("macros", lang)),
+        (t("btn_back", lang),),
+    )
+
+
+@_keyboard()
+def settings_kb(lang: str):
+    return _reply(
+        (t("set_lang", lang), t("set_tz", lang)),
+        (t("set_quick_grams", lang),),
+        (t("btn_back", lang),),
+    )
+
+
+@_keyboard()
+def admin_kb(lang: str):
+    return _reply(
+        (ADMIN_BTN_ANALYTICS, ADMIN_BTN_LIMITS),
+        (ADMIN_BTN_BROADCAST, ADMIN_BTN_SLOW_QUERIES),
+        (t("btn_back", lang),),
+    )
+
+
+@_keyboard()
+def lang_picker_kb(lang: str):
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton(t("lang_ru", lang), callback_data="setlang:ru"))
+    kb.add(types.InlineKeyboardButton(t("lang_en", lang), callback_data="setlang:en"))
+    return kb
+
+
+@_keyboard()
+def activity_picker_kb(lang: str):
+    kb = types.InlineKeyboardMarkup()
+    for key in ACTIVITY:
+        kb.add(types.InlineKeyboardButton(t(f"act_{key}", lang), callback_data=f"act:{key}"))
+    return kb
@@ -0,0 +1,356 @@
+"""
+Load generator: replays synthetic Telegram updates through the bot.py handlers
+against a local fake Bot API and a fake Open Food Facts server.
+
+    python loadtest.py --users 200 --sessions 3 --threads 4 --json loadtest.json
+
+Reports per-handler p50/p95/p99 latency, throughput, DB statements per update
+and memory growth. Uses a throwaway database, never the one from .env.
+"""
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_servers import FakeBotAPI, FakeOFF
+
+FOODS = [
+    ("Овсянка", "Oatmeal"), ("Молоко", "Milk"), ("Банан", "Banana"), ("Яблоко", "Apple"),
+    ("Куриная грудка", "Chicken breast"), ("Рис", "Rice"), ("Гречка", "Buckwheat"),
+    ("Творог", "Cottage cheese"), ("Яйцо", "Egg"), ("Хлеб", "Bread"), ("Сыр", "Cheese"),
+    ("Картофель", "Potato"), ("Говядина", "Beef"), ("Лосось", "Salmon"), ("Кефир", "Kefir"),
+]
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(q / 100.0 * (len(values) - 1)))))
+    return values[k]
+
+
+def rss_kb() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+class Recorder:
+    """
+    Latency and SQL statement counts per handler; statements are counted per
+    thread. Statements run by the DBWriter thread can't be told apart by
+    handler and are counted on their own.
+    """
+
+    def __init__(self):
+        self.latency: dict[str, list[float]] = defaultdict(list)
+        self.queries: dict[str, list[int]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.writer_statements = 0
+
+    def on_statement(self, sql: str) -> None:
+        if threading.current_thread().name == "db-writer":
+            self.writer_statements += 1  # only that thread writes it
+            return
+        self._local.n = getattr(self._local, "n", 0) + 1
+
+    def run(self, name: str, fn, *args) -> None:
+        self._local.n = 0
+        t0 = time.perf_counter()
+        try:
+            fn(*args)
+        except Exception:
+            with self._lock:
+                self.errors[name] += 1
+        dt = time.perf_counter() - t0
+        with self._lock:
+            self.latency[name].append(dt)
+            self.queries[name].append(self._local.n)
+
+    def report(self) -> dict[str, dict[str, float]]:
+        out = {}
+        for name, lat in sorted(self.latency.items()):
+            q = self.queries[name]
+            out[name] = {
+                "n": len(lat),
+                "p50_ms": percentile(lat, 50) * 1000,
+                "p95_ms": percentile(lat, 95) * 1000,
+                "p99_ms": percentile(lat, 99) * 1000,
+                "max_ms": max(lat) * 1000,
+                "queries_avg": sum(q) / len(q),
+                "errors": self.errors.get(name, 0),
+            }
+        return out
+
+
+class UpdateFactory:
+    """Builds telebot Message / CallbackQuery objects shaped like real private-chat updates."""
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def message(self, user_id: int, text: str):
+        from telebot import types
+
+        return types.Message.de_json({
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "from": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}", "username": f"user{user_id}"},
+            "chat": {"id": user_id, "type": "private"},
+            "text": text,
+        })
+
+    def callback(self, user_id: int, data: str):
+        from telebot import types
+
+        return types.CallbackQuery.de_json({
+            "id": str(next(self._ids)),
+            "from": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}", "username": f"user{user_id}"},
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": next(self._ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "",
+            },
+        })
+
+
+    def inline_query(self, user_id: int, query: str):
+        from telebot import types
+
+        return types.InlineQuery.de_json({
+            "id": str(next(self._ids)),
+            "from": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}", "username": f"user{user_id}"},
+            "query": query,
+            "offset": "",
+        })
+
+
+def build_session(bot_mod, f: UpdateFactory, rnd: random.Random, user_id: int, product_ids: list[int], first: bool):
+    """One user's realistic sequence of (step_name, handler, update)."""
+    t = bot_mod.t
+    lang = "ru"
+    steps = []
+    steps.append(("start", bot_mod.start, f.message(user_id, "/start")))
+    if first:
+        steps.append(("setlang", bot_mod.cb_setlang, f.callback(user_id, f"setlang:{lang}")))
+
+    for _ in range(rnd.randint(1, 3)):
+        name_ru, name_en = rnd.choice(FOODS)
+        query = rnd.choice((name_ru, name_en))[: rnd.randint(3, 6)]
+        steps += [
+            ("open_add_food", bot_mod.router, f.message(user_id, t("btn_add_food", lang))),
+            ("find", bot_mod.router, f.message(user_id, t("btn_find_product", lang))),
+            ("search", bot_mod.router, f.message(user_id, query)),
+            ("pick", bot_mod.cb_pick_product, f.callback(user_id, f"pick:global:{rnd.choice(product_ids)}:1")),
+            ("meal", bot_mod.router, f.message(user_id, t(rnd.choice(("meal_breakfast", "meal_lunch", "meal_dinner", "meal_snack")), lang))),
+        ]
+        if rnd.random() < 0.3:
+            steps.append(("grams_quick", bot_mod.router, f.message(user_id, "➕ +100 г")))
+        steps.append(("grams", bot_mod.router, f.message(user_id, str(rnd.choice((50, 100, 120, 150, 200, 250))))))
+
+    if rnd.random() < 0.5:
+        name_ru, name_en = rnd.choice(FOODS)
+        name = rnd.choice((name_ru, name_en))
+        # typing in inline mode sends a query per keystroke
+        steps += [("inline", bot_mod.inline_search, f.inline_query(user_id, name[:n])) for n in range(2, min(len(name), 6) + 1)]
+    if rnd.random() < 0.5:
+        steps += [
+            ("open_add_food", bot_mod.router, f.message(user_id, t("btn_add_food", lang))),
+            ("recent", bot_mod.router, f.message(user_id, t("btn_recent", lang))),
+        ]
+    if rnd.random() < 0.2:
+        barcode = "46" + "".join(rnd.choice("0123456789") for _ in range(11))
+        steps += [
+            ("find", bot_mod.router, f.message(user_id, t("btn_find_product", lang))),
+            ("barcode", bot_mod.router, f.message(user_id, barcode)),
+        ]
+    if rnd.random() < 0.5:
+        steps += [
+            ("diary", bot_mod.router, f.message(user_id, t("btn_diary", lang))),
+            ("diary_view", bot_mod.router, f.message(user_id, t(rnd.choice(("today", "list_view")), lang))),
+        ]
+    steps += [
+        ("summary", bot_mod.router, f.message(user_id, t("btn_summary", lang))),
+        ("summary_period", bot_mod.router, f.message(user_id, t(rnd.choice(("sum_today", "sum_week", "sum_month")), lang))),
+        ("back", bot_mod.router, f.message(user_id, t("btn_back", lang))),
+    ]
+    return steps
+
+
+def seed_products(db_mod, db_path: str, n: int, rnd: random.Random) -> list[int]:
+    now = db_mod.utcnow()
+    rows = []
+    for i in range(n):
+        name_ru, name_en = FOODS[i % len(FOODS)]
+        rows.append((f"{name_ru} {i}", f"{name_en} {i}", rnd.uniform(20, 600), rnd.uniform(0, 30), rnd.uniform(0, 30), rnd.uniform(0, 80), "seed", 0, now))
+
+    def insert(conn):
+        conn.executemany(
+            "INSERT INTO products_global(name_ru, name_en, kcal, p, f, c, source, created_by_user_id, created_at) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        return [int(r["id"]) for r in conn.execute("SELECT id FROM products_global")]
+
+    return db_mod.write(db_path, insert)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--users", type=int, default=100)
+    ap.add_argument("--sessions", type=int, default=3, help="sessions per user")
+    ap.add_argument("--threads", type=int, default=4, help="concurrent handler threads (TeleBot num_threads)")
+    ap.add_argument("--products", type=int, default=5000, help="products_global rows to seed")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--flood-every", type=int, default=0, help="fake Bot API answers every N-th send with 429")
+    ap.add_argument("--off-latency", type=float, default=0.05, help="fake OFF response delay, seconds")
+    ap.add_argument("--backup-every", type=float, default=0.0, help="take an online snapshot and checkpoint every N seconds during the run")
+    ap.add_argument("--json", help="write the report to this file")
+    args = ap.parse_args()
+
+    rnd = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="kbju-load-")
+    fake_api = FakeBotAPI(flood_every=args.flood_every).start()
+    fake_off = FakeOFF(latency=args.off_latency).start()
+    os.environ.update({
+        "BOT_TOKEN": "123456:LOADTEST",
+        "DB_PATH": os.path.join(workdir, "load.sqlite3"),
+        "TELEGRAM_API_URL": fake_api.api_url,
+        "OFF_BASE_URL": fake_off.base_url,
+        "OFF_ENABLED": "1",
+    })
+
+    import backup as backup_mod
+    import bot as bot_mod
+    import database as db_mod
+
+    bot_mod.create_app()
+
+    product_ids = seed_products(db_mod, bot_mod.cfg.db_path, args.products, rnd)
+    bot_mod.product_index.warm(bot_mod.cfg.db_path)
+    factory = UpdateFactory()
+    user_ids = [100000 + i for i in range(args.users)]
+    # sessions of one user stay in order; different users run concurrently
+    streams = {
+        uid: [s for k in range(args.sessions) for s in build_session(bot_mod, factory, rnd, uid, product_ids, first=(k == 0))]
+        for uid in user_ids
+    }
+
+    rec = Recorder()
+    db_mod.set_statement_hook(rec.on_statement)
+    bot_mod.sender.start()
+
+    tracemalloc.start()
+    rss_start = rss_kb()
+    mem_start = tracemalloc.get_traced_memory()[0]
+    t0 = time.perf_counter()
+
+    def play(uid: int) -> None:
+        for name, handler, update in streams[uid]:
+            rec.run(name, handler, update)
+
+    backups = bot_mod.backups
+    backups.backup_dir = os.path.join(workdir, "backups")
+    snapshots: list[dict] = []
+    checkpoints: list[dict] = []
+    done = threading.Event()
+
+    def backup_loop() -> None:
+        while not done.wait(args.backup_every):
+            info = backups.run_snapshot()
+            if info:
+                snapshots.append(info)
+            checkpoints.append(backups.run_checkpoint() or {})
+
+    if args.backup_every:
+        threading.Thread(target=backup_loop, daemon=True).start()
+
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        list(pool.map(play, user_ids))
+
+    elapsed = time.perf_counter() - t0
+    done.set()
+    mem_end, mem_peak = tracemalloc.get_traced_memory()
+    rss_end = rss_kb()
+    tracemalloc.stop()
+    db_mod.set_statement_hook(None)
+
+    drain_deadline = time.monotonic() + 120
+    while bot_mod.sender.pending() and time.monotonic() < drain_deadline:
+        time.sleep(0.2)
+    bot_mod.sender.stop()
+
+    handlers = rec.report()
+    total = sum(h["n"] for h in handlers.values())
+    report = {
+        "params": vars(args),
+        "updates": total,
+        "elapsed_s": elapsed,
+        "throughput_ups": total / elapsed if elapsed else 0.0,
+        "queries_per_update": (sum(sum(q) for q in rec.queries.values()) + rec.writer_statements) / max(total, 1),
+        "writer_queries_per_update": rec.writer_statements / max(total, 1),
+        "memory": {
+            "traced_growth_kb": (mem_end - mem_start) / 1024,
+            "traced_peak_kb": mem_peak / 1024,
+            "rss_start_kb": rss_start,
+            "rss_end_kb": rss_end,
+            "state_entries": len(bot_mod.STATE),
+        },
+        "sender": bot_mod.sender.stats(),
+        "search_index": {**bot_mod.product_index.size(), **bot_mod.product_index.stats},
+        "db_writer": db_mod.writer_stats(bot_mod.cfg.db_path),
+        "fake_api_messages": len(fake_api.sent()),
+        "off_requests": fake_off.requests,
+        "backups": {
+            "snapshots": len(snapshots),
+            "copy_seconds_max": max((i["seconds"] for i in snapshots), default=0.0),
+            "step_ms_max": max((i["max_step_seconds"] for i in snapshots), default=0.0) * 1000,
+            "checkpoint_ms_max": max((i.get("seconds", 0.0) for i in checkpoints), default=0.0) * 1000,
+            "wal_bytes_end": backup_mod.wal_size(bot_mod.cfg.db_path),
+        },
+        "handlers": handlers,
+    }
+
+    print(f"{total} updates in {elapsed:.2f}s -> {report['throughput_ups']:.1f} updates/s, "
+          f"{report['queries_per_update']:.1f} SQL statements/update "
+          f"({report['writer_queries_per_update']:.1f} on the writer thread, not in the sql column)")
+    print(f"{'handler':<14}{'n':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}{'sql':>6}{'err':>5}")
+    for name, h in handlers.items():
+        print(f"{name:<14}{h['n']:>7}{h['p50_ms']:>9.2f}{h['p95_ms']:>9.2f}{h['p99_ms']:>9.2f}{h['max_ms']:>9.2f}{h['queries_avg']:>6.1f}{h['errors']:>5}")
+    m = report["memory"]
+    if args.backup_every:
+        b = report["backups"]
+        print(f"backups: {b['snapshots']} snapshots (copy max {b['copy_seconds_max']:.2f}s, step max {b['step_ms_max']:.1f} ms), "
+              f"checkpoint max {b['checkpoint_ms_max']:.1f} ms, -wal {b['wal_bytes_end']} bytes at the end")
+    print(f"memory: traced +{m['traced_growth_kb']:.0f} KB (peak {m['traced_peak_kb']:.0f} KB), "
+          f"RSS {m['rss_start_kb']} -> {m['rss_end_kb']} KB, STATE={m['state_entries']}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    fake_api.stop()
+    fake_off.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+from __future__ import annotations
+
+import functools
+import hashlib
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Iterable
+
+import database as db
+
+# Nothing is recorded until enable() is called; timed() and the wrappers then
+# cost one flag check.
+_enabled = False
+_lock = threading.Lock()
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels_key(labels: dict[str, Any]) -> tuple[tuple[str, str], ...]:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _fmt_labels(key: Iterable[tuple[str, str]], extra: str = "") -> str:
+    parts = []
+    for k, v in key:
+        v = v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+        parts.append(f'{k}="{v}"')
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, value: float = 1.0, **labels) -> None:
+        key = _labels_key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0.0) + value
+
+    def render(self) -> list[str]:
+        with _lock:
+            items = list(self.values.items())
+        return [f"{self.name}{_fmt_labels(k)} {v}" for k, v in items]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # labels -> [per-bucket counts..., +Inf count, sum]
+        self.values: dict[tuple, list[float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = _labels_key(labels)
+        i = bisect_left(self.buckets, value)
+        with _lock:
+            row = self.values.get(key)
+            if row is None:
+                row = self.values[key] = [0.0] * (len(self.buckets) + 2)
+            row[i] += 1
+            row[-1] += value
+
+    def render(self) -> list[str]:
+        with _lock:
+            items = [(k, list(v)) for k, v in self.values.items()]
+        out = []
+        for key, row in items:
+            acc = 0.0
+            for le, n in zip(self.buckets, row):
+                acc += n
+                bucket = _fmt_labels(key, 'le="%s"' % le)
+                out.append(f"{self.name}_bucket{bucket} {acc}")
+            acc += row[len(self.buckets)]
+            bucket = _fmt_labels(key, 'le="+Inf"')
+            out.append(f"{self.name}_bucket{bucket} {acc}")
+            out.append(f"{self.name}_sum{_fmt_labels(key)} {row[-1]}")
+            out.append(f"{self.name}_count{_fmt_labels(key)} {acc}")
+        return out
+
+
+handler_seconds = Histogram("kbju_handler_seconds", "TeleBot handler latency")
+handler_errors = Counter("kbju_handler_errors_total", "Exceptions raised by handlers")
+db_query_seconds = Histogram("kbju_db_query_seconds", "SQL statement execution time")
+db_connections = Counter("kbju_db_connections_total", "SQLite connections opened")
+external_seconds = Histogram("kbju_external_request_seconds", "Latency of calls to external services", (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+external_errors = Counter("kbju_external_request_errors_total", "Failed calls to external services")
+backup_seconds = Histogram("kbju_backup_seconds", "Snapshot, WAL checkpoint and restore duration", (0.01, 0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0))
+backup_step_seconds = Histogram("kbju_backup_step_seconds", "Duration of one backup API step (the source read lock is held this long)")
+backup_errors = Counter("kbju_backup_errors_total", "Failed snapshots and checkpoints")
+
+REGISTRY: list[Counter | Histogram] = [
+    handler_seconds, handler_errors, db_query_seconds, db_connections, external_seconds, external_errors,
+    backup_seconds, backup_step_seconds, backup_errors,
+]
+
+# Callables returning {metric_name: value} sampled at scrape time (e.g. queue depths).
+_collectors: list[Callable[[], dict[str, float]]] = []
+
+
+def register_collector(fn: Callable[[], dict[str, float]]) -> None:
+    _collectors.append(fn)
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+_WS = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=1024)
+def statement_label(sql: str) -> str:
+    # SQL in database.py is parameterized, so the statement text is a bounded label set;
+    # a prefix alone would merge variants that differ only past it, hence the hash of the whole text
+    text = _WS.sub(" ", sql).strip()
+    return f"{text[:80]} #{hashlib.blake2b(text.encode(), digest_size=4).hexdigest()}"
+
+
+def _on_query(sql: str, params, seconds: float, conn) -> None:
+    db_query_seconds.observe(seconds, statement=statement_label(sql))
+
+
+def _on_connect(db_path: str) -> None:
+    db_connections.inc()
+
+
+def enable() -> None:
+    global _enabled
+    if _enabled:
+        return
+    _enabled = True
+    db.add_query_observer(_on_query)
+    db.add_connect_observer(_on_connect)
+
+
+@contextmanager
+def timed(service: str, op: str):
+    """Time a call to an external service (OFF, YooKassa)."""
+    if not _enabled:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        external_errors.inc(service=service, op=op)
+        raise
+    finally:
+        external_seconds.observe(time.perf_counter() - t0, service=service, op=op)
+
+
+def _wrap_handler(fn: Callable) -> Callable:
+    name = getattr(fn, "__name__", "handler")
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            handler_errors.inc(handler=name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - t0, handler=name)
+
+    wrapper.__instrumented__ = True
+    return wrapper
+
+
+def instrument_bot(bot) -> int:
+    """Wrap every registered TeleBot handler with a latency histogram. Call after all handlers are registered."""
+    n = 0
+    for attr in dir(bot):
+        if not attr.endswith("_handlers"):
+            continue
+        handlers = getattr(bot, attr)
+        if not isinstance(handlers, list):
+            continue
+        for h in handlers:
+            if isinstance(h, dict) and callable(h.get("function")) and not getattr(h["function"], "__instrumented__", False):
+                h["function"] = _wrap_handler(h["function"])
+                n += 1
+    return n
+
+
+def render() -> str:
+    lines = []
+    for m in REGISTRY:
+        lines.append(f"# HELP {m.name} {m.help}")
+        lines.append(f"# TYPE {m.name} {m.kind}")
+        lines.extend(m.render())
+    for fn in _collectors:
+        try:
+            values = fn()
+        except Exception:
+            continue
+        for name, value in values.items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {float(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def serve(host: str, port: int) -> ThreadingHTTPServer:
+    """Expose render() at http://host:port/metrics in a daemon thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=httpd.serve_forever, name="metrics-http", daemon=True).start()
+    return httpd
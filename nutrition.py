@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import math
+import threading
+from array import array
+from operator import mul
+from typing import Iterable, Sequence
+
+MACROS = ("kcal", "p", "f", "c")
+_NAN = float("nan")
+
+# daily energy = BMR * activity factor * goal factor
+ACTIVITY = {"sedentary": 1.2, "light": 1.375, "moderate": 1.55, "high": 1.725, "extreme": 1.9}
+GOALS = {"cut": 0.85, "maint": 1.0, "bulk": 1.1}
+PROTEIN_G_PER_KG = {"cut": 2.0, "maint": 1.6, "bulk": 1.8}
+FAT_SHARE = 0.25  # of energy; carbs get the rest
+
+
+def bmr(sex: str, age: float, weight: float, height: float) -> float:
+    """Mifflin-St Jeor basal metabolic rate, kcal/day (weight in kg, height in cm)."""
+    return 10 * weight + 6.25 * height - 5 * age + (5 if sex == "m" else -161)
+
+
+def daily_targets(sex: str, age: float, weight: float, height: float, activity: str = "moderate", goal: str = "maint") -> dict[str, float]:
+    kcal = bmr(sex, age, weight, height) * ACTIVITY[activity] * GOALS[goal]
+    p = PROTEIN_G_PER_KG[goal] * weight
+    f = kcal * FAT_SHARE / 9
+    c = max(kcal - 4 * p - 9 * f, 0.0) / 4
+    return {"kcal": kcal, "p": p, "f": f, "c": c}
+
+
+class _Columns:
+    """kcal/p/f/c per 100 g of one product table in float32 arrays indexed by product id (NaN = unknown)."""
+
+    def __init__(self):
+        self.cols = tuple(array("f") for _ in MACROS)
+        self.owner = array("q")  # products_user.user_id; 0 for global products
+
+    def _grow(self, size: int) -> None:
+        n = size - len(self.owner)
+        if n > 0:
+            for col in self.cols:
+                col.extend([_NAN] * n)
+            self.owner.extend([0] * n)
+
+    def put(self, product_id: int, kcal: float, p: float, f: float, c: float, owner: int = 0) -> None:
+        if product_id >= len(self.owner):
+            # grow geometrically, product ids are dense (AUTOINCREMENT)
+            self._grow(max(product_id + 1, len(self.owner) * 3 // 2, 1024))
+        for col, v in zip(self.cols, (kcal, p, f, c)):
+            col[product_id] = float(v or 0.0)
+        self.owner[product_id] = owner
+
+    def known(self, product_id: int) -> bool:
+        return 0 <= product_id < len(self.owner) and not math.isnan(self.cols[0][product_id])
+
+    def forget(self, product_id: int) -> None:
+        if 0 <= product_id < len(self.owner):
+            for col in self.cols:
+                col[product_id] = _NAN
+
+
+class MacroTable:
+    """
+    Read-through cache of product macros used for summaries.
+
+    Loaded lazily with one scan per product table, kept current by the insert
+    helpers, and filled on demand for ids added by other processes. Summing a
+    range is a dot product of grams against the macro columns: per product row
+    there is a single float32, not a sqlite3.Row and a dict.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables = {"global": _Columns(), "user": _Columns()}
+        self.loaded = False
+
+    def load(self, rows_global: Iterable[tuple], rows_user: Iterable[tuple]) -> None:
+        """rows_global: (id, kcal, p, f, c); rows_user: (id, user_id, kcal, p, f, c)."""
+        g, u = _Columns(), _Columns()
+        for pid, kcal, p, f, c in rows_global:
+            g.put(pid, kcal, p, f, c)
+        for pid, owner, kcal, p, f, c in rows_user:
+            u.put(pid, kcal, p, f, c, owner)
+        with self._lock:
+            self._tables = {"global": g, "user": u}
+            self.loaded = True
+
+    def put(self, ref_type: str, product_id: int, kcal: float, p: float, f: float, c: float, owner: int = 0) -> None:
+        with self._lock:
+            self._tables[ref_type].put(product_id, kcal, p, f, c, owner)
+
+    def forget(self, ref_type: str, product_id: int) -> None:
+        """Mark a product unknown, so the next missing() check reloads it."""
+        with self._lock:
+            self._tables[ref_type].forget(product_id)
+
+    def missing(self, ref_type: str, ids: Iterable[int]) -> list[int]:
+        table = self._tables[ref_type]
+        return sorted({i for i in ids if not table.known(i)})
+
+    def totals(self, user_id: int, ref_types: Sequence[str], ref_ids: Sequence[int], grams: Sequence[float]) -> dict[str, float]:
+        """
+        Sum macros of food_log rows given as parallel sequences. Rows pointing at
+        unknown products, or at another user's products, are skipped.
+        """
+        out = dict.fromkeys(MACROS, 0.0)
+        for ref_type, table in self._tables.items():
+            cols, owner = table.cols, table.owner
+            idx: list[int] = []
+            g: list[float] = []
+            for t, i, w in zip(ref_types, ref_ids, grams):
+                if t == ref_type and table.known(i) and (ref_type == "global" or owner[i] == user_id):
+                    idx.append(i)
+                    g.append(w)
+            if not idx:
+                continue
+            for name, col in zip(MACROS, cols):
+                out[name] += sum(map(mul, g, map(col.__getitem__, idx))) / 100.0
+        return out
+
+    def per_row(self, ref_types: Sequence[str], ref_ids: Sequence[int], grams: Sequence[float]) -> tuple[list[float], ...]:
+        """kcal/p/f/c of each row (0 for unknown products), without the owner check."""
+        n = len(ref_ids)
+        out = tuple([0.0] * n for _ in MACROS)
+        for ref_type, table in self._tables.items():
+            pos = [k for k in range(n) if ref_types[k] == ref_type and table.known(ref_ids[k])]
+            if not pos:
+                continue
+            ids = list(map(ref_ids.__getitem__, pos))
+            g = list(map(grams.__getitem__, pos))
+            for dst, col in zip(out, table.cols):
+                for k, v in zip(pos, map(mul, g, map(col.__getitem__, ids))):
+                    dst[k] = v / 100.0
+        return out
+
+    def size(self) -> dict[str, int]:
+        return {f"{k}_slots": len(t.owner) for k, t in self._tables.items()}
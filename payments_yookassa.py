@@ -1,11 +1,21 @@
 from __future__ import annotations
 
+import hmac
 import json
+import logging
+import threading
 import uuid
 from dataclasses import dataclass
-from typing import Any, Optional
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Optional
+from urllib.parse import parse_qs, urlparse
 
-from yookassa import Configuration, Payment
+import database as db
+import metrics
+
+log = logging.getLogger("kbju.yookassa")
+
+# The YooKassa SDK is imported on first use, not at import time.
 
 @dataclass(frozen=True)
 class YooKassaConfig:
@@ -14,6 +24,8 @@ class YooKassaConfig:
     return_url: str
 
 def init_yookassa(cfg: YooKassaConfig) -> None:
+    from yookassa import Configuration
+
     Configuration.account_id = cfg.shop_id
     Configuration.secret_key = cfg.secret_key
 
@@ -29,6 +41,8 @@ def create_sbp_payment(
     """Creates a payment with Redirect confirmation. YooKassa will provide confirmation_url.
     Docs mention redirect to confirmation_url for user action. citeturn2search13
     """
+    from yookassa import Payment
+
     init_yookassa(cfg)
 
     idem = idempotency_key or str(uuid.uuid4())
@@ -44,7 +58,8 @@ def create_sbp_payment(
         },
     }
 
-    payment = Payment.create(payload, idem)
+    with metrics.timed("yookassa", "create"):
+        payment = Payment.create(payload, idem)
     confirmation_url = getattr(payment, "confirmation", {}).get("confirmation_url")
     return {
         "id": payment.id,
@@ -55,11 +70,120 @@ def create_sbp_payment(
     }
 
 def fetch_payment_status(cfg: YooKassaConfig, payment_id: str) -> dict[str, Any]:
+    from yookassa import Payment
+
     init_yookassa(cfg)
-    payment = Payment.find_one(payment_id)
+    with metrics.timed("yookassa", "find_one"):
+        payment = Payment.find_one(payment_id)
     return {
         "id": payment.id,
         "status": payment.status,
         "paid": getattr(payment, "paid", None),
         "raw": payment.json(),
     }
+
+# notification event -> payments.status
+EVENT_STATUS = {
+    "payment.waiting_for_capture": "waiting_for_capture",
+    "payment.succeeded": "succeeded",
+    "payment.canceled": "canceled",
+}
+
+def process_notification(db_path: str, body: dict[str, Any], fetch: Callable[[str], dict[str, Any]]) -> str:
+    """
+    Apply one webhook notification. The body is unauthenticated, so it only
+    names the payment: its status is re-read from the API with fetch(payment_id)
+    (fetch_payment_status). YooKassa retries until it gets a 200 and may deliver
+    the same event twice or a stale one after a final status, so this is
+    idempotent: see db.apply_payment_status. Returns its outcome, or "ignored"
+    for events that aren't payment status changes.
+    """
+    obj = body.get("object") or {}
+    if body.get("type") != "notification" or body.get("event") not in EVENT_STATUS or not obj.get("id"):
+        return "ignored"
+    payment = fetch(str(obj["id"]))
+    status = payment.get("status")
+    if status not in EVENT_STATUS.values():
+        return "ignored"  # still pending
+    meta = {"event": body["event"], "paid": payment.get("paid")}
+    return db.apply_payment_status(db_path, str(payment.get("id") or obj["id"]), status, meta)
+
+# notifications are a few KB; anything bigger is not from YooKassa
+MAX_NOTIFICATION_BYTES = 64 * 1024
+
+class WebhookServer:
+    """
+    HTTP endpoint for YooKassa notifications (WEBHOOK_HOST/PORT/PATH). With
+    WEBHOOK_SECRET set, the notification URL registered in YooKassa must carry
+    ?secret=<it>. Payment statuses are taken from fetch(payment_id), not from
+    the body (see process_notification). Answers 200 once a notification is
+    applied or known to be a repeat, 500 on errors so YooKassa retries.
+    """
+
+    def __init__(
+        self, db_path: str, host: str, port: int, path: str,
+        fetch: Callable[[str], dict[str, Any]], secret: str | None = None,
+    ):
+        self.db_path = db_path
+        self.path = path
+        self.fetch = fetch
+        self.secret = secret
+        self.stats = {"received": 0, "applied": 0, "duplicate": 0, "stale": 0, "unknown": 0, "ignored": 0, "rejected": 0, "errors": 0}
+        self._lock = threading.Lock()
+        hook = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                url = urlparse(self.path)
+                try:
+                    length = int(self.headers.get("Content-Length") or 0)
+                except ValueError:
+                    length = -1
+                if not 0 <= length <= MAX_NOTIFICATION_BYTES:
+                    hook._count("received")
+                    hook._count("rejected")
+                    self.close_connection = True  # the body is left unread
+                    code = 413
+                else:
+                    code = hook.handle(url.path, parse_qs(url.query).get("secret", [None])[-1], self.rfile.read(length))
+                self.send_response(code)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.port = self.httpd.server_address[1]
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self.stats[key] += 1
+
+    def handle(self, path: str, secret: str | None, body: bytes) -> int:
+        self._count("received")
+        if path != self.path or (self.secret and not hmac.compare_digest((secret or "").encode(), self.secret.encode())):
+            self._count("rejected")
+            return 404
+        try:
+            data = json.loads(body or b"{}")
+        except ValueError:
+            self._count("rejected")
+            return 400
+        try:
+            with metrics.timed("yookassa", "webhook"):
+                outcome = process_notification(self.db_path, data, self.fetch)
+        except Exception:
+            log.exception("webhook: notification failed")
+            self._count("errors")
+            return 500
+        self._count(outcome)
+        return 200
+
+    def start(self) -> "WebhookServer":
+        threading.Thread(target=self.httpd.serve_forever, name="yookassa-webhook", daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -2,8 +2,6 @@ from __future__ import annotations
 
 import os
 from datetime import datetime
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
 
 def ensure_dir(path: str) -> None:
     os.makedirs(path, exist_ok=True)
@@ -15,6 +13,10 @@ def export_day_pdf(
     totals: dict[str, float],
     lang: str = "ru",
 ) -> str:
+    # reportlab is heavy; only PDF export needs it
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+
     ensure_dir(pdf_dir)
     filename = f"kbju_{user_id}_{date_str}.pdf"
     filepath = os.path.join(pdf_dir, filename)
@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import json
+import logging
+import threading
+import time
+from datetime import date, datetime, timezone
+from typing import Any
+
+import database as db
+
+log = logging.getLogger("kbju.popstats")
+
+CACHE_KEY = "popstats_cache"
+PERCENTILES = (10, 25, 50, 75, 90)
+RETENTION_WEEKS = 6
+
+
+def percentile_from_hist(hist: list[tuple[int, int]], width: float, q: float) -> float:
+    """q-th percentile (0..100) from (bin, count) pairs, interpolated inside the bin."""
+    total = sum(n for _, n in hist)
+    if not total:
+        return 0.0
+    target = total * q / 100.0
+    acc = 0
+    for b, n in hist:
+        if acc + n >= target:
+            return (b + (target - acc) / n) * width
+        acc += n
+    return (hist[-1][0] + 1) * width
+
+
+def compute(db_path: str) -> dict[str, Any]:
+    raw = db.daily_totals_stats(db_path)
+    tot = raw["totals"]
+    days = tot["days"] or 0
+    kcal = tot["kcal"] or 0.0
+
+    sizes = dict(raw["cohort_sizes"])
+    today = datetime.now(timezone.utc).date()
+    cohorts = {}
+    for c in sizes:
+        # weeks the cohort has not reached yet stay None
+        elapsed = (today - date.fromisoformat(c)).days // 7
+        cohorts[c] = [0 if w <= elapsed else None for w in range(RETENTION_WEEKS)]
+    for cohort, week, n in raw["retention"]:
+        if cohort in cohorts and 0 <= week < RETENTION_WEEKS and cohorts[cohort][week] is not None:
+            cohorts[cohort][week] = n
+
+    return {
+        "computed_at": db.utcnow(),
+        "watermark": raw["watermark"],
+        "days": days,
+        "users": tot["users"] or 0,
+        "kcal_percentiles": [[q, percentile_from_hist(raw["kcal_hist"], raw["kcal_bin"], q)] for q in PERCENTILES],
+        "avg_per_day": {k: (tot[k] or 0.0) / days if days else 0.0 for k in ("kcal", "p", "f", "c")},
+        # share of energy from protein/fat/carbs, 4/9/4 kcal per gram
+        "energy_split": {
+            k: (tot[k] or 0.0) * m / kcal if kcal else 0.0 for k, m in (("p", 4), ("f", 9), ("c", 4))
+        },
+        "meal_days": {k: (tot[k] or 0) / days if days else 0.0 for k in ("breakfast", "lunch", "dinner", "snack", "three_meals")},
+        "cohorts": [
+            {"week": c, "size": sizes[c], "active": cohorts[c]}
+            for c in sorted(sizes, reverse=True)
+        ],
+    }
+
+
+def cached(db_path: str) -> dict[str, Any] | None:
+    with db.connect(db_path) as conn:
+        raw = db.get_setting(conn, CACHE_KEY)
+    return json.loads(raw) if raw else None
+
+
+class PopulationStatsJob:
+    """
+    Periodically folds new food_log rows into daily_totals (incremental, by
+    food_log.id watermark), recomputes population stats from the rollup and
+    caches them in settings for admin_analytics.
+    """
+
+    def __init__(self, db_path: str, interval: float = 3600.0, chunk_size: int = 50_000):
+        self.db_path = db_path
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self._wake = threading.Event()
+        self._stopping = False
+        self._running = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self.last_run: dict[str, float] = {}
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._loop, name="popstats", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopping = True
+        self._wake.set()
+        if self._thread:
+            self._thread.join(5)
+
+    def kick(self) -> None:
+        """Run as soon as possible instead of waiting for the interval (once, if the loop isn't started)."""
+        if self._thread and self._thread.is_alive():
+            self._wake.set()
+        elif not self._running.locked():
+            threading.Thread(target=self._run_once, name="popstats-once", daemon=True).start()
+
+    def _run_once(self) -> None:
+        try:
+            self.run()
+        except Exception:
+            log.exception("population stats job failed")
+
+    def _loop(self) -> None:
+        while not self._stopping:
+            try:
+                self.run()
+            except Exception:
+                log.exception("population stats job failed")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def run(self) -> dict[str, Any] | None:
+        if not self._running.acquire(blocking=False):
+            return None
+        try:
+            t0 = time.perf_counter()
+            rows = db.rollup_daily_totals(self.db_path, self.chunk_size, should_stop=lambda: self._stopping)
+            t1 = time.perf_counter()
+            stats = compute(self.db_path)
+            db.write(self.db_path, db.set_setting, CACHE_KEY, json.dumps(stats, ensure_ascii=False))
+            self.last_run = {"rows": rows, "rollup_seconds": t1 - t0, "stats_seconds": time.perf_counter() - t1}
+            log.info("popstats: %d new food_log rows in %.1fs, stats in %.1fs", rows, t1 - t0, self.last_run["stats_seconds"])
+            return stats
+        finally:
+            self._running.release()
+
+
+def report(stats: dict[str, Any] | None) -> str:
+    if not stats:
+        return "📊 Статистика по питанию ещё считается…"
+    avg = stats["avg_per_day"]
+    split = stats["energy_split"]
+    meals = stats["meal_days"]
+    lines = [
+        f"📊 Питание: {stats['users']} польз., {stats['days']} дней (на {stats['computed_at'][:16]})",
+        "Ккал/день: " + " · ".join(f"p{q} {v:.0f}" for q, v in stats["kcal_percentiles"]),
+        f"Среднее: {avg['kcal']:.0f} ккал, Б {avg['p']:.0f} / Ж {avg['f']:.0f} / У {avg['c']:.0f} г",
+        f"Доля энергии: Б {split['p']:.0%} · Ж {split['f']:.0%} · У {split['c']:.0%}",
+        f"Дни с приёмом: завтрак {meals['breakfast']:.0%} · обед {meals['lunch']:.0%} · ужин {meals['dinner']:.0%} · перекус {meals['snack']:.0%}",
+        f"Все три основных приёма: {meals['three_meals']:.0%} дней",
+    ]
+    if stats["cohorts"]:
+        lines.append("")
+        lines.append("🧪 Удержание по неделе регистрации (W0…W%d):" % (RETENTION_WEEKS - 1))
+        for c in stats["cohorts"]:
+            size = c["size"] or 1
+            lines.append(f"{c['week']} ({c['size']}): " + " ".join("—" if n is None else f"{n / size:.0%}" for n in c["active"]))
+    return "\n".join(lines)
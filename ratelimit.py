@@ -0,0 +1,123 @@
+"""
+Inbound flood protection, checked before a handler touches the database.
+
+Every update costs at least ensure_user (a write) and user_lang, so a client
+sending hundreds of messages a second slows everyone down. IngressLimiter keeps
+a token bucket per user and one for the process; updates over either limit are
+dropped with nothing but a counter bump. Per-user buckets are exact because the
+supervisor routes all updates of a user to the same process; the global bucket
+is per process, and the supervisor gives each worker its share of the limit.
+
+Barcode lookups go out to Open Food Facts, so a user whose lookups keep missing
+is put on a cooldown instead of being allowed to probe digit strings.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+
+from sender import TokenBucket
+
+
+class _Client:
+    __slots__ = ("bucket", "dropped", "throttled", "misses", "miss_window", "cooldown_until")
+
+    def __init__(self, rate: float, burst: float):
+        self.bucket = TokenBucket(rate, burst)
+        self.dropped = 0
+        self.throttled = False  # told to slow down during the current flood
+        self.misses = 0
+        self.miss_window = 0.0
+        self.cooldown_until = 0.0
+
+
+class IngressLimiter:
+    def __init__(
+        self,
+        user_rate: float = 2.0,
+        user_burst: float = 10.0,
+        global_rate: float = 300.0,
+        barcode_misses: int = 3,
+        barcode_window: float = 600.0,
+        barcode_cooldown: float = 900.0,
+        max_users: int = 100_000,
+    ):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_bucket = TokenBucket(global_rate, global_rate) if global_rate > 0 else None
+        self.barcode_misses = barcode_misses
+        self.barcode_window = barcode_window
+        self.barcode_cooldown = barcode_cooldown
+        self.max_users = max_users
+        self._clients: OrderedDict[int, _Client] = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"allowed": 0, "dropped_user": 0, "dropped_global": 0, "barcode_misses": 0, "barcode_blocked": 0}
+
+    def _client(self, user_id: int) -> _Client:
+        c = self._clients.get(user_id)
+        if c is None:
+            c = self._clients[user_id] = _Client(self.user_rate, self.user_burst)
+            if len(self._clients) > self.max_users:
+                self._clients.popitem(last=False)
+        else:
+            self._clients.move_to_end(user_id)
+        return c
+
+    def allow(self, user_id: int, now: float | None = None) -> tuple[bool, bool]:
+        """
+        (allowed, first_drop): first_drop is True for the first update dropped
+        in a flood, so the caller can tell the user once rather than per message.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self.user_rate > 0:
+                c = self._client(user_id)
+                if not c.bucket.take(now):
+                    c.dropped += 1
+                    self.stats["dropped_user"] += 1
+                    first, c.throttled = not c.throttled, True
+                    return False, first
+                c.throttled = False
+            # users over their own limit don't spend the shared tokens
+            if self.global_bucket is not None and not self.global_bucket.take(now):
+                self.stats["dropped_global"] += 1
+                return False, False
+            self.stats["allowed"] += 1
+            return True, False
+
+    def barcode_allowed(self, user_id: int, now: float | None = None) -> bool:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            c = self._clients.get(user_id)
+            if c is not None and now < c.cooldown_until:
+                self.stats["barcode_blocked"] += 1
+                return False
+            return True
+
+    def barcode_result(self, user_id: int, found: bool, now: float | None = None) -> None:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            c = self._client(user_id)
+            if found:
+                c.misses = 0
+                return
+            self.stats["barcode_misses"] += 1
+            if now - c.miss_window > self.barcode_window:
+                c.misses, c.miss_window = 0, now
+            c.misses += 1
+            if c.misses >= self.barcode_misses:
+                c.misses, c.cooldown_until = 0, now + self.barcode_cooldown
+
+    def top(self, n: int = 5) -> list[tuple[int, int]]:
+        """(user_id, dropped updates) of the users dropped the most."""
+        with self._lock:
+            rows = [(uid, c.dropped) for uid, c in self._clients.items() if c.dropped]
+        return sorted(rows, key=lambda r: -r[1])[:n]
+
+    def snapshot(self) -> dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            cooling = sum(1 for c in self._clients.values() if now < c.cooldown_until)
+            return {**self.stats, "tracked_users": len(self._clients), "barcode_cooldowns": cooling}
@@ -0,0 +1,295 @@
+from __future__ import annotations
+
+import re
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
+
+import database as db
+
+_NON_WORD = re.compile(r"[\W_]+")
+
+
+def normalize(text: str | None) -> list[str]:
+    """Search tokens of a product name or query: casefolded, ё→е, split on non-word characters."""
+    if not text:
+        return []
+    return _NON_WORD.sub(" ", text.casefold().replace("ё", "е")).split()
+
+
+@dataclass(slots=True)
+class Entry:
+    ref_type: str
+    id: int
+    owner: int  # user_id for products_user, 0 for global
+    name_ru: str
+    name_en: str
+    kcal: float
+    p: float
+    f: float
+    c: float
+    popularity: int
+    tokens: tuple[str, ...]
+
+    def matches(self, words: list[str]) -> bool:
+        return all(any(tok.startswith(w) for tok in self.tokens) for w in words)
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "id": self.id, "name_ru": self.name_ru, "name_en": self.name_en,
+            "kcal": self.kcal, "p": self.p, "f": self.f, "c": self.c, "ref_type": self.ref_type,
+        }
+
+
+class ProductIndex:
+    """
+    In-memory prefix index over normalized product names for inline search.
+
+    Tokens are kept in one sorted list with a parallel array of product keys
+    (global id, or -id for user products); products sharing a token are
+    ordered by popularity, so a prefix lookup is a bisect plus a short scan
+    that takes the top of each matching token's run. At most `max_products` products are held: the most
+    popular global ones plus user products. When full, the products of users
+    who haven't searched for `owner_ttl` seconds go first, then the least
+    popular global ones; an evicted user's products are loaded back by the
+    refresh() of their next search. New products are picked up by refresh()
+    using id watermarks, so every process sees what any of them added.
+    Results of recent queries are kept in a small LRU ("hot prefixes").
+    """
+
+    def __init__(
+        self,
+        max_products: int = 200_000,
+        cache_size: int = 2048,
+        max_candidates: int = 5000,
+        refresh_interval: float = 5.0,
+        owner_ttl: float = 3600.0,
+    ):
+        self.max_products = max_products
+        self.cache_size = cache_size
+        self.max_candidates = max_candidates
+        self.refresh_interval = refresh_interval
+        self.owner_ttl = owner_ttl
+
+        self._lock = threading.RLock()
+        self._tokens: list[str] = []
+        self._keys = array("q")
+        self._entries: dict[int, Entry] = {}
+        self._by_owner: dict[int, list[int]] = {}
+        self._owner_seen: dict[int, float] = {}  # owner -> last search, monotonic
+        self._evicted_owners: set[int] = set()
+        self._cache: OrderedDict[str, list[int]] = OrderedDict()
+        self._last_global_id = 0
+        self._last_user_id = 0
+        self._refreshed_at = 0.0
+        self.ready = False
+        self.stats = {"queries": 0, "cache_hits": 0, "evicted": 0, "added": 0}
+
+    # --- building ---
+
+    def _entry(self, row, ref_type: str) -> Entry:
+        tokens = tuple(dict.fromkeys(sys.intern(tok) for tok in normalize(row["name_ru"]) + normalize(row["name_en"])))
+        return Entry(
+            ref_type, int(row["id"]),
+            int(row["user_id"]) if ref_type == "user" else 0,
+            row["name_ru"] or "", row["name_en"] or "",
+            float(row["kcal"] or 0), float(row["p"] or 0), float(row["f"] or 0), float(row["c"] or 0),
+            int(row["popularity"] or 0) if ref_type == "global" else 0,
+            tokens,
+        )
+
+    @staticmethod
+    def _key(e: Entry) -> int:
+        return e.id if e.ref_type == "global" else -e.id
+
+    def _rank(self, key: int) -> tuple[int, int]:
+        return -self._entries[key].popularity, key
+
+    def warm(self, db_path: str) -> int:
+        """(Re)build the whole index. Returns the number of products indexed."""
+        glob, users, max_g, max_u, left_out = db.products_for_index(db_path, self.max_products)
+        entries: dict[int, Entry] = {}
+        by_owner: dict[int, list[int]] = {}
+        pairs: list[tuple[str, int]] = []
+        for ref_type, rows in (("global", glob), ("user", users)):
+            for row in rows:
+                e = self._entry(row, ref_type)
+                key = self._key(e)
+                entries[key] = e
+                if e.owner:
+                    by_owner.setdefault(e.owner, []).append(key)
+                pairs.extend((tok, -e.popularity, key) for tok in e.tokens)
+        pairs.sort()
+        with self._lock:
+            self._tokens = [p[0] for p in pairs]
+            self._keys = array("q", (p[2] for p in pairs))
+            self._entries = entries
+            self._by_owner = by_owner
+            # owners that didn't fit are loaded back by the refresh() of their next search
+            self._evicted_owners = set(left_out)
+            self._owner_seen = {o: t for o, t in self._owner_seen.items() if o in by_owner}
+            self._cache.clear()
+            self._last_global_id, self._last_user_id = max_g, max_u
+            self._refreshed_at = time.monotonic()
+            self.ready = True
+        return len(entries)
+
+    def add(self, e: Entry) -> None:
+        key = self._key(e)
+        with self._lock:
+            if key in self._entries:
+                return
+            if len(self._entries) >= self.max_products:
+                self._evict()
+            self._entries[key] = e
+            if e.owner:
+                self._by_owner.setdefault(e.owner, []).append(key)
+                self._owner_seen.setdefault(e.owner, time.monotonic())  # just added a product: not cold
+            for tok in e.tokens:
+                lo = bisect_left(self._tokens, tok)
+                hi = bisect_right(self._tokens, tok, lo)
+                i = bisect_left(self._keys, self._rank(key), lo, hi, key=self._rank)
+                self._tokens.insert(i, tok)
+                self._keys.insert(i, key)
+            self._cache.clear()
+            self.stats["added"] += 1
+
+    def update(self, ref_type: str, product_id: int, kcal: float, p: float, f: float, c: float) -> None:
+        """New macros of an indexed product (a recipe whose ingredients changed); names and ranking stay."""
+        with self._lock:
+            e = self._entries.get(product_id if ref_type == "global" else -product_id)
+            if e is None:
+                return
+            e.kcal, e.p, e.f, e.c = kcal, p, f, c
+            self._cache.clear()
+
+    def _evict(self) -> None:
+        # drop ~1% of the products in one pass over the token list: all products
+        # of the coldest users first (an owner is indexed whole or not at all),
+        # then the least popular global ones
+        n = max(1, self.max_products // 100)
+        victims: set[int] = set()
+        cold = time.monotonic() - self.owner_ttl
+        for owner in sorted(self._by_owner, key=lambda o: self._owner_seen.get(o, 0.0)):
+            if len(victims) >= n or self._owner_seen.get(owner, 0.0) > cold:
+                break
+            victims.update(self._by_owner.pop(owner))
+            self._owner_seen.pop(owner, None)
+            self._evicted_owners.add(owner)
+        if len(victims) < n:
+            victims.update(sorted(
+                (k for k, e in self._entries.items() if e.ref_type == "global"),
+                key=lambda k: self._entries[k].popularity,
+            )[:n - len(victims)])
+        if not victims:
+            return
+        keep = [i for i, k in enumerate(self._keys) if k not in victims]
+        self._tokens = [self._tokens[i] for i in keep]
+        self._keys = array("q", (self._keys[i] for i in keep))
+        for k in victims:
+            del self._entries[k]
+        self.stats["evicted"] += len(victims)
+
+    def refresh(self, db_path: str, force: bool = False, user_id: int | None = None) -> int:
+        """
+        Index products added since the last warm/refresh. Cheap no-op within
+        refresh_interval, except that the products of `user_id` (about to
+        search) are loaded back if they were evicted.
+        """
+        added = 0
+        if self.ready and user_id is not None and user_id in self._evicted_owners:
+            with self._lock:
+                self._owner_seen[user_id] = time.monotonic()  # so adding them doesn't evict them again
+                self._evicted_owners.discard(user_id)
+            for row in db.user_products_for_index(db_path, user_id):
+                self.add(self._entry(row, "user"))
+                added += 1
+        now = time.monotonic()
+        if not self.ready or (not force and now - self._refreshed_at < self.refresh_interval):
+            return added
+        self._refreshed_at = now
+        glob, users = db.products_added_since(db_path, self._last_global_id, self._last_user_id)
+        for row in glob:
+            self.add(self._entry(row, "global"))
+            self._last_global_id = max(self._last_global_id, int(row["id"]))
+        for row in users:
+            # an evicted owner's new products come back with the rest of theirs
+            if int(row["user_id"]) not in self._evicted_owners:
+                self.add(self._entry(row, "user"))
+            self._last_user_id = max(self._last_user_id, int(row["id"]))
+        return added + len(glob) + len(users)
+
+    # --- querying ---
+
+    def _global_matches(self, words: list[str], depth: int) -> list[int]:
+        cache_key = " ".join(words)
+        hit = self._cache.get(cache_key)
+        if hit is not None:
+            self._cache.move_to_end(cache_key)
+            self.stats["cache_hits"] += 1
+            return hit
+
+        # scan the range of the longest (most selective) word, taking at most
+        # `depth` matches from each token's popularity-ordered run
+        probe = max(words, key=len)
+        single = len(words) == 1
+        tokens, keys = self._tokens, self._keys
+        i = bisect_left(tokens, probe)
+        scanned = 0
+        seen: set[int] = set()
+        found: list[Entry] = []
+        while i < len(tokens) and tokens[i].startswith(probe) and scanned < self.max_candidates:
+            tok = tokens[i]
+            end = bisect_right(tokens, tok, i)
+            taken = 0
+            while i < end and taken < depth and scanned < self.max_candidates:
+                key = keys[i]
+                i += 1
+                scanned += 1
+                if key < 0 or key in seen:
+                    continue
+                seen.add(key)
+                e = self._entries[key]
+                if single or e.matches(words):
+                    found.append(e)
+                    taken += 1
+            i = end
+        found.sort(key=lambda e: (-e.popularity, e.id))
+        result = [self._key(e) for e in found[:depth]]
+
+        self._cache[cache_key] = result
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return result
+
+    def search(self, user_id: int, query: str, limit: int = 20, prefer: set[tuple[str, int]] | None = None) -> list[dict[str, Any]]:
+        """
+        Products whose name tokens start with every query word: the user's own
+        products first, then global ones by popularity. `prefer` ((ref_type, id)
+        pairs, e.g. the user's recent products) are moved to the front.
+        """
+        words = normalize(query)
+        if not words:
+            return []
+        with self._lock:
+            self.stats["queries"] += 1
+            if user_id in self._by_owner:
+                self._owner_seen[user_id] = time.monotonic()
+            own = [self._entries[k] for k in self._by_owner.get(user_id, ()) if k in self._entries]
+            hits = [e for e in own if e.matches(words)]
+            hits += [self._entries[k] for k in self._global_matches(words, max(limit, 50)) if k in self._entries]
+        if prefer:
+            hits.sort(key=lambda e: (e.ref_type, e.id) not in prefer)
+        return [e.as_dict() for e in hits[:limit]]
+
+    def size(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "products": len(self._entries), "tokens": len(self._tokens), "cached_queries": len(self._cache),
+                "evicted_owners": len(self._evicted_owners),
+            }
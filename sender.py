@@ -0,0 +1,318 @@
+from __future__ import annotations
+
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+import requests
+from telebot.apihelper import ApiTelegramException
+
+import metrics
+
+# Priority lanes: lower value is served first.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+LANES = (PRIORITY_INTERACTIVE, PRIORITY_BULK)
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, up to `capacity` stored."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1.0))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now: float | None = None) -> float:
+        """Seconds until one token is available (0 if available now)."""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+    def take(self, now: float | None = None) -> bool:
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+@dataclass
+class OutboundMessage:
+    chat_id: int
+    method: str
+    args: tuple
+    kwargs: dict[str, Any]
+    priority: int
+    seq: int
+    future: Future = field(default_factory=Future)
+    enqueued_at: float = field(default_factory=time.monotonic)
+    attempts: int = 0
+
+
+def retry_after_of(exc: BaseException) -> float | None:
+    """Flood-wait seconds from a Telegram 429 error, None for other errors."""
+    if isinstance(exc, ApiTelegramException) and exc.error_code == 429:
+        params = (exc.result_json or {}).get("parameters") or {}
+        return float(params.get("retry_after", 1))
+    return None
+
+
+def is_blocked_error(exc: BaseException) -> bool:
+    """403: bot was blocked by the user / user is deactivated."""
+    return isinstance(exc, ApiTelegramException) and exc.error_code == 403
+
+
+def is_network_error(exc: BaseException) -> bool:
+    """Connection failure or timeout: worth retrying. Other requests errors (bad URL, ...) are not."""
+    if isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    return isinstance(exc, OSError) and not isinstance(exc, requests.exceptions.RequestException)
+
+
+class OutboundSender:
+    """
+    Single outbound queue for all Bot API sends.
+
+    Messages are taken from priority lanes (interactive before bulk), throttled by
+    a global and a per-chat token bucket, and retried on 429 using retry_after.
+    A chat that is out of tokens is parked so other chats keep flowing.
+
+    A 429 or a network error holds the whole chat (everything queued for it
+    waits, so its messages stay in order) for retry_after or the backoff.
+    429s from `global_flood_chats` different chats within `global_flood_window`
+    seconds mean the bot as a whole is limited, and pause every chat.
+    """
+
+    def __init__(
+        self,
+        bot,
+        global_rate: float = 30.0,
+        chat_rate: float = 1.0,
+        chat_burst: float = 3.0,
+        max_retries: int = 3,
+        on_blocked: Callable[[int], None] | None = None,
+        global_flood_chats: int = 3,
+        global_flood_window: float = 1.0,
+    ):
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.on_blocked = on_blocked
+        self.global_flood_chats = global_flood_chats
+        self.global_flood_window = global_flood_window
+
+        self._lanes: dict[int, deque[OutboundMessage]] = {p: deque() for p in LANES}
+        self._parked: list[tuple[float, int, OutboundMessage]] = []  # (ready_at, seq, msg)
+        self._chat_buckets: dict[int, TokenBucket] = {}
+        self._held: dict[int, float] = {}  # chat_id -> monotonic time its sends resume
+        self._floods: deque[tuple[float, int]] = deque()  # recent 429s: (time, chat_id)
+        self._paused_until = 0.0
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread: threading.Thread | None = None
+        self._stopping = False
+
+        self.metrics: dict[str, float] = {
+            "enqueued": 0,
+            "sent": 0,
+            "failed": 0,
+            "retried": 0,
+            "flood_waits": 0,
+            "flood_wait_seconds": 0.0,
+            "global_flood_waits": 0,
+            "blocked": 0,
+            "queue_latency_sum": 0.0,
+            "queue_latency_max": 0.0,
+        }
+
+    # --- public API ---
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="outbound-sender", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float | None = 5.0) -> None:
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def submit(self, chat_id: int, method: str, *args, priority: int = PRIORITY_INTERACTIVE, **kwargs) -> Future:
+        msg = OutboundMessage(chat_id, method, args, kwargs, priority, next(self._seq))
+        with self._cond:
+            self._lanes[priority].append(msg)
+            self.metrics["enqueued"] += 1
+            self._cond.notify()
+        return msg.future
+
+    def send_message(self, chat_id: int, text: str, priority: int = PRIORITY_INTERACTIVE, **kwargs) -> Future:
+        return self.submit(chat_id, "send_message", chat_id, text, priority=priority, **kwargs)
+
+    def pending(self) -> int:
+        with self._cond:
+            return sum(len(q) for q in self._lanes.values()) + len(self._parked)
+
+    def stats(self) -> dict[str, Any]:
+        with self._cond:
+            out = dict(self.metrics)
+            out["queued_interactive"] = len(self._lanes[PRIORITY_INTERACTIVE])
+            out["queued_bulk"] = len(self._lanes[PRIORITY_BULK])
+            out["parked"] = len(self._parked)
+            out["chat_buckets"] = len(self._chat_buckets)
+            out["held_chats"] = len(self._held)
+        sent = out["sent"] or 1
+        out["queue_latency_avg"] = out["queue_latency_sum"] / sent
+        return out
+
+    # --- worker ---
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        b = self._chat_buckets.get(chat_id)
+        if b is None:
+            b = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return b
+
+    def _unpark(self, now: float) -> None:
+        due = []
+        while self._parked and self._parked[0][0] <= now:
+            due.append(heapq.heappop(self._parked)[2])
+        # return to the head of their lanes keeping the original order
+        for msg in sorted(due, key=lambda m: m.seq, reverse=True):
+            self._lanes[msg.priority].appendleft(msg)
+
+    def _prune_buckets(self, now: float) -> None:
+        for chat_id in [c for c, until in self._held.items() if until <= now]:
+            del self._held[chat_id]
+        if len(self._chat_buckets) < 10000:
+            return
+        for chat_id in [c for c, b in self._chat_buckets.items() if b.is_full(now)]:
+            del self._chat_buckets[chat_id]
+
+    def _hold(self, msg: OutboundMessage, until: float) -> None:
+        """Park msg and keep its chat's later messages behind it until `until`. Called with the lock held."""
+        self._held[msg.chat_id] = max(self._held.get(msg.chat_id, 0.0), until)
+        heapq.heappush(self._parked, (self._held[msg.chat_id], msg.seq, msg))
+        self._cond.notify()
+
+    def _is_global_flood(self, chat_id: int, now: float) -> bool:
+        self._floods.append((now, chat_id))
+        while self._floods and self._floods[0][0] < now - self.global_flood_window:
+            self._floods.popleft()
+        return len({c for _, c in self._floods}) >= self.global_flood_chats
+
+    def _next(self) -> OutboundMessage | None:
+        """Pick the next sendable message, or wait. Called with the lock held."""
+        while not self._stopping:
+            now = time.monotonic()
+            self._unpark(now)
+
+            delay = self._paused_until - now
+            if delay <= 0:
+                delay = self.global_bucket.wait_time(now)
+            if delay <= 0:
+                for p in LANES:
+                    lane = self._lanes[p]
+                    while lane:
+                        msg = lane.popleft()
+                        held = self._held.get(msg.chat_id, 0.0)
+                        if held > now:
+                            heapq.heappush(self._parked, (held, msg.seq, msg))
+                            continue
+                        bucket = self._chat_bucket(msg.chat_id)
+                        wait = bucket.wait_time(now)
+                        if wait > 0:
+                            heapq.heappush(self._parked, (now + wait, msg.seq, msg))
+                            continue
+                        bucket.take(now)
+                        self.global_bucket.take(now)
+                        return msg
+                delay = None
+
+            if self._parked:
+                park_delay = max(self._parked[0][0] - now, 0.0)
+                delay = park_delay if delay is None else min(delay, park_delay)
+            self._prune_buckets(now)
+            self._cond.wait(delay)
+        return None
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                msg = self._next()
+            if msg is None:
+                return
+            self._deliver(msg)
+
+    def _deliver(self, msg: OutboundMessage) -> None:
+        msg.attempts += 1
+        try:
+            with metrics.timed("telegram", msg.method):
+                result = getattr(self.bot, msg.method)(*msg.args, **msg.kwargs)
+        except Exception as e:
+            self._on_error(msg, e)
+            return
+
+        latency = time.monotonic() - msg.enqueued_at
+        with self._cond:
+            self.metrics["sent"] += 1
+            self.metrics["queue_latency_sum"] += latency
+            self.metrics["queue_latency_max"] = max(self.metrics["queue_latency_max"], latency)
+        msg.future.set_result(result)
+
+    def _on_error(self, msg: OutboundMessage, exc: Exception) -> None:
+        retry_after = retry_after_of(exc)
+        if retry_after is not None and msg.attempts <= self.max_retries:
+            with self._cond:
+                now = time.monotonic()
+                self.metrics["flood_waits"] += 1
+                self.metrics["flood_wait_seconds"] += retry_after
+                self.metrics["retried"] += 1
+                if self._is_global_flood(msg.chat_id, now):
+                    self.metrics["global_flood_waits"] += 1
+                    self._paused_until = max(self._paused_until, now + retry_after)
+                self._hold(msg, now + retry_after)
+            return
+
+        # anything else (TypeError from a bad reply_markup, ...) fails the same way every time
+        if is_network_error(exc) and msg.attempts <= self.max_retries:
+            with self._cond:
+                self.metrics["retried"] += 1
+                backoff = min(2 ** msg.attempts, 30)
+                self._hold(msg, time.monotonic() + backoff)
+            return
+
+        with self._cond:
+            self.metrics["failed"] += 1
+            if is_blocked_error(exc):
+                self.metrics["blocked"] += 1
+        if is_blocked_error(exc) and self.on_blocked:
+            try:
+                self.on_blocked(msg.chat_id)
+            except Exception:
+                pass
+        msg.future.set_exception(exc)
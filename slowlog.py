@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+import logging
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any
+
+import database as db
+
+log = logging.getLogger("kbju.slowlog")
+
+_WS = re.compile(r"\s+")
+# "SCAN food_log" / "SCAN TABLE food_log" (older SQLite) = full table scan. So is
+# "SCAN t USING [COVERING] INDEX idx": every index entry is read, the index only
+# gives the order. Lookups with a constraint are SEARCH ... (col=?) lines.
+_FULL_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)(?: AS \w+)?(?: USING (?:COVERING )?INDEX \w+)?$")
+
+PLAN_TTL = 600.0  # re-EXPLAIN a statement at most this often, seconds
+
+_lock = threading.Lock()
+_threshold = 0.0
+_enabled = False
+_tables: set[str] = set()
+
+
+@dataclass
+class SlowStatement:
+    sql: str
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+    params_shape: str = ""
+    plan: list[str] = field(default_factory=list)
+    full_scans: list[str] = field(default_factory=list)
+    planned_at: float = 0.0
+
+
+_stats: dict[str, SlowStatement] = {}
+
+
+def _normalize(sql: str) -> str:
+    return _WS.sub(" ", sql).strip()
+
+
+def params_shape(params: Any) -> str:
+    """Types and sizes of the bound parameters, never their values."""
+    if params is None:
+        return "many"
+    if isinstance(params, dict):
+        items = params.items()
+    else:
+        items = enumerate(params)
+    parts = []
+    for k, v in items:
+        name = type(v).__name__
+        if isinstance(v, (str, bytes)):
+            name += f"[{len(v)}]"
+        parts.append(name if isinstance(k, int) else f"{k}={name}")
+    return "(" + ", ".join(parts) + ")"
+
+
+def _known_tables(conn: sqlite3.Connection) -> set[str]:
+    if not _tables:
+        rows = sqlite3.Connection.execute(conn, "SELECT name FROM sqlite_master WHERE type='table'").fetchall()
+        _tables.update(r[0] for r in rows)
+    return _tables
+
+
+def explain(conn: sqlite3.Connection, sql: str, params: Any) -> tuple[list[str], list[str]]:
+    """EXPLAIN QUERY PLAN lines and the tables that are scanned without an index."""
+    # sqlite3.Connection.execute directly, so the EXPLAIN itself is not observed
+    rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, params or ()).fetchall()
+    plan = [r[3] for r in rows]
+    tables = _known_tables(conn)
+    scans = []
+    for detail in plan:
+        m = _FULL_SCAN.match(detail)
+        if m and m.group(1) in tables:
+            scans.append(m.group(1))
+    return plan, scans
+
+
+def _on_query(sql: str, params: Any, seconds: float, conn: sqlite3.Connection) -> None:
+    if seconds < _threshold:
+        return
+    key = _normalize(sql)
+    now = time.monotonic()
+    with _lock:
+        st = _stats.get(key)
+        if st is None:
+            st = _stats[key] = SlowStatement(key)
+        st.count += 1
+        st.total += seconds
+        st.max = max(st.max, seconds)
+        st.params_shape = params_shape(params)
+        need_plan = params is not None and now - st.planned_at > PLAN_TTL
+        if need_plan:
+            st.planned_at = now
+
+    if need_plan:
+        try:
+            plan, scans = explain(conn, sql, params)
+        except sqlite3.Error:
+            plan, scans = [], []
+        with _lock:
+            st.plan, st.full_scans = plan, scans
+
+    log.warning(
+        "slow query %.1f ms %s params=%s%s plan=%s",
+        seconds * 1000, key[:200], st.params_shape,
+        f" FULL SCAN: {', '.join(st.full_scans)}" if st.full_scans else "",
+        " | ".join(st.plan),
+    )
+
+
+def enable(threshold_ms: float) -> None:
+    global _threshold, _enabled
+    _threshold = threshold_ms / 1000.0
+    if not _enabled:
+        _enabled = True
+        db.add_query_observer(_on_query)
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def top(n: int = 10) -> list[SlowStatement]:
+    with _lock:
+        return sorted(_stats.values(), key=lambda s: s.total, reverse=True)[:n]
+
+
+def reset() -> None:
+    with _lock:
+        _stats.clear()
+
+
+def report(n: int = 10) -> str:
+    if not _enabled:
+        return "🐢 Профилировщик запросов выключен (SLOW_QUERY_MS=0)"
+    items = top(n)
+    if not items:
+        return f"🐢 Нет запросов дольше {_threshold * 1000:.0f} мс"
+    lines = [f"🐢 ТОП-{len(items)} медленных запросов (> {_threshold * 1000:.0f} мс)"]
+    for i, s in enumerate(items, 1):
+        flag = f" ⚠️ SCAN {', '.join(s.full_scans)}" if s.full_scans else ""
+        lines.append(
+            f"\n{i}. Σ {s.total * 1000:.0f} мс, ×{s.count}, max {s.max * 1000:.0f} мс{flag}\n"
+            f"{s.sql[:160]}\n{s.params_shape}"
+        )
+        if s.plan:
+            lines.append("plan: " + " | ".join(s.plan)[:200])
+    return "\n".join(lines)
@@ -0,0 +1,335 @@
+"""
+Soak test: hours of synthetic traffic through the bot.py handlers against local
+fake Bot API, Open Food Facts and YooKassa servers with injected faults
+(latency, 429s, timeouts, duplicate and stale payment webhooks).
+
+    python soak.py --duration 7200 --window 60 --threads 4 --json soak.json
+
+Every window it samples latency percentiles, RSS and traced memory, STATE and
+the in-process caches, open file descriptors, threads and the DB/WAL size.
+The report fits a trend over the windows after warm-up and flags leaks and
+latency drift; the exit code is 1 if anything was flagged. Faults and user
+sessions come from counters and a seeded RNG, so two runs with the same
+arguments see the same sequence. Uses a throwaway database.
+"""
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_servers import FakeBotAPI, FakeOFF, FakeYooKassa
+from loadtest import Recorder, UpdateFactory, build_session, percentile, rss_kb, seed_products
+
+
+def fd_count() -> int:
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return -1
+
+
+def file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def slope(xs: list[float], ys: list[float]) -> float:
+    """Least-squares slope of ys over xs."""
+    n = len(xs)
+    if n < 2:
+        return 0.0
+    mx, my = sum(xs) / n, sum(ys) / n
+    den = sum((x - mx) ** 2 for x in xs)
+    return sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / den if den else 0.0
+
+
+class Soak:
+    def __init__(self, args, bot_mod, db_mod, backup_mod, fakes: dict):
+        self.args = args
+        self.bot = bot_mod
+        self.db = db_mod
+        self.backup = backup_mod
+        self.fakes = fakes
+        self.factory = UpdateFactory()
+        self.product_ids: list[int] = []
+        # known users, grown by --new-users per window, so per-user caches see both hits and new keys
+        self.users = [100000 + i for i in range(args.users)]
+        self.next_user = itertools.count(100000 + args.users)
+        self.expected: dict[str, str] = {}  # provider payment id -> final status
+        self.samples: list[dict] = []
+        self.handler_errors = 0
+        self.started = 0.0
+
+    def play_window(self, index: int, deadline: float) -> tuple[Recorder, int]:
+        rec = Recorder()
+        sessions = itertools.count()
+
+        def worker(k: int) -> None:
+            rnd = random.Random(self.args.seed * 1_000_003 + index * 101 + k)
+            while time.monotonic() < deadline:
+                uid = rnd.choice(self.users)
+                for name, handler, update in build_session(self.bot, self.factory, rnd, uid, self.product_ids, first=False):
+                    rec.run(name, handler, update)
+                    if self.args.think:
+                        time.sleep(self.args.think)
+                next(sessions)
+
+        with ThreadPoolExecutor(max_workers=self.args.threads) as pool:
+            list(pool.map(worker, range(self.args.threads)))
+        return rec, next(sessions)
+
+    def new_users(self) -> None:
+        for _ in range(self.args.new_users):
+            uid = next(self.next_user)
+            self.users.append(uid)
+            self.bot.start(self.factory.message(uid, "/start"))
+            # build_session speaks Russian
+            self.bot.cb_setlang(self.factory.callback(uid, "setlang:ru"))
+
+    def payments_round(self, rnd: random.Random) -> None:
+        import requests
+
+        api = self.fakes["yookassa"]
+        for _ in range(self.args.payments):
+            uid = rnd.choice(self.users)
+            # what create_sbp_payment does through the SDK, against the fake
+            resp = requests.post(f"{api.base_url}/v3/payments", json={
+                "amount": {"value": "199.00", "currency": "RUB"}, "description": "soak",
+                "metadata": {"telegram_user_id": str(uid)},
+            }, timeout=5).json()
+            self.db.create_payment(self.bot.cfg.db_path, uid, "yookassa", 199.0, "RUB", resp["id"], f"soak-{resp['id']}")
+            succeed = rnd.random() < 0.8
+            self.expected[resp["id"]] = "succeeded" if succeed else "canceled"
+            api.pay(resp["id"], succeed=succeed)
+
+    def sample(self, index: int, rec: Recorder, sessions: int, seconds: float) -> dict:
+        bot, db = self.bot, self.db
+        lat = [x for v in rec.latency.values() for x in v]
+        errors = sum(rec.errors.values())
+        self.handler_errors += errors
+        checkpoint = self.backup.checkpoint(bot.cfg.db_path, "PASSIVE")
+        api, off = self.fakes["bot_api"], self.fakes["off"]
+        s = {
+            "window": index,
+            "minute": (time.monotonic() - self.started) / 60,
+            "sessions": sessions,
+            "updates": len(lat),
+            "ups": len(lat) / seconds if seconds else 0.0,
+            "p50_ms": percentile(lat, 50) * 1000,
+            "p95_ms": percentile(lat, 95) * 1000,
+            "p99_ms": percentile(lat, 99) * 1000,
+            "errors": errors,
+            "rss_kb": rss_kb(),
+            "traced_kb": tracemalloc.get_traced_memory()[0] / 1024,
+            "fds": fd_count(),
+            "threads": threading.active_count(),
+            "state": len(bot.STATE),
+            "undo": len(bot.UNDO),
+            "recent_cache": len(db._recent_cache),
+            "day_totals_cache": len(db._day_totals),
+            "search_cached_queries": bot.product_index.size()["cached_queries"],
+            "ingress_users": bot.ingress.snapshot()["tracked_users"],
+            "sender_pending": bot.sender.pending(),
+            "sender_chat_buckets": bot.sender.stats()["chat_buckets"],
+            "db_bytes": file_size(bot.cfg.db_path),
+            "wal_bytes": file_size(bot.cfg.db_path + "-wal"),
+            "checkpoint_busy": int((checkpoint or {}).get("busy", 0)),
+            "api_429": sum(n for (m, st), n in api.counts.items() if st == 429),
+            "api_timeouts": api.timeouts,
+            "off_timeouts": off.timeouts,
+        }
+        with db.connect(bot.cfg.db_path) as conn:
+            rows = conn.execute("SELECT COUNT(*) FROM food_log").fetchone()[0]
+        s["food_log_rows"] = rows
+        s["bytes_per_row"] = s["db_bytes"] / rows if rows else 0.0
+        return s
+
+    def run(self) -> None:
+        a = self.args
+        rnd = random.Random(a.seed)
+        self.product_ids = seed_products(self.db, self.bot.cfg.db_path, a.products, rnd)
+        self.bot.product_index.warm(self.bot.cfg.db_path)
+        for uid in self.users:
+            self.bot.start(self.factory.message(uid, "/start"))
+            self.bot.cb_setlang(self.factory.callback(uid, "setlang:ru"))
+
+        tracemalloc.start()
+        self.started = time.monotonic()
+        windows = max(1, int(a.duration // a.window))
+        for i in range(windows):
+            t0 = time.monotonic()
+            self.new_users()
+            self.payments_round(rnd)
+            rec, sessions = self.play_window(i, t0 + a.window)
+            s = self.sample(i, rec, sessions, time.monotonic() - t0)
+            self.samples.append(s)
+            print(f"[{s['minute']:6.1f} min] {s['updates']:>6} upd {s['ups']:7.1f}/s p50 {s['p50_ms']:6.2f} p95 {s['p95_ms']:6.2f} ms "
+                  f"err {s['errors']} | RSS {s['rss_kb']} KB traced {s['traced_kb']:.0f} KB fds {s['fds']} thr {s['threads']} "
+                  f"STATE {s['state']} | db {s['db_bytes'] // 1024} KB wal {s['wal_bytes'] // 1024} KB", flush=True)
+
+        # let the outbound queue and webhook deliveries settle before checking them
+        deadline = time.monotonic() + 60
+        while (self.bot.sender.pending() or self.fakes["yookassa"].pending()) and time.monotonic() < deadline:
+            time.sleep(0.2)
+        time.sleep(0.5)
+        tracemalloc.stop()
+
+    def verdicts(self) -> tuple[dict, list[str]]:
+        a = self.args
+        warm = self.samples[min(len(self.samples) - 1, max(1, int(len(self.samples) * a.warmup))):] if len(self.samples) > 2 else self.samples
+        hours = [s["minute"] / 60 for s in warm]
+        trend = {
+            "rss_kb_per_hour": slope(hours, [s["rss_kb"] for s in warm]),
+            "traced_kb_per_hour": slope(hours, [s["traced_kb"] for s in warm]),
+            "fds_per_hour": slope(hours, [s["fds"] for s in warm]),
+            "threads_per_hour": slope(hours, [s["threads"] for s in warm]),
+            "p95_ms_per_hour": slope(hours, [s["p95_ms"] for s in warm]),
+            "bytes_per_row_per_hour": slope(hours, [s["bytes_per_row"] for s in warm]),
+        }
+        q = max(1, len(warm) // 4)
+        first_p95 = sorted(s["p95_ms"] for s in warm[:q])[q // 2]
+        last_p95 = sorted(s["p95_ms"] for s in warm[-q:])[q // 2]
+        trend["p95_drift"] = last_p95 / first_p95 if first_p95 else 1.0
+
+        flags = []
+        if self.handler_errors:
+            flags.append(f"{self.handler_errors} handler errors")
+        if trend["rss_kb_per_hour"] > a.max_rss_growth * 1024:
+            flags.append(f"RSS grows {trend['rss_kb_per_hour'] / 1024:.1f} MB/h (limit {a.max_rss_growth} MB/h)")
+        if trend["traced_kb_per_hour"] > a.max_rss_growth * 1024:
+            flags.append(f"Python heap grows {trend['traced_kb_per_hour'] / 1024:.1f} MB/h")
+        if warm[-1]["fds"] - warm[0]["fds"] > 5:
+            flags.append(f"file descriptors {warm[0]['fds']} -> {warm[-1]['fds']}")
+        if warm[-1]["threads"] - warm[0]["threads"] > 2:
+            flags.append(f"threads {warm[0]['threads']} -> {warm[-1]['threads']}")
+        if trend["p95_drift"] > a.max_drift:
+            flags.append(f"p95 latency drifted x{trend['p95_drift']:.2f} ({first_p95:.1f} -> {last_p95:.1f} ms)")
+        # every session ends with "back", so STATE should drain between windows
+        if self.samples[-1]["state"] > a.threads:
+            flags.append(f"STATE holds {self.samples[-1]['state']} users after the last window")
+        if self.samples[-1]["sender_pending"]:
+            flags.append(f"{self.samples[-1]['sender_pending']} messages still queued")
+
+        wrong = []
+        for pid, want in self.expected.items():
+            row = self.db.get_payment_by_provider_id(self.bot.cfg.db_path, pid)
+            if row is None or row["status"] != want:
+                wrong.append(pid)
+        if wrong:
+            flags.append(f"{len(wrong)} of {len(self.expected)} payments ended in the wrong status")
+        return trend, flags
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--duration", type=float, default=3600.0, help="seconds")
+    ap.add_argument("--window", type=float, default=60.0, help="seconds per sample")
+    ap.add_argument("--users", type=int, default=200, help="users at the start")
+    ap.add_argument("--new-users", type=int, default=0, help="users joining every window (per-user caches then grow towards their caps, which reads as growth)")
+    ap.add_argument("--threads", type=int, default=4)
+    ap.add_argument("--think", type=float, default=0.2, help="pause between a user's updates, seconds; keep the load below what the outbound queue drains")
+    ap.add_argument("--products", type=int, default=5000)
+    ap.add_argument("--payments", type=int, default=10, help="payments per window")
+    ap.add_argument("--seed", type=int, default=1)
+    # faults
+    ap.add_argument("--api-latency", type=float, default=0.01, help="fake Bot API delay per request, seconds")
+    ap.add_argument("--flood-every", type=int, default=200, help="every N-th send gets a 429")
+    ap.add_argument("--timeout-every", type=int, default=1000, help="every N-th send hangs past the client timeout")
+    ap.add_argument("--off-timeout-every", type=int, default=10, help="every N-th OFF lookup hangs past OFF_TIMEOUT")
+    ap.add_argument("--dup-every", type=int, default=3, help="every N-th payment notification is delivered twice")
+    ap.add_argument("--stale-every", type=int, default=4, help="every N-th final notification is followed by a stale one")
+    # verdicts
+    ap.add_argument("--warmup", type=float, default=0.5, help="share of windows left out of the trends, while the per-user caches fill")
+    ap.add_argument("--max-rss-growth", type=float, default=16.0, help="MB per hour")
+    ap.add_argument("--max-drift", type=float, default=1.5, help="p95 of the last quarter / first quarter")
+    ap.add_argument("--json", help="write the report to this file")
+    args = ap.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="kbju-soak-")
+    fakes = {
+        "bot_api": FakeBotAPI(flood_every=args.flood_every, latency=args.api_latency, timeout_every=args.timeout_every, hang=3.0, keep_calls=False).start(),
+        "off": FakeOFF(latency=0.05, timeout_every=args.off_timeout_every, hang=2.0).start(),
+    }
+    os.environ.update({
+        "BOT_TOKEN": "123456:SOAK",
+        "DB_PATH": os.path.join(workdir, "soak.sqlite3"),
+        "TELEGRAM_API_URL": fakes["bot_api"].api_url,
+        "OFF_BASE_URL": fakes["off"].base_url,
+        "OFF_ENABLED": "1",
+        "OFF_TIMEOUT": "1",
+        # the fake has no limits; real ones would only turn the soak into a test of the queue
+        "SEND_RATE_GLOBAL": "1000",
+        "SEND_RATE_CHAT": "100",
+        "BACKUP_INTERVAL": "0",
+    })
+
+    import backup as backup_mod
+    import bot as bot_mod
+    import database as db_mod
+    import payments_yookassa
+    import requests
+    from telebot import apihelper
+
+    bot_mod.create_app()
+    apihelper.READ_TIMEOUT = 2  # below the fake's hang, so injected timeouts are real client timeouts
+    bot_mod.sender.start()
+    def fetch(payment_id: str) -> dict:
+        # what fetch_payment_status does through the SDK, against the fake
+        resp = requests.get(f"{fakes['yookassa'].base_url}/v3/payments/{payment_id}", timeout=5)
+        resp.raise_for_status()
+        return resp.json()
+
+    hook = payments_yookassa.WebhookServer(bot_mod.cfg.db_path, "127.0.0.1", 0, bot_mod.cfg.webhook_path, fetch).start()
+    fakes["yookassa"] = FakeYooKassa(
+        webhook_url=f"http://127.0.0.1:{hook.port}{bot_mod.cfg.webhook_path}",
+        dup_every=args.dup_every, stale_every=args.stale_every,
+    ).start()
+
+    soak = Soak(args, bot_mod, db_mod, backup_mod, fakes)
+    try:
+        soak.run()
+    finally:
+        bot_mod.sender.stop()
+    trend, flags = soak.verdicts()
+
+    report = {
+        "params": vars(args),
+        "samples": soak.samples,
+        "trend": trend,
+        "flags": flags,
+        "payments": {"expected": len(soak.expected), "webhook": hook.stats, "deliveries": dict(fakes["yookassa"].delivery)},
+        "sender": bot_mod.sender.stats(),
+        "fake_api": {f"{m} {st}": n for (m, st), n in sorted(fakes["bot_api"].counts.items())},
+        "off": {"requests": fakes["off"].requests, "timeouts": fakes["off"].timeouts},
+        "db_writer": db_mod.writer_stats(bot_mod.cfg.db_path),
+    }
+    print(f"trend: RSS {trend['rss_kb_per_hour'] / 1024:+.1f} MB/h, heap {trend['traced_kb_per_hour'] / 1024:+.1f} MB/h, "
+          f"fds {trend['fds_per_hour']:+.1f}/h, p95 {trend['p95_ms_per_hour']:+.2f} ms/h (x{trend['p95_drift']:.2f})")
+    last = soak.samples[-1]
+    print(f"caches at the end: recent {last['recent_cache']}, day totals {last['day_totals_cache']}, search queries {last['search_cached_queries']}, "
+          f"ingress {last['ingress_users']}, chat buckets {last['sender_chat_buckets']}, STATE {last['state']}, UNDO {last['undo']}")
+    print(f"payments: {len(soak.expected)} created, webhooks {hook.stats}")
+    print("OK: no leaks or drift flagged" if not flags else "FLAGGED:\n  " + "\n  ".join(flags))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    hook.stop()
+    for fake in fakes.values():
+        fake.stop()
+    raise SystemExit(1 if flags else 0)
+
+
+if __name__ == "__main__":
+    main()
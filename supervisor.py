@@ -0,0 +1,230 @@
+"""
+Run the bot as N worker processes on one host.
+
+The supervisor initializes the schema once, long-polls getUpdates and routes
+every update to worker `user_id % N`, so all updates of a user are handled by
+the same process, in order, and its STATE and per-user caches stay local.
+Worker 0 is the primary and also runs the broadcast scheduler and the stats
+job. A worker that dies is restarted with the same shard and queue.
+
+Each worker has its own outbound sender, ingress limiter and DB writer, so
+SEND_RATE_GLOBAL and INGRESS_RATE_GLOBAL are split evenly between workers and
+the writers of different workers contend for the SQLite write lock (a writer
+waits and retries BEGIN IMMEDIATE while another one commits).
+
+    python supervisor.py --workers 4
+"""
+from __future__ import annotations
+
+import argparse
+import logging
+import multiprocessing as mp
+import os
+import signal
+import threading
+import time
+from typing import Any
+
+from dotenv import load_dotenv
+from telebot import apihelper
+
+import database as db
+from config import ALLOWED_UPDATES, load_config
+
+log = logging.getLogger("kbju.supervisor")
+
+# per-worker slots in the shared counters array
+PROCESSED, BUSY_SECONDS, ERRORS, HEARTBEAT = range(4)
+SLOTS = 4
+
+
+def route_key(update: dict[str, Any]) -> int:
+    """user_id of the update (chat id for anonymous posts), update_id as a last resort."""
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        sender = value.get("from") or value.get("user") or value.get("chat") or (value.get("message") or {}).get("chat")
+        if isinstance(sender, dict) and "id" in sender:
+            return int(sender["id"])
+    return int(update.get("update_id", 0))
+
+
+def worker_main(index: int, workers: int, inbox, counters) -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(processName)s %(levelname)s %(message)s")
+    os.environ["DB_INIT"] = "0"
+    # the sender's and the ingress limiter's global buckets are per process;
+    # each worker gets its share of the bot-wide limits (per-chat/user ones stay, a user is on one worker)
+    cfg = load_config()
+    os.environ["SEND_RATE_GLOBAL"] = str(cfg.send_rate_global / workers)
+    os.environ["INGRESS_RATE_GLOBAL"] = str(cfg.ingress_rate_global / workers)
+    port = int(os.getenv("METRICS_PORT", "0") or 0)
+    if port:
+        os.environ["METRICS_PORT"] = str(port + index)
+
+    import bot as app  # preloaded by the fork server, so this is a dict lookup
+    from telebot import types
+
+    # one update at a time: per-user order is the order of the shard queue
+    app.create_app(threaded=False)
+    app.start_services(primary=(index == 0))
+    base = index * SLOTS
+    log.info("worker %d started, pid %d", index, os.getpid())
+
+    while True:
+        counters[base + HEARTBEAT] = time.time()
+        try:
+            raw = inbox.get(timeout=1.0)
+        except Exception:
+            continue
+        if raw is None:
+            break
+        t0 = time.perf_counter()
+        try:
+            app.bot.process_new_updates([types.Update.de_json(raw)])
+        except Exception:
+            log.exception("worker %d: update %s failed", index, raw.get("update_id"))
+            counters[base + ERRORS] += 1
+        counters[base + PROCESSED] += 1
+        counters[base + BUSY_SECONDS] += time.perf_counter() - t0
+
+    app.sender.stop()
+    app.scheduler.stop()
+    app.stats_job.stop()
+    app.backups.stop()
+    db.stop_writer(app.cfg.db_path)
+
+
+class Supervisor:
+    def __init__(self, workers: int, report_interval: float = 60.0):
+        load_dotenv()
+        self.cfg = load_config()
+        self.n = workers
+        self.report_interval = report_interval
+        # workers fork from a server that has already imported the bot modules
+        # (importing bot has no side effects), so a (re)spawn skips ~200 ms of imports
+        self.ctx = mp.get_context("forkserver")
+        self.ctx.set_forkserver_preload(["bot"])
+        self.queues = [self.ctx.Queue() for _ in range(workers)]
+        self.counters = self.ctx.Array("d", workers * SLOTS, lock=False)
+        self.procs: list[Any] = [None] * workers
+        self.restarts = [0] * workers
+        self._stopping = threading.Event()
+        self._routed = [0] * workers
+
+    def _spawn(self, i: int) -> None:
+        p = self.ctx.Process(target=worker_main, args=(i, self.n, self.queues[i], self.counters), name=f"kbju-worker-{i}", daemon=True)
+        p.start()
+        self.procs[i] = p
+
+    def start(self) -> None:
+        db.init_db(self.cfg.db_path)
+        if self.cfg.bot_api_url:
+            apihelper.API_URL = self.cfg.bot_api_url
+        for i in range(self.n):
+            self._spawn(i)
+        threading.Thread(target=self._watch, name="supervisor-watch", daemon=True).start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        for q in self.queues:
+            q.put(None)
+        for p in self.procs:
+            if p is not None:
+                p.join(10)
+                if p.is_alive():
+                    p.terminate()
+
+    def dispatch(self, update: dict[str, Any]) -> int:
+        i = route_key(update) % self.n
+        self.queues[i].put(update)
+        self._routed[i] += 1
+        return i
+
+    def load(self) -> list[dict[str, Any]]:
+        out = []
+        for i, p in enumerate(self.procs):
+            base = i * SLOTS
+            try:
+                backlog = self.queues[i].qsize()
+            except NotImplementedError:
+                backlog = -1
+            out.append({
+                "worker": i,
+                "pid": p.pid if p else None,
+                "alive": bool(p and p.is_alive()),
+                "restarts": self.restarts[i],
+                "routed": self._routed[i],
+                "processed": int(self.counters[base + PROCESSED]),
+                "errors": int(self.counters[base + ERRORS]),
+                "busy_seconds": self.counters[base + BUSY_SECONDS],
+                "backlog": backlog,
+                "heartbeat_age": time.time() - self.counters[base + HEARTBEAT] if self.counters[base + HEARTBEAT] else None,
+            })
+        return out
+
+    def _watch(self) -> None:
+        prev = {w["worker"]: w for w in self.load()}
+        last = time.monotonic()
+        while not self._stopping.wait(min(5.0, self.report_interval)):
+            for i, p in enumerate(self.procs):
+                if p is not None and not p.is_alive() and not self._stopping.is_set():
+                    log.error("worker %d (pid %s) exited with %s, restarting", i, p.pid, p.exitcode)
+                    self.restarts[i] += 1
+                    self._spawn(i)
+            now = time.monotonic()
+            if now - last < self.report_interval:
+                continue
+            cur = self.load()
+            dt = now - last
+            parts = []
+            for w in cur:
+                was = prev.get(w["worker"], w)
+                rate = (w["processed"] - was["processed"]) / dt
+                busy = (w["busy_seconds"] - was["busy_seconds"]) / dt
+                stuck = " STUCK" if w["heartbeat_age"] is not None and w["heartbeat_age"] > 60 else ""
+                parts.append(f"w{w['worker']}: {rate:.1f} upd/s busy {busy:.0%} backlog {w['backlog']} err {w['errors']}{stuck}")
+            log.info("load | %s", " | ".join(parts))
+            prev = {w["worker"]: w for w in cur}
+            last = now
+
+    def poll(self) -> None:
+        offset = None
+        # like infinity_polling(skip_pending=True): drop what queued up while we were down
+        pending = apihelper.get_updates(self.cfg.bot_token, offset=-1, timeout=0)
+        if pending:
+            offset = pending[-1]["update_id"] + 1
+        while not self._stopping.is_set():
+            try:
+                updates = apihelper.get_updates(
+                    self.cfg.bot_token, offset=offset, timeout=20,
+                    allowed_updates=ALLOWED_UPDATES, long_polling_timeout=20,
+                )
+            except Exception:
+                log.exception("getUpdates failed")
+                self._stopping.wait(3)
+                continue
+            for u in updates:
+                offset = u["update_id"] + 1
+                self.dispatch(u)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--workers", type=int, default=int(os.getenv("WORKERS", "0") or 0) or os.cpu_count() or 1)
+    ap.add_argument("--report-interval", type=float, default=60.0, help="seconds between per-worker load log lines")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(processName)s %(levelname)s %(message)s")
+
+    sup = Supervisor(args.workers, args.report_interval)
+    signal.signal(signal.SIGTERM, lambda *_: sup._stopping.set())
+    sup.start()
+    try:
+        sup.poll()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sup.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,9 @@
 # texts.py
 
+from string import Formatter
+from types import MappingProxyType
+from typing import Callable
+
 TEXTS = {
     "ru": {
         "choose_lang": "Выбери язык / Choose language:",
@@ -35,13 +39,38 @@ TEXTS = {
         "enter_query": "Напиши название продукта (RU/EN).",
         "no_results": "Ничего не нашла 😕",
         "choose_product": "Выбери продукт:",
+        "btn_add_to_diary": "➕ Добавить в дневник",
         "enter_grams": "Сколько грамм?",
         "grams_hint": "Можно кнопками: +50, +100, +200",
         "added_ok": "✅ Добавлено",
+        "slow_down": "Слишком много сообщений подряд, подожди пару секунд 🙏",
+        "barcode_cooldown": "Слишком много неизвестных штрихкодов подряд. Попробуй позже или найди продукт по названию.",
+        "batch_confirm": "Добавить в дневник? Выбери приём пищи:",
+        "batch_total": "Итого: {kcal:.0f} ккал",
+        "batch_added": "✅ Добавлено в «{meal}»: {n}\nЗа сегодня: {kcal:.0f} ккал",
+        "batch_cancelled": "Отменено",
+        "batch_expired": "Список устарел, пришли его ещё раз",
+        "btn_cancel": "✖️ Отмена",
 
         "my_products_title": "Мои продукты",
         "limit_reached": "Лимит бесплатных продуктов: {n}",
 
+        "btn_new_recipe": "🍲 Новый рецепт",
+        "recipe_name_prompt": "Как назвать рецепт?",
+        "recipe_items_prompt": (
+            "Пришли ингредиенты, по одному в строке: название и граммы.\n"
+            "Например:\nгречка 80\nкурица 150\n\nКогда всё — жми «{btn}»."
+        ),
+        "btn_done": "✅ Готово",
+        "recipe_item_added": "➕ {name} — {grams:g} г",
+        "recipe_item_not_found": "Не нашла: {query}",
+        "recipe_empty": "В рецепте пока нет ингредиентов",
+        "recipe_card": "🍲 <b>{name}</b>, {weight:g} г\nНа 100 г: {kcal:.0f} ккал · Б {p:.1f} · Ж {f:.1f} · У {c:.1f}",
+        "btn_add_ingredient": "➕ Ингредиент",
+        "btn_recipe_yield": "⚖️ Вес готового блюда",
+        "recipe_yield_prompt": "Сколько весит готовое блюдо, в граммах? 0 — считать по сумме ингредиентов.",
+        "recipe_cycle": "Рецепт не может содержать сам себя",
+
         "send_kbju_per100": (
             "Введи КБЖУ на 100 г:\n\n"
             "Ккал Б Ж У\n"
@@ -59,12 +88,25 @@ TEXTS = {
         "diary_title": "Дневник",
         "today": "Сегодня",
         "list_view": "🧾 Списком",
+        "diary_day": "📒 {day}",
+        "diary_list": "🧾 Все записи, сначала новые",
+        "diary_total": "Итого: {kcal:.0f} ккал · Б {p:.0f} г · Ж {f:.0f} г · У {c:.0f} г",
+        "btn_more_entries": "⬇️ Ещё",
+        "btn_edit_grams": "⚖️ Граммы",
+        "btn_delete": "🗑 Удалить",
+        "btn_undo": "↩️ Отменить",
+        "entry_deleted": "🗑 Удалено: {entry}",
+        "entry_updated": "✏️ Изменено: {entry}",
+        "entry_restored": "↩️ Вернула: {entry}",
+        "entry_not_found": "Запись не найдена",
+        "nothing_to_undo": "Нечего отменять",
 
         "summary_title": "Сводка",
         "sum_today": "Сегодня",
         "sum_week": "Неделя",
         "sum_month": "Месяц",
         "remaining": "До цели",
+        "summary_totals": "📊 {period}: {kcal:.0f} ккал\nБ {p:.0f} г · Ж {f:.0f} г · У {c:.0f} г",
 
         "settings_title": "Настройки",
         "set_lang": "🌐 Язык",
@@ -79,23 +121,249 @@ TEXTS = {
         "activity": "🏃 Активность",
         "cal_norm": "🧮 Норма",
         "macros": "🥩 Макросы",
+        "profile_prompt": (
+            "Пол, возраст, вес (кг) и рост (см) через пробел:\n"
+            "Пример: м 30 80 180"
+        ),
+        "profile_empty": "Профиль не заполнен — нажми «👤 Профиль».",
+        "profile_text": "👤 {sex}, {age} лет, {weight:g} кг, {height:g} см\n🏃 {activity}\n🎯 {goal}",
+        "sex_m": "муж.",
+        "sex_f": "жен.",
+        "pick_activity": "Выбери уровень активности:",
+        "act_sedentary": "Сидячая работа, без спорта",
+        "act_light": "1–3 тренировки в неделю",
+        "act_moderate": "3–5 тренировок в неделю",
+        "act_high": "6–7 тренировок в неделю",
+        "act_extreme": "Тяжёлый труд или 2 тренировки в день",
+        "targets_text": "🧮 Норма в день: {kcal:.0f} ккал\nБ {p:.0f} г · Ж {f:.0f} г · У {c:.0f} г",
+        "bmr_text": "Базовый обмен (Миффлин — Сан Жеор): {bmr:.0f} ккал",
+        "macros_text": "🥩 Белки {p:.0f} г ({p_share:.0%}) · Жиры {f:.0f} г ({f_share:.0%}) · Углеводы {c:.0f} г ({c_share:.0%})",
+        "remaining_text": "🍽 На сегодня осталось: {kcal:.0f} ккал\nБ {p:.0f} г · Ж {f:.0f} г · У {c:.0f} г\nСъедено {eaten:.0f} из {target:.0f} ккал",
 
         "feedback_title": "Обратная связь",
         "feedback_prompt": "Напиши сообщение:",
         "thanks": "Спасибо! 🫶",
 
         "admin_title": "Админ-панель",
+
+        "pdf_disabled": "📄 PDF пока временно отключен (вернём позже).",
+        "my_products_add_hint": "{btn} — чтобы добавить",
     },
 
     "en": {
+        "choose_lang": "Выбери язык / Choose language:",
+        "lang_ru": "🇷🇺 Русский",
+        "lang_en": "🇬🇧 English",
+
         "main_title": "Main menu",
+        "btn_add_food": "➕ Add food",
+        "btn_diary": "📒 Diary",
+        "btn_summary": "📊 Summary",
+        "btn_more": "☰ More",
+        "btn_back": "⬅️ Back",
+
+        "more_title": "More",
+        "btn_my_products": "⭐ My products",
+        "btn_search": "🔎 Search",
+        "btn_goals": "🎯 Goals & targets",
+        "btn_settings": "⚙️ Settings",
+        "btn_feedback": "💬 Feedback",
+        "btn_admin": "👑 Admin panel",
+
+        "add_food_title": "Add food",
+        "btn_find_product": "🔎 Find product",
+        "btn_recent": "🕘 Recent",
+        "btn_add_new_product": "➕ Add new product",
+
+        "pick_meal": "Choose a meal:",
+        "meal_breakfast": "🍳 Breakfast",
+        "meal_lunch": "🍲 Lunch",
+        "meal_dinner": "🍽 Dinner",
+        "meal_snack": "🍏 Snack",
+
+        "enter_query": "Type a product name (RU/EN).",
+        "no_results": "Nothing found 😕",
+        "choose_product": "Choose a product:",
+        "btn_add_to_diary": "➕ Add to diary",
+        "enter_grams": "How many grams?",
+        "grams_hint": "You can use the buttons: +50, +100, +200",
+        "added_ok": "✅ Added",
+        "slow_down": "Too many messages in a row, wait a couple of seconds 🙏",
+        "barcode_cooldown": "Too many unknown barcodes in a row. Try again later or search by name.",
+        "batch_confirm": "Add to the diary? Pick the meal:",
+        "batch_total": "Total: {kcal:.0f} kcal",
+        "batch_added": "✅ Added to “{meal}”: {n}\nToday: {kcal:.0f} kcal",
+        "batch_cancelled": "Cancelled",
+        "batch_expired": "This list is outdated, send it again",
+        "btn_cancel": "✖️ Cancel",
+
+        "my_products_title": "My products",
+        "limit_reached": "Free products limit: {n}",
+
+        "btn_new_recipe": "🍲 New recipe",
+        "recipe_name_prompt": "What's the recipe called?",
+        "recipe_items_prompt": (
+            "Send the ingredients, one per line: name and grams.\n"
+            "For example:\nbuckwheat 80\nchicken 150\n\nPress “{btn}” when you're done."
+        ),
+        "btn_done": "✅ Done",
+        "recipe_item_added": "➕ {name} — {grams:g} g",
+        "recipe_item_not_found": "Not found: {query}",
+        "recipe_empty": "The recipe has no ingredients yet",
+        "recipe_card": "🍲 <b>{name}</b>, {weight:g} g\nPer 100 g: {kcal:.0f} kcal · P {p:.1f} · F {f:.1f} · C {c:.1f}",
+        "btn_add_ingredient": "➕ Ingredient",
+        "btn_recipe_yield": "⚖️ Cooked weight",
+        "recipe_yield_prompt": "How much does the cooked dish weigh, in grams? 0 — use the sum of the ingredients.",
+        "recipe_cycle": "A recipe can't contain itself",
+
+        "send_kbju_per100": (
+            "Send calories and macros per 100 g:\n\n"
+            "Kcal P F C\n"
+            "Example: 165 31 3.6 0"
+        ),
+
+        "send_names": (
+            "Now the product names:\n\n"
+            "RU: Куриная грудка\n"
+            "EN: Chicken breast"
+        ),
+
+        "bad_format": "Wrong format 😕",
+
+        "diary_title": "Diary",
+        "today": "Today",
+        "list_view": "🧾 List",
+        "diary_day": "📒 {day}",
+        "diary_list": "🧾 All entries, newest first",
+        "diary_total": "Total: {kcal:.0f} kcal · P {p:.0f} g · F {f:.0f} g · C {c:.0f} g",
+        "btn_more_entries": "⬇️ More",
+        "btn_edit_grams": "⚖️ Grams",
+        "btn_delete": "🗑 Delete",
+        "btn_undo": "↩️ Undo",
+        "entry_deleted": "🗑 Deleted: {entry}",
+        "entry_updated": "✏️ Changed: {entry}",
+        "entry_restored": "↩️ Restored: {entry}",
+        "entry_not_found": "Entry not found",
+        "nothing_to_undo": "Nothing to undo",
+
+        "summary_title": "Summary",
+        "sum_today": "Today",
+        "sum_week": "Week",
+        "sum_month": "Month",
+        "remaining": "Remaining",
+        "summary_totals": "📊 {period}: {kcal:.0f} kcal\nP {p:.0f} g · F {f:.0f} g · C {c:.0f} g",
+
+        "settings_title": "Settings",
+        "set_lang": "🌐 Language",
+        "set_tz": "🕒 Time zone",
+        "set_quick_grams": "⚡ Quick grams",
+
+        "goals_title": "Goals & targets",
+        "goal_cut": "Lose weight",
+        "goal_maint": "Maintain",
+        "goal_bulk": "Gain",
+        "profile": "👤 Profile",
+        "activity": "🏃 Activity",
+        "cal_norm": "🧮 Calorie target",
+        "macros": "🥩 Macros",
+        "profile_prompt": (
+            "Sex, age, weight (kg) and height (cm), separated by spaces:\n"
+            "Example: m 30 80 180"
+        ),
+        "profile_empty": "No profile yet — tap “👤 Profile”.",
+        "profile_text": "👤 {sex}, {age} y.o., {weight:g} kg, {height:g} cm\n🏃 {activity}\n🎯 {goal}",
+        "sex_m": "male",
+        "sex_f": "female",
+        "pick_activity": "Choose your activity level:",
+        "act_sedentary": "Desk job, no sport",
+        "act_light": "1–3 workouts a week",
+        "act_moderate": "3–5 workouts a week",
+        "act_high": "6–7 workouts a week",
+        "act_extreme": "Physical job or 2 workouts a day",
+        "targets_text": "🧮 Daily norm: {kcal:.0f} kcal\nP {p:.0f} g · F {f:.0f} g · C {c:.0f} g",
+        "bmr_text": "Basal metabolic rate (Mifflin-St Jeor): {bmr:.0f} kcal",
+        "macros_text": "🥩 Protein {p:.0f} g ({p_share:.0%}) · Fat {f:.0f} g ({f_share:.0%}) · Carbs {c:.0f} g ({c_share:.0%})",
+        "remaining_text": "🍽 Left for today: {kcal:.0f} kcal\nP {p:.0f} g · F {f:.0f} g · C {c:.0f} g\nEaten {eaten:.0f} of {target:.0f} kcal",
+
+        "feedback_title": "Feedback",
+        "feedback_prompt": "Write your message:",
+        "thanks": "Thank you! 🫶",
+
+        "admin_title": "Admin panel",
+
+        "pdf_disabled": "📄 PDF export is temporarily disabled (coming back later).",
+        "my_products_add_hint": "{btn} — to add one",
     },
 }
 
+DEFAULT_LANG = "ru"
+
+# Где искать ключ, если его нет в таблице языка. Последний в цепочке — DEFAULT_LANG.
+FALLBACKS: dict[str, tuple[str, ...]] = {
+    "ru": ("ru",),
+    "en": ("en", "ru"),
+}
+
+
+def _chain(lang: str) -> tuple[str, ...]:
+    chain = FALLBACKS.get(lang, (lang,))
+    return chain if chain[-1] == DEFAULT_LANG else chain + (DEFAULT_LANG,)
+
+
+def _compile() -> tuple[MappingProxyType, MappingProxyType]:
+    keys = {k for table in TEXTS.values() for k in table}
+    catalog: dict[tuple[str, str], str] = {}
+    templates: dict[tuple[str, str], Callable[..., str]] = {}
+    for lang in TEXTS:
+        for key in keys:
+            for src in _chain(lang):
+                if key in TEXTS.get(src, {}):
+                    text = TEXTS[src][key]
+                    catalog[(lang, key)] = text
+                    if any(field for _, field, _, _ in Formatter().parse(text) if field is not None):
+                        templates[(lang, key)] = text.format
+                    break
+    return MappingProxyType(catalog), MappingProxyType(templates)
+
+
+# (lang, key) -> text, с уже применёнными fallback-цепочками
+CATALOG, TEMPLATES = _compile()
+
 
 def t(key: str, lang: str) -> str:
     """
     Получить текст по ключу и языку.
     Если ключ не найден — вернуть сам ключ.
     """
-    return TEXTS.get(lang, TEXTS["ru"]).get(key, key)
+    text = CATALOG.get((lang, key))
+    if text is None:
+        text = CATALOG.get((DEFAULT_LANG, key), key)
+    return text
+
+
+def tf(key: str, lang: str, **kwargs) -> str:
+    """t() + подстановка параметров для шаблонов вроде limit_reached."""
+    fmt = TEMPLATES.get((lang, key)) or TEMPLATES.get((DEFAULT_LANG, key))
+    if fmt is None:
+        return t(key, lang)
+    return fmt(**kwargs)
+
+
+def missing_keys() -> dict[str, list[str]]:
+    """Ключи, которых нет в собственной таблице языка (закрываются fallback-ом)."""
+    keys = {k for table in TEXTS.values() for k in table}
+    return {lang: sorted(keys - table.keys()) for lang, table in TEXTS.items()}
+
+
+def coverage() -> dict[str, float]:
+    keys = {k for table in TEXTS.values() for k in table}
+    return {lang: len(table.keys() & keys) / len(keys) for lang, table in TEXTS.items()}
+
+
+if __name__ == "__main__":
+    import sys
+
+    missing = missing_keys()
+    for lang, pct in coverage().items():
+        print(f"{lang}: {pct:.0%}" + (f", missing: {', '.join(missing[lang])}" if missing[lang] else ""))
+    sys.exit(1 if any(missing.values()) else 0)